@@ -0,0 +1,113 @@
+import logging
+import re
+import shutil
+import subprocess
+import zipfile
+from collections import namedtuple
+from os import path, remove
+
+import release
+
+# Defaults for extracting movies from archive sets: extractions running at once overall, and extractions
+# reading from or writing to any one device at once.
+WORKERS = 2
+PER_DEVICE = 1
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# A file packed in an archive, by its name within the archive and its unpacked size.
+Member = namedtuple('Member', ['name', 'size'])
+
+
+def kind(archive_file):
+    volume = release.archive_volume(path.basename(archive_file))
+    return volume[0] if volume else None
+
+
+def can_extract(archive_file):
+    """True if archives of this kind can be extracted here: ZIP files always can, RAR sets need unrar."""
+
+    return kind(archive_file) == release.ZIP or shutil.which('unrar') is not None
+
+
+def members(archive_file):
+    """The files packed in an archive set, given its first volume. Returns None if it can't be read."""
+
+    if kind(archive_file) == release.ZIP:
+        try:
+            with zipfile.ZipFile(archive_file) as z:
+                return [Member(info.filename, info.file_size) for info in z.infolist() if not info.is_dir()]
+        except (OSError, zipfile.BadZipFile):
+            logging.exception('Could not read [%s]', archive_file)
+            return None
+
+    try:
+        result = subprocess.run(['unrar', 'lt', '-p-', archive_file], stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        logging.exception('Could not run unrar on [%s]', archive_file)
+        return None
+    if result.returncode != 0:
+        logging.error('unrar failed on [%s] with exit status [%d]: %s', archive_file, result.returncode,
+                      result.stderr.decode(errors='replace').strip())
+        return None
+
+    # The technical listing has a block of 'Field: value' lines per file.
+    found = []
+    name = None
+    for line in result.stdout.decode(errors='replace').splitlines():
+        match = re.match(r'\s*(Name|Type|Size): (.*)$', line)
+        if match is None:
+            continue
+        field, value = match.groups()
+        if field == 'Name':
+            name = value
+        elif field == 'Type' and value != 'File':
+            name = None
+        elif field == 'Size' and name is not None:
+            found.append(Member(name, int(value)))
+            name = None
+    return found
+
+
+def main_video(archive_file):
+    """The largest video file packed in an archive set, or None if there isn't one."""
+
+    videos = [member for member in members(archive_file) or ()
+              if path.splitext(member.name)[1].lower() in release.VIDEO_EXTENSIONS]
+    return max(videos, key=lambda member: member.size, default=None)
+
+
+def extract(archive_file, member, destination, chunk_size=CHUNK_SIZE):
+    """Stream a file out of an archive set straight into the destination, without unpacking anything else.
+
+    Returns the number of bytes written, or None if the file couldn't be extracted in full, in which case
+    any partial output is removed."""
+
+    logging.debug('Extracting [%s] from [%s] to [%s]', member.name, archive_file, destination)
+    written = None
+    try:
+        with open(destination, 'wb') as out:
+            if kind(archive_file) == release.ZIP:
+                with zipfile.ZipFile(archive_file) as z, z.open(member.name) as packed:
+                    shutil.copyfileobj(packed, out, chunk_size)
+            else:
+                # unrar prints the file to standard output, which is copied as it comes
+                process = subprocess.Popen(['unrar', 'p', '-inul', '-p-', archive_file, member.name],
+                                           stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+                with process:
+                    shutil.copyfileobj(process.stdout, out, chunk_size)
+                if process.returncode != 0:
+                    raise OSError('unrar exited with status %d' % process.returncode)
+            written = out.tell()
+    except (OSError, zipfile.BadZipFile, KeyError):
+        logging.exception('Could not extract [%s] from [%s]', member.name, archive_file)
+
+    if written is not None and written != member.size:
+        logging.error('Extracted [%d] bytes of [%s] from [%s]; expected [%d].', written, member.name, archive_file,
+                      member.size)
+        written = None
+
+    if written is None and path.exists(destination):
+        remove(destination)
+    return written
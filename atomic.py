@@ -0,0 +1,45 @@
+import fcntl
+import os
+import secrets
+from contextlib import contextmanager
+from os import path
+
+LOCK_SUFFIX = '.lock'
+
+
+@contextmanager
+def locked(lock_file, blocking=True):
+    """Hold an exclusive lock on the file, shared with other processes. If it isn't blocking and another process
+    already has the lock, False is yielded instead of waiting for it."""
+
+    with open(lock_file, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_atomically(file_name, content):
+    """Replace the file with the content (text or bytes) in one step, so that nothing reading it ever sees half
+    of it and an interrupted run can't leave it truncated.
+
+    The content goes to a temporary file of its own next to it first, so runs writing the same file at once
+    never write to the same temporary file. It is created with the usual permissions, as open would. Runs that
+    read the file, change it and write it back must hold its lock throughout (see locked)."""
+
+    temp_file = path.join(path.dirname(path.abspath(file_name)),
+                          '.%s.%s.tmp' % (path.basename(file_name), secrets.token_hex(8)))
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        os.replace(temp_file, file_name)
+    except BaseException:
+        if path.exists(temp_file):
+            os.remove(temp_file)
+        raise
@@ -0,0 +1,502 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from unittest import mock
+
+import PTN
+
+import cache
+import configcache
+import logger
+import metadata
+import names
+import titleindex
+import tmdb
+import transfer
+from copy_files import CopyMedia
+from matcher import SeriesMatcher
+from test_helpers import StubTmdbServer, synthetic_mkv, synthetic_mp4, synthetic_scan_dir, write_file
+
+MIB = 1024 * 1024
+TMPFS = '/dev/shm'
+
+argParser = argparse.ArgumentParser(description='Benchmark the media copying stages.')
+
+argParser.add_argument('--files', type=int, default=2000, help='Number of synthetic files to match')
+argParser.add_argument('--series', type=int, default=300, help='Number of synthetic series to configure')
+argParser.add_argument('--startup-runs', type=int, default=10,
+                       help='Number of times to start a new process for the startup benchmark')
+argParser.add_argument('--repeat', type=int, default=3, help='Number of times to repeat each measurement')
+argParser.add_argument('--names', type=int, default=3000, help='Number of release names to parse')
+argParser.add_argument('--lookups', type=int, default=400, help='Number of release names to classify')
+argParser.add_argument('--tmdb-latency', type=float, default=0.02,
+                       help='Seconds the stub movie DB server takes to answer each query')
+argParser.add_argument('--tmdb-rate', type=float, default=1000,
+                       help='Movie DB requests per second allowed while classifying')
+argParser.add_argument('--index-titles', type=int, default=500000,
+                       help='Number of synthetic titles in the offline title index')
+argParser.add_argument('--index-lookups', type=int, default=20000, help='Number of titles to look up in the index')
+argParser.add_argument('--transfer-files', type=int, default=8, help='Number of series files to move')
+argParser.add_argument('--transfer-size', type=int, default=16, help='Size in MiB of each series file to move')
+argParser.add_argument('--media-size', type=int, default=4096,
+                       help='Size in MiB of the synthetic media files (created sparse, so this costs no disk space)')
+argParser.add_argument('--dir', help='Directory on disk to create synthetic files in')
+argParser.add_argument('--tmpfs', default=TMPFS,
+                       help='Directory on tmpfs to create synthetic files in, if it exists (default %(default)s)')
+argParser.add_argument('--json', help='Write the results as JSON to this file, or - for standard output')
+
+
+class RecordingEngine(transfer.TransferEngine):
+    """Transfer engine keeping the result of every transfer it runs."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = []
+
+    def run(self, jobs, placement=None):
+        results = super().run(jobs, placement)
+        self.results.extend(results)
+        return results
+
+
+def percentiles(samples):
+    """Percentiles in milliseconds of timings in seconds, or None if there aren't any."""
+
+    if not samples:
+        return None
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': ordered[-1] * 1000}
+
+
+def stage_result(stage, items, seconds, latencies=None, bytes=None, **extra):
+    """Record the throughput of a stage and the latency percentiles of the individual items it handled."""
+
+    result = {'stage': stage,
+              'items': items,
+              'seconds': seconds,
+              'items_per_second': items / seconds if seconds else None,
+              'bytes': bytes,
+              'bytes_per_second': bytes / seconds if bytes is not None and seconds else None,
+              'latency_ms': percentiles(latencies)}
+    result.update(extra)
+    return result
+
+
+def timed(function, *args, **kwargs):
+    """Call the function, returning how long it took along with its result."""
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def item_latencies(function, items):
+    """Time the function over each item on its own."""
+
+    return [timed(function, item)[0] for item in items]
+
+
+def synthetic_series(num_series):
+    """Build a series configuration shaped like the real one: one '(.*)(Name)( - )(\\d{1,})(.*)' per show."""
+
+    return [{'name': 'Series %d' % i,
+             'regex': '(.*)(Synthetic Show %d)( - )(\\d{1,})(.*)' % i}
+            for i in range(num_series)]
+
+
+def synthetic_files(num_files, num_series, seed=0):
+    """Build a scan directory listing where roughly half the files match one of the series."""
+
+    rnd = random.Random(seed)
+    files = []
+    for i in range(num_files):
+        if i % 2:
+            files.append('[SubGroup] Synthetic Show %d - %02d [1080p].mkv' % (rnd.randrange(num_series),
+                                                                          rnd.randrange(1, 25)))
+        else:
+            files.append('Some.Other.Download.%d.2019.1080p.WEB-DL.mkv' % i)
+    return files
+
+
+def legacy_match_files(files, series):
+    """The original nested loop: every file against every series with re.match and a TRACE record per pair."""
+
+    matches = []
+    nonmatches = []
+    for f in files:
+        matched = False
+        for show in series:
+            logging.log(logger.TRACE, 'Checking [%s] against [%s] using pattern [%s]',
+                        f, show['name'], show['regex'])
+            if re.match(show['regex'], f):
+                matches.append((f, show))
+                matched = True
+                break
+        if not matched:
+            nonmatches.append(f)
+
+    return matches, nonmatches
+
+
+def bench_match_files(num_files, num_series, repeat):
+    """Compare the original matching loop against the compiled SeriesMatcher."""
+
+    series = synthetic_series(num_series)
+    files = synthetic_files(num_files, num_series)
+
+    matcher = SeriesMatcher(series)
+    if legacy_match_files(files, series) != CopyMedia.match_files(files, matcher):
+        raise AssertionError('Compiled matcher results differ from the original loop.')
+
+    legacy = min(timeit.repeat(lambda: legacy_match_files(files, series), number=1, repeat=repeat))
+    compiled = min(timeit.repeat(lambda: CopyMedia.match_files(files, matcher), number=1, repeat=repeat))
+    build = min(timeit.repeat(lambda: SeriesMatcher(series), number=1, repeat=repeat))
+
+    return [stage_result('match_files legacy loop', num_files, legacy,
+                         item_latencies(lambda f: legacy_match_files([f], series), files), series=num_series),
+            stage_result('match_files', num_files, compiled, item_latencies(matcher.match, files),
+                         series=num_series, build_seconds=build, speed_up=legacy / compiled)]
+
+
+def bench_execute(num_files, num_series, directory, repeat):
+    """Run CopyMedia end to end over a synthetic scan directory: scan, match, move the series files and
+    look up the rest in a stub movie DB."""
+
+    files = synthetic_files(num_files, num_series)
+    scan_dir = os.path.join(directory, 'scan')
+    config_file = os.path.join(directory, 'execute.json')
+    with open(config_file, 'w') as f:
+        json.dump({'scanDir': scan_dir,
+                   'seriesDir': os.path.join(directory, 'series'),
+                   'movieDir': os.path.join(directory, 'movies'),
+                   'scanState': {'enabled': False},
+                   'tmdbCache': {'enabled': False},
+                   'libraryIndex': {'enabled': False},
+                   'tmdbRateLimit': 1000,
+                   'series': synthetic_series(num_series)}, f)
+
+    timings = []
+    with StubTmdbServer() as server:
+        for _ in range(repeat):
+            synthetic_scan_dir(scan_dir, files)
+            c = CopyMedia(config_file=config_file, tmdb='key')
+            timings.append(timed(c.execute)[0])
+            # every repeat starts from an empty library, so it moves the same files again
+            for entry in os.scandir(scan_dir):
+                os.remove(entry.path)
+            for library_dir in ('series', 'movies'):
+                shutil.rmtree(os.path.join(directory, library_dir), ignore_errors=True)
+        requests = len(server.requests) // repeat
+
+    return [stage_result('execute', num_files, min(timings), series=num_series, tmdb_requests=requests)]
+
+
+# Run in a new process: load the configuration and decide whether one file matches a series.
+STARTUP_PROBE = """
+import sys
+from copy_files import CopyMedia
+c = CopyMedia(config_file=sys.argv[1], logfile=sys.argv[2])
+CopyMedia.match_files([sys.argv[3]], c.matcher)
+"""
+
+
+def bench_startup(num_series, directory, runs):
+    """Time new processes from being started to their first match decision, each compiling the configuration
+    from scratch and then loading it already compiled. The time to start the bare interpreter is reported
+    alongside, since it is part of both."""
+
+    config_file = os.path.join(directory, 'startup.json')
+    with open(config_file, 'w') as f:
+        json.dump({'scanDir': os.path.join(directory, 'scan'),
+                   'seriesDir': os.path.join(directory, 'series'),
+                   'movieDir': os.path.join(directory, 'movies'),
+                   'series': synthetic_series(num_series)}, f)
+    name = synthetic_files(1, num_series)[0]
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def start(*args):
+        return timed(subprocess.run, [sys.executable, *args], cwd=here, check=True)[0]
+
+    interpreter = min(start('-c', 'pass') for _ in range(runs))
+
+    results = []
+    for stage, compiled in [('startup compiling config', False), ('startup compiled config', True)]:
+        timings = []
+        for _ in range(runs):
+            if not compiled and os.path.exists(configcache.compiled_file(config_file)):
+                os.remove(configcache.compiled_file(config_file))
+            timings.append(start('-c', STARTUP_PROBE, config_file, os.path.join(directory, 'startup.log'), name))
+        results.append(stage_result(stage, runs, sum(timings), timings, series=num_series,
+                                    interpreter_ms=interpreter * 1000))
+    return results
+
+
+MOVIE_TITLES = ['Toy Story 4', 'Brave', '22 Jump Street', 'Batman vs Superman Dawn of Justice', 'Blade Runner 2049',
+                'The Grand Budapest Hotel', 'Mad Max Fury Road', 'Spirited Away', 'Parasite', 'Knives Out',
+                'Arrival', 'Moonlight', 'Whiplash', 'Inception', 'Her', 'Interstellar', 'Coco', 'Up', 'Soul']
+SHOW_TITLES = ['Planet Earth II', 'The Marvelous Mrs Maisel', 'Sherlock', 'The Expanse', 'Dark', 'Chernobyl',
+               'Fleabag', 'Succession', 'Severance', 'The Bear']
+QUALITIES = ['1080p.BluRay.x264.AC3', '720p.WEB-DL.DD5.1.H264', '2160p.UHD.BluRay.x265.10bit.HDR.DTS-HD.MA.5.1',
+             '1080p.AMZN.WEB-DL.DDP5.1.H.264', '720p_hdtv_x264', '1080p.WEBRip.x265.HEVC.10bit.AAC.5.1']
+GROUPS = ['RARBG', 'HDChina', 'NTb', 'fov', 'LordVako', 'SPARKS', 'GECKOS', 'YTS']
+
+
+def release_names(num_names, seed=0):
+    """Build a corpus of release names in the styles seen in real downloads: movies with a year, episodes in
+    SxxEyy and NxNN forms, and anime style fansub names."""
+
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(num_names):
+        style = i % 4
+        quality = rnd.choice(QUALITIES)
+        group = rnd.choice(GROUPS)
+        if style == 0:
+            title = rnd.choice(MOVIE_TITLES).replace(' ', rnd.choice(['.', ' ', '_']))
+            corpus.append('%s.%d.%s-%s' % (title, rnd.randrange(1980, 2024), quality, group))
+        elif style == 1:
+            title = rnd.choice(SHOW_TITLES).replace(' ', '.')
+            corpus.append('%s.S%02dE%02d.%s-%s' % (title, rnd.randrange(1, 9), rnd.randrange(1, 24), quality, group))
+        elif style == 2:
+            title = rnd.choice(SHOW_TITLES).lower().replace(' ', '.')
+            corpus.append('%s.%dx%02d.%s-%s' % (title, rnd.randrange(1, 9), rnd.randrange(1, 24), quality, group))
+        else:
+            corpus.append('[%s] Synthetic Show %d - %02d [1080p].mkv'
+                          % (group, rnd.randrange(300), rnd.randrange(1, 25)))
+    return corpus
+
+
+def bench_clean_names(num_names, directory):
+    """Compare parsing every name with PTN against the memoized, cached and batched parser layer."""
+
+    corpus = release_names(num_names)
+    unique = len(set(corpus))
+
+    names.set_cache(None)
+    raw = timed(lambda: [PTN.parse(name) for name in corpus])[0]
+    serial = timed(lambda: [names.parse(name) for name in corpus])[0]
+    warm = timed(names.clean_names, corpus)[0]
+
+    names.set_cache(None)
+    with mock.patch.object(names, 'POOL_THRESHOLD', 0):
+        pooled = timed(names.clean_names, corpus)[0]
+
+    names.set_cache(cache.NameCache(os.path.join(directory, 'names.sqlite')))
+    filled = timed(names.clean_names, corpus)[0]
+    # a fresh process starts with nothing in memory
+    names.set_cache(cache.NameCache(os.path.join(directory, 'names.sqlite')))
+    persistent = timed(names.clean_names, corpus)[0]
+    names.set_cache(None)
+
+    return [stage_result(stage, len(corpus), seconds, unique=unique)
+            for stage, seconds in [('PTN.parse', raw), ('parse cold', serial), ('clean_names warm', warm),
+                                   ('clean_names process pool', pooled), ('clean_names filling cache', filled),
+                                   ('clean_names from cache', persistent)]]
+
+
+def bench_classify(num_names, latency, rate_limit, directory):
+    """Time movie DB lookups against a stub server: one at a time as originally done, then as a batch with a
+    cold and a warm cache."""
+
+    corpus = list(dict.fromkeys(release_names(num_names, seed=1)))
+    results = []
+
+    latencies = []
+    is_movie = tmdb.is_movie
+
+    def timed_is_movie(*args, **kwargs):
+        seconds, answer = timed(is_movie, *args, **kwargs)
+        latencies.append(seconds)
+        return answer
+
+    lookups = cache.LookupCache(os.path.join(directory, 'lookups.sqlite'))
+    runs = [('is_movie one at a time', lambda: [tmdb.is_movie(name, 'key') for name in corpus]),
+            ('classify cold cache', lambda: tmdb.classify(corpus, 'key', lookups, rate_limit=rate_limit)),
+            ('classify warm cache', lambda: tmdb.classify(corpus, 'key', lookups, rate_limit=rate_limit))]
+
+    with StubTmdbServer(movies=MOVIE_TITLES[::2], delay=latency) as server, \
+            mock.patch.object(tmdb, 'is_movie', timed_is_movie):
+        for stage, run in runs:
+            latencies.clear()
+            sent = len(server.requests)
+            seconds = timed(run)[0]
+            results.append(stage_result(stage, len(corpus), seconds, latencies,
+                                        tmdb_requests=len(server.requests) - sent, tmdb_latency=latency))
+    lookups.close()
+
+    return results
+
+
+def synthetic_export(export_file, num_titles, seed=0):
+    """Write a TMDB daily movie ID export of made up titles, returning the titles."""
+
+    rnd = random.Random(seed)
+    words = ['%s%s' % (rnd.choice(MOVIE_TITLES).split()[0], i) for i in range(2000)]
+    titles = [' '.join(rnd.choice(words) for _ in range(rnd.randrange(1, 5))) for _ in range(num_titles)]
+    with gzip.open(export_file, 'wt', compresslevel=1) as f:
+        for i, title in enumerate(titles):
+            f.write(json.dumps({'adult': False, 'id': i, 'original_title': title, 'popularity': 0.6,
+                                'video': False}) + '\n')
+    return titles
+
+
+def bench_title_index(num_titles, num_lookups, directory):
+    """Time building the offline title index from an export, then looking titles up in it: straight
+    membership tests, half of them misses, and full is_movie answers for release names."""
+
+    export_file = os.path.join(directory, 'movie_ids.json.gz')
+    index_file = os.path.join(directory, titleindex.INDEX_FILE)
+    titles = synthetic_export(export_file, num_titles)
+
+    seconds, count = timed(titleindex.build, export_file, index_file)
+    results = [stage_result('title index build', num_titles, seconds, bytes=os.path.getsize(export_file),
+                            titles=count)]
+
+    rnd = random.Random(2)
+    queries = [rnd.choice(titles) if i % 2 else 'Missing Title %d' % i for i in range(num_lookups)]
+    index = titleindex.TitleIndex(index_file)
+    latencies = item_latencies(lambda title: title in index, queries)
+    results.append(stage_result('title index lookup', len(queries), sum(latencies), latencies, titles=count,
+                                found=sum(title in index for title in queries)))
+
+    corpus = release_names(min(num_lookups, 2000), seed=3)
+    names.clean_names(corpus)
+    latencies = item_latencies(lambda name: tmdb.is_movie(name, None, index=index), corpus)
+    results.append(stage_result('is_movie from title index', len(corpus), sum(latencies), latencies,
+                                tmdb_requests=0))
+    index.close()
+    os.remove(export_file)
+    os.remove(index_file)
+
+    return results
+
+
+def bench_move_series(num_files, size, disk, tmpfs, repeat):
+    """Time moving series files within the disk, and from tmpfs onto the disk."""
+
+    show = {'name': 'Benchmark Show', 'regex': '(.*)(Benchmark Show)( - )(\\d{1,})(.*)'}
+    files = ['[SubGroup] Benchmark Show - %02d [1080p].mkv' % episode for episode in range(num_files)]
+    matches = [(file_name, show) for file_name in files]
+
+    runs = [('move_series same filesystem', disk, disk)]
+    if tmpfs is not None:
+        runs.append(('move_series tmpfs to disk', tmpfs, disk))
+
+    results = []
+    for stage, source, destination in runs:
+        start_dir = os.path.join(source, 'move-from')
+        move_dir = os.path.join(destination, 'move-to')
+        timings = []
+        latencies = []
+        for _ in range(repeat):
+            os.makedirs(start_dir, exist_ok=True)
+            for file_name in files:
+                write_file(os.path.join(start_dir, file_name), size)
+
+            engine = RecordingEngine()
+            timings.append(timed(CopyMedia.move_series, matches, move_dir, start_dir, engine)[0])
+            latencies.extend(result.seconds for result in engine.results)
+            for result in engine.results:
+                if result.error is not None:
+                    raise result.error
+                os.remove(result.destination)
+
+        results.append(stage_result(stage, num_files, min(timings), latencies, bytes=num_files * size,
+                                    method=engine.results[0].method, source=source, destination=destination))
+    return results
+
+
+def bench_strip_metadata(media_size, directories, repeat):
+    """Time stripping the meta-data from each kind of synthetic media file in each of the directories.
+
+    Throughput is of the whole file, alongside the bytes actually written; a remux would write all of them."""
+
+    results = []
+    for label, directory in directories:
+        for name, build in [('movie.mp4', synthetic_mp4), ('movie.mkv', synthetic_mkv)]:
+            file_name = os.path.join(directory, name)
+            timings = []
+            for _ in range(repeat):
+                build(file_name, media_size)
+                written = sum(length for offset, header, length in metadata.find_edits(file_name))
+                timings.append(timed(CopyMedia.strip_metadata, file_name)[0])
+            size = os.path.getsize(file_name)
+            os.remove(file_name)
+
+            results.append(stage_result('strip_metadata %s %s' % (os.path.splitext(name)[1][1:], label), 1,
+                                        min(timings), timings, bytes=size, bytes_written=written))
+    return results
+
+
+def print_results(results):
+    for result in results:
+        line = '%-32s %6d items %10.2f ms' % (result['stage'], result['items'], result['seconds'] * 1000)
+        if result['items_per_second'] is not None:
+            line += ' %10.0f items/s' % result['items_per_second']
+        if result['bytes_per_second'] is not None:
+            line += ' %9.1f MB/s' % (result['bytes_per_second'] / 1000000)
+        if result['latency_ms'] is not None:
+            line += '  latency p50 %.3f p90 %.3f p99 %.3f ms' % tuple(result['latency_ms'][p]
+                                                                      for p in ('p50', 'p90', 'p99'))
+        print(line)
+
+
+def main(argv=None):
+    args = argParser.parse_args(argv)
+
+    # Keep logging at the configured level but out of the way of the results.
+    logging.basicConfig(level=logger.logLevel, handlers=[logging.NullHandler()])
+
+    results = bench_match_files(args.files, args.series, args.repeat)
+
+    with contextlib.ExitStack() as stack:
+        directory = stack.enter_context(tempfile.TemporaryDirectory(dir=args.dir))
+        directories = [('disk', directory)]
+        tmpfs = None
+        if args.tmpfs and os.path.isdir(args.tmpfs):
+            tmpfs = stack.enter_context(tempfile.TemporaryDirectory(dir=args.tmpfs))
+            directories.append(('tmpfs', tmpfs))
+
+        results += bench_execute(args.files, args.series, directory, args.repeat)
+        results += bench_startup(args.series, directory, args.startup_runs)
+        results += bench_clean_names(args.names, directory)
+        results += bench_classify(args.lookups, args.tmdb_latency, args.tmdb_rate, directory)
+        results += bench_title_index(args.index_titles, args.index_lookups, directory)
+        results += bench_move_series(args.transfer_files, args.transfer_size * MIB, directory, tmpfs, args.repeat)
+        results += bench_strip_metadata(args.media_size * MIB, directories, args.repeat)
+
+    if args.json:
+        report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'settings': vars(args),
+                  'stages': results}
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import logger
+
+CACHE_FILE = 'tmdb-cache.sqlite'
+
+# Found movies rarely stop being movies, but a miss may just be a release the movie DB hasn't caught up with yet.
+POSITIVE_TTL = 90 * 24 * 60 * 60
+NEGATIVE_TTL = 3 * 24 * 60 * 60
+MAX_ENTRIES = 20000
+
+
+class LookupCache:
+    """Persistent cache of yes/no lookup answers, stored in a small SQLite database.
+
+    Positive and negative answers expire after their own time to live. Once the cache holds more than
+    max_entries answers, the oldest ones are evicted. The database is only opened on first use, so a
+    cache that is configured but never needed doesn't touch the disk."""
+
+    def __init__(self, cache_file=CACHE_FILE, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 max_entries=MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            logging.debug('Opening lookup cache: [%s]', self.cache_file)
+            self.connection = sqlite3.connect(self.cache_file, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS lookups '
+                                    '(key TEXT PRIMARY KEY, answer INTEGER NOT NULL, stored REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS lookups_stored ON lookups (stored)')
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        """Return the cached answer for the key, or None if there isn't one or it has expired."""
+
+        with self.lock:
+            row = self.connect().execute('SELECT answer, stored FROM lookups WHERE key = ?', (key,)).fetchone()
+
+        if row is None:
+            logging.log(logger.TRACE, 'Lookup cache miss: [%s]', key)
+            return None
+
+        answer = bool(row[0])
+        ttl = self.positive_ttl if answer else self.negative_ttl
+        if time.time() - row[1] > ttl:
+            logging.debug('Cached answer for [%s] has expired.', key)
+            return None
+
+        logging.debug('Lookup cache hit: [%s] is [%s]', key, answer)
+        return answer
+
+    def put(self, key, answer):
+        """Store the answer for the key, evicting the oldest answers if the cache has grown too large."""
+
+        with self.lock:
+            connection = self.connect()
+            connection.execute('INSERT OR REPLACE INTO lookups (key, answer, stored) VALUES (?, ?, ?)',
+                               (key, int(bool(answer)), time.time()))
+
+            excess = connection.execute('SELECT COUNT(*) FROM lookups').fetchone()[0] - self.max_entries
+            if excess > 0:
+                logging.debug('Lookup cache is full; evicting [%d] oldest answers.', excess)
+                connection.execute('DELETE FROM lookups WHERE key IN '
+                                   '(SELECT key FROM lookups ORDER BY stored, rowid LIMIT ?)', (excess,))
+            connection.commit()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class NameCache:
+    """Persistent cache of parsed release names, stored alongside the lookups in the same SQLite database.
+
+    Parsing a name always gives the same result, so entries never expire; once the cache holds more than
+    max_entries names, the least recently stored ones are evicted."""
+
+    def __init__(self, cache_file=CACHE_FILE, max_entries=MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            logging.debug('Opening name cache: [%s]', self.cache_file)
+            self.connection = sqlite3.connect(self.cache_file, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS names '
+                                    '(name TEXT PRIMARY KEY, fields TEXT NOT NULL, stored REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS names_stored ON names (stored)')
+            self.connection.commit()
+        return self.connection
+
+    def get_many(self, names):
+        """Return a dict of each of the names found in the cache to its parsed fields."""
+
+        names = list(names)
+        found = {}
+        with self.lock:
+            connection = self.connect()
+            # stay well within SQLite's limit on the number of parameters in one statement
+            for start in range(0, len(names), 500):
+                batch = names[start:start + 500]
+                rows = connection.execute('SELECT name, fields FROM names WHERE name IN (%s)'
+                                          % ','.join('?' * len(batch)), batch)
+                found.update((name, json.loads(fields)) for name, fields in rows)
+
+        logging.log(logger.TRACE, 'Name cache found [%d] of [%d] names.', len(found), len(names))
+        return found
+
+    def put_many(self, parsed):
+        """Store a dict of names to their parsed fields, evicting the oldest names if the cache has grown too large."""
+
+        if not parsed:
+            return
+
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.executemany('INSERT OR REPLACE INTO names (name, fields, stored) VALUES (?, ?, ?)',
+                                   ((name, json.dumps(fields), now) for name, fields in parsed.items()))
+
+            excess = connection.execute('SELECT COUNT(*) FROM names').fetchone()[0] - self.max_entries
+            if excess > 0:
+                logging.debug('Name cache is full; evicting [%d] oldest names.', excess)
+                connection.execute('DELETE FROM names WHERE name IN '
+                                   '(SELECT name FROM names ORDER BY stored, rowid LIMIT ?)', (excess,))
+            connection.commit()
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,113 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+
+import atomic
+import matcher
+
+# Written next to the configuration file, with this added to its name.
+SUFFIX = '.compiled'
+
+# Changed whenever what is stored changes, so that compiled files written by older versions are ignored.
+VERSION = 2
+
+# The configuration as loaded from its file, along with everything worked out from it alone: the key that
+# scan state is tied to, and the validated series compiled into a SeriesMatcher (None if there are no series).
+CompiledConfig = namedtuple('CompiledConfig', ['config', 'key', 'matcher'])
+
+
+def compiled_file(config_file):
+    return config_file + SUFFIX
+
+
+def config_key(config):
+    """Hash of the configuration, which changes whenever any setting does."""
+
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def code_version(compile):
+    """Hash of the code that compiles the configuration: this module, the matcher and wherever compile is
+    defined. Compiled files written by any other version of it are ignored."""
+
+    sources = {__file__, matcher.__file__}
+    try:
+        sources.add(inspect.getsourcefile(compile))
+    except TypeError:
+        logging.debug('No source file for [%s]', compile)
+    digest = hashlib.sha1()
+    for source in sorted(source for source in sources if source):
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def load(config_file, compile):
+    """Load the configuration file, compiled by compile(config) into a CompiledConfig.
+
+    The result is saved alongside the configuration file, as plain JSON: the configuration, its key and the
+    analysis of its series. Later loads use it for as long as the configuration file keeps the same
+    modification time and size and the code compiling it is unchanged, without even reading the configuration
+    file. If those change, the file is read and its hash checked, so that the configuration is only compiled
+    again when its content has actually changed."""
+
+    stat = os.stat(config_file)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    code = code_version(compile)
+
+    cached = read(compiled_file(config_file), code)
+    if cached is not None and cached['stamp'] == stamp:
+        logging.debug('Using compiled configuration [%s]', compiled_file(config_file))
+        return cached['compiled']
+
+    with open(config_file, 'rb') as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+
+    if cached is not None and cached['hash'] == digest:
+        logging.debug('Configuration file [%s] was touched but not changed.', config_file)
+        compiled = cached['compiled']
+    else:
+        logging.debug('Compiling configuration file [%s]', config_file)
+        compiled = compile(json.loads(content))
+
+    write(compiled_file(config_file), {'version': VERSION, 'code': code, 'stamp': stamp, 'hash': digest,
+                                       'config': compiled.config, 'key': compiled.key,
+                                       'matcher': compiled.matcher and compiled.matcher.state()})
+    return compiled
+
+
+def read(file_name, code):
+    try:
+        with open(file_name, 'rb') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        logging.warning('Could not read compiled configuration [%s]; compiling it again.', file_name)
+        return None
+
+    if not isinstance(cached, dict) or cached.get('version') != VERSION or cached.get('code') != code:
+        logging.debug('Compiled configuration [%s] is from another version; compiling it again.', file_name)
+        return None
+
+    try:
+        config = cached['config']
+        series_matcher = cached['matcher'] and matcher.SeriesMatcher.from_state(config['series'], cached['matcher'])
+        cached['compiled'] = CompiledConfig(config, cached['key'], series_matcher)
+    except (KeyError, TypeError, ValueError, re.error):
+        logging.warning('Compiled configuration [%s] is damaged; compiling it again.', file_name, exc_info=True)
+        return None
+    return cached
+
+
+def write(file_name, cached):
+    # Replaced in one step, so that other runs never read half of it.
+    try:
+        atomic.write_atomically(file_name, json.dumps(cached))
+    except OSError:
+        logging.warning('Could not save compiled configuration [%s].', file_name, exc_info=True)
@@ -1,18 +1,34 @@
 #!/usr/bin/python3
 
 import argparse
-import json
 import logging
+import os
 import re
 import shutil
-import subprocess
-from os import listdir, path, makedirs, rename, remove
+import threading
+from functools import partial
+from os import path, makedirs, rename, remove
 from os.path import isdir, isfile, join, split
 
+import archive
+import cache
+import configcache
 import ifttt
+import library
 import logger
+import metadata
+import metrics
+import names
+import release
+import scanstate
+import titleindex
 import tmdb
+import transfer
+import watch
 from exceptions import ConfigurationError
+from matcher import SeriesMatcher
+from pipeline import PassReport, Stage, run_pipeline
+from plan import COPY, DELETE, DUPLICATE, EXTRACT, MOVE, PLACED_BY, REMUX, RENAME, RESERVED_SPACE, STRIP, Job, Plan
 
 # Set up default file locations for configs and logs
 CONFIG_FILE = './CopyMedia.json'
@@ -31,6 +47,13 @@ argParser.add_argument('-c', '--config', help='Configuration file',
                        default=CONFIG_FILE)
 argParser.add_argument('-t', '--tmdb', help='The Movie DB API key')
 argParser.add_argument('-l', '--log', help='Log file')
+argParser.add_argument('--log-level', help='Level to log at, e.g. INFO or TRACE. Overrides logLevel in the '
+                                          'configuration file.')
+argParser.add_argument('-n', '--dry-run', action='store_true',
+                       help='Print the plan of everything that would be done, without doing any of it')
+argParser.add_argument('-w', '--watch', action='store_true',
+                       help='Keep running, processing new entries in the scan directory as they '
+                            'finish downloading, as well as any paths written to the watch FIFO')
 argParser.add_argument('delugeArgs', default=[], nargs='*',
                        help='If deluge is used, there will be three args,'
                             ' in this order: Torrent Id, Torrent Name, and Torrent Path')
@@ -39,26 +62,56 @@ argParser.add_argument('delugeArgs', default=[], nargs='*',
 class CopyMedia:
     file = None
     logfile = None
+    log_level = None
+    dry_run = False
     configs = None
     config_file = None
     ifttt_url = None
+    notifications = None
     scandir = None
     seriesdir = None
     moviedir = None
     tmdb = None
+    tmdb_cache = None
+    tmdb_workers = None
+    tmdb_rate_limit = None
+    tmdb_timeout = None
+    tmdb_index = None
+    tmdb_fallback = False
+    transfer_engine = None
+    reserved_space = RESERVED_SPACE
+    strip_workers = metadata.WORKERS
+    strips_per_device = metadata.PER_DEVICE
+    strip_timeout = metadata.TIMEOUT
+    extract_workers = archive.WORKERS
+    extracts_per_device = archive.PER_DEVICE
+    scan_state = None
+    retry = None
+    library = None
+    metrics = None
 
     series = None
+    matcher = None
+    reports = None
+    passes = None
+    series_moved = None
 
     def __init__(self, logfile=None, config_file=None, ifttt_url=None, scandir=None,
-                 seriesdir=None, file=None, tmdb=None, moviedir=None):
+                 seriesdir=None, file=None, tmdb=None, moviedir=None, log_level=None, dry_run=False):
         self.file = file
+        self.dry_run = dry_run
         self.logfile = logfile
+        self.log_level = log_level
         self.config_file = config_file
         self.ifttt_url = ifttt_url
         self.scandir = scandir
         self.seriesdir = seriesdir
         self.moviedir = moviedir
         self.tmdb = tmdb
+        self.reports = []
+        self.passes = []
+        self.retry = set()
+        self.series_moved = []
 
         # initialize logging
         if self.logfile:
@@ -87,66 +140,422 @@ class CopyMedia:
         """Initiate the scanning, matching, transformation, and movement of media."""
 
         logging.debug('Begin processing execution...')
+        self.retry.clear()
+
+        with metrics.stage('execute') as timer:
+            # Build list of files based on whether a single file has been
+            # specified or whether we need to scan a directory
+            files = []
+            dirs = []
+            signatures = {}
+            if self.file:
+                self.scandir, name = split(self.file)
+                # the file specified might be a directory, especially if it is a movie. Check and differentiate.
+                if isfile(self.file):
+                    files.append(name)
+                elif isdir(self.file):
+                    dirs.append(name)
+            else:
+                logging.debug('Scanning [%s] for files to process.', self.scandir)
+                files, dirs, signatures = self.scan()
+            timer.add(items=len(files) + len(dirs))
+
+            self.process_entries(files, dirs)
+
+            if self.scan_state is not None and not self.file and not self.dry_run:
+                # Remember everything that was in the directory, except what needs another look on the next run.
+                self.scan_state.save(self.scandir, {name: signature for name, signature in signatures.items()
+                                                    if name not in self.retry}, set(files) | set(dirs))
+
+        if self.metrics is not None:
+            self.metrics.write()
+
+        logging.debug('Processing complete.')
+
+    def scan(self):
+        """List the files and directories in the scan directory in a single pass.
+
+        If a scan state is kept, entries that haven't changed since an earlier run already processed them
+        are skipped. Returns the files and directories to process, along with the signatures of every entry
+        in the directory."""
 
-        # Build list of files based on whether a single file has been
-        # specified or whether we need to scan a directory
         files = []
         dirs = []
-        if self.file:
-            self.scandir, name = split(self.file)
-            # the file specified might be a directory, especially if it is a movie. Check and differentiate.
-            if isfile(self.file):
-                files.append(name)
-            elif isdir(self.file):
-                dirs.append(name)
-        else:
-            logging.debug('Scanning [%s] for files to process.', self.scandir)
-            files = [f for f in listdir(self.scandir) if isfile(join(self.scandir, f))]
-            dirs = [d for d in listdir(self.scandir) if isdir(join(self.scandir, d)) and d != 'tmp']
+        signatures = {}
+        skipped = 0
+        with os.scandir(self.scandir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if entry.name == 'tmp':
+                        continue
+                    found = dirs
+                elif entry.is_file():
+                    found = files
+                else:
+                    continue
+
+                if self.scan_state is not None:
+                    signature = scanstate.signature(entry)
+                    signatures[entry.name] = signature
+                    if self.scan_state.unchanged(self.scandir, entry.name, signature):
+                        skipped += 1
+                        continue
+
+                found.append(entry.name)
+
+        if skipped:
+            logging.debug('Skipped [%d] entries unchanged since they were last processed.', skipped)
+        return files, dirs, signatures
+
+    def watch(self):
+        """Process everything already waiting in the scan directory, then keep processing entries as they arrive."""
+
+        watch_config = self.configs.get('watch', {})
+        fifo_file = watch_config.get('fifo', join(path.dirname(path.abspath(self.config_file or CONFIG_FILE)),
+                                                  watch.FIFO_FILE))
+        watcher = watch.Watcher(self, fifo_file=fifo_file, settle=watch_config.get('settle', watch.SETTLE),
+                                retry_interval=watch_config.get('retryInterval', watch.RETRY_INTERVAL))
+
+        self.execute()
+
+        logging.info('Entering watch mode.')
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            logging.info('Leaving watch mode.')
+
+    def process_entries(self, files, dirs):
+        """Process the given file and directory names found in the scan directory.
+
+        Everything to be done is planned first, then the plan is carried out; in a dry run it is only
+        printed. Returns the plan."""
+
+        plan = Plan()
+        if self.library is not None:
+            self.library.invalidate()
 
         if files or dirs:
             if files:
                 logging.info('Files found: [%s]', files)
-                self.process_files(files)
+                self.process_files(files, plan)
 
             if dirs:
                 logging.info('Directories found: [%s]', dirs)
-                self.process_dirs(dirs)
+                self.process_dirs(dirs, plan)
         else:
             logging.info('No files or directories found. Stopping.')
 
-        logging.debug('Processing complete.')
+        if self.dry_run:
+            print(plan.describe(self.reserved_space))
+        else:
+            self.series_moved = []
+            self.execute_plan(plan)
 
-    def process_dirs(self, dirs):
-        """Process all directories provided.
+            if self.library is not None and not self.library.stale:
+                self.library.save()
+
+            if self.ifttt_url is not None:
+                # Sent in the background, along with any notifications left over from earlier runs.
+                self.notifications.add(self.series_moved, self.ifttt_url)
+        return plan
+
+    def execute_plan(self, plan):
+        """Carry out the jobs of a plan, grouped by device, with jobs for different devices running in parallel.
+
+        Before anything is done, the bytes to be copied onto each destination filesystem are checked against its
+        free space, less the reserved space. Jobs that don't fit are held back: their entries are left in the scan
+        directory and looked at again on the next run.
+
+        Jobs that extract a movie from an archive set, and jobs that remux a movie with ffmpeg, are each scheduled
+        separately, alongside the others, as they are bound by both the disk they read from and the one they write
+        to: no more than extractsPerDevice or stripsPerDevice of them use any one device at once. Each movie is
+        moved as soon as its own extraction or remux is done. Returns the jobs held back."""
+
+        admitted, held = plan.admit(self.reserved_space)
+        for job in held:
+            logging.error('Not enough space in [%s] for [%s]; holding it back until the next run.',
+                          job.destination, job.name)
+            self.retry.update(job.entries)
+
+        ordered = plan.ordered(admitted)
+        extracts = [job for job in ordered if any(step.action == EXTRACT for step in job.steps)]
+        remuxes = [job for job in ordered if job not in extracts and any(step.action == REMUX for step in job.steps)]
+        others = [job for job in ordered if job not in extracts and job not in remuxes]
+
+        schedulers = [threading.Thread(target=transfer.run_on_devices, name=name,
+                                       args=([((job.source_device, job.destination_device), partial(self.run_job, job))
+                                              for job in jobs], workers, per_device))
+                      for name, jobs, workers, per_device in
+                      [('extracts', extracts, self.extract_workers, self.extracts_per_device),
+                       ('remuxes', remuxes, self.strip_workers, self.strips_per_device)]]
+        for scheduler in schedulers:
+            scheduler.start()
+
+        engine = self.transfer_engine or transfer.TransferEngine()
+        transfer.run_in_lanes(((job.destination_device, partial(self.run_job, job)) for job in others),
+                              engine.workers, engine.per_device)
+        for scheduler in schedulers:
+            scheduler.join()
+        return held
+
+    def run_job(self, job):
+        """Run a job of a plan. A job that fails is logged, and doesn't stop any of the others; its entries are
+        looked at again on the next run."""
+
+        logging.debug('Running [%s] with [%d] steps...', job.name, len(job.steps))
+        try:
+            job.run()
+        except Exception:
+            logging.exception('Failed to carry out [%s]', job.name)
+            self.retry.update(job.entries)
+
+    def process_paths(self, paths):
+        """Process specific files and directories, such as those handed over in watch mode.
+
+        The paths don't have to be within the configured scan directory; they are processed from
+        whichever directory they are in."""
+
+        by_dir = {}
+        for entry in paths:
+            parent, name = split(entry)
+            by_dir.setdefault(parent, []).append(name)
+
+        scandir = self.scandir
+        try:
+            with metrics.stage('process_paths') as timer:
+                timer.add(items=len(paths))
+                for parent, entries in by_dir.items():
+                    self.scandir = parent
+                    self.process_entries([name for name in entries if isfile(join(parent, name))],
+                                         [name for name in entries if isdir(join(parent, name))])
+        finally:
+            self.scandir = scandir
+
+        if self.metrics is not None:
+            self.metrics.write()
+
+    def process_dirs(self, dirs, plan):
+        """Plan the processing of all directories provided.
 
         Directories are treated as potential movies only. First, a query is performed against tmdb to determine
         if there is a matching movie. If so, then process the directory as a movie."""
 
+        if self.moviedir is None:
+            logging.debug('No movie directory; skipping directories.')
+            return
+
+        unclaimed, reports = run_pipeline([Stage('movie directories', partial(self.movie_dirs_stage, plan))], dirs)
+        self.reports.extend(reports)
+        logging.debug('Directories left unprocessed: [%s]', unclaimed)
+
+    def movie_dirs_stage(self, plan, dirs):
+        """Claim the directories that are movies and plan the processing of each of them as a movie."""
+
         logging.debug('Checking directories to see if they are movies...')
-        movies = [d for d in dirs if tmdb.is_movie(d, self.tmdb)]
+        found = self.classify(dirs)
+        movies = [d for d in dirs if found[d]]
         logging.debug('Found movies: [%s]', movies)
 
-        if self.moviedir is not None:
-            for movie in movies:
-                self.process_movie(movie)
+        for movie in movies:
+            job = self.plan_movie(plan, movie)
+            if job is not None:
+                plan.add(job)
 
-    def process_movie(self, movie_dir_name):
+        return movies, [d for d in dirs if not found[d]]
+
+    def plan_movie(self, plan, movie_dir_name):
+        """Plan the processing of a movie directory by process_movie, returning the Job or None if it can't be done.
+        If downloads are left in place, the movie is planned to be placed by place_movie instead.
+
+        Everything that could stop the movie being processed is checked here, before anything is renamed."""
+
+        dir = join(self.scandir, movie_dir_name)
+        scan = release.scan_release(dir)
+        if scan.archive is not None:
+            return self.plan_archive(plan, movie_dir_name, scan)
+        if scan.movie is None:
+            logging.error('No movie file found in [%s]', dir)
+            return None
+
+        movie_name = path.basename(scan.movie)
+        try:
+            base_name = self.movie_base_name(movie_name)
+        except RuntimeError:
+            logging.exception('Could not re-name movie file.')
+            return None
+
+        dest = join(self.moviedir, base_name)
+        if path.exists(dest):
+            if self.transfer_engine.placement != transfer.MOVE:
+                logging.info('[%s] is already placed in [%s].', dir, dest)
+            else:
+                logging.error('Movie directory [%s] already exists; leaving [%s] in place.', dest, dir)
+            return None
+
+        if self.transfer_engine.placement != transfer.MOVE:
+            return self.plan_placed_movie(plan, movie_dir_name, scan, base_name)
+
+        job = Job(movie_dir_name, partial(self.process_movie, movie_dir_name, scan), plan.device(dir),
+                  plan.device(self.moviedir), self.moviedir, [movie_dir_name])
+
+        movie = join(dir, scan.movie)
+        if path.dirname(scan.movie):
+            job.add(MOVE, movie, join(dir, movie_name), scan.size)
+
+        new_dir = join(self.scandir, base_name)
+        new_movie = join(new_dir, base_name + path.splitext(movie_name)[1])
+        job.add(RENAME, dir, new_dir)
+        job.add(RENAME, join(new_dir, movie_name), new_movie, scan.size)
+        job.add(DELETE, join(new_dir, '*'), bytes=scan.total - scan.size)
+
+        # Across devices, the movie is stripped as it is copied into a temporary directory in the movie directory
+        # (see strip_and_move_movie), so that's where the stripped movie is.
+        same_device = job.source_device == job.destination_device
+        stripped_movie = new_movie if same_device else join(self.moviedir, '.' + base_name + '.partial',
+                                                              path.basename(new_movie))
+
+        # Stripping in place only writes the meta-data; a remux writes the whole movie again.
+        edits = metadata.find_edits(movie)
+        if edits is not None:
+            job.add(STRIP, stripped_movie, bytes=sum(edit[2] for edit in edits))
+        elif shutil.which('ffmpeg') is None:
+            logging.warning('ffmpeg not found; meta-data will be left in [%s].', movie)
+        elif same_device:
+            job.add(REMUX, new_movie, bytes=scan.size)
+        else:
+            # ffmpeg writes the movie into the movie directory itself, leaving only the rest to be copied
+            job.add(REMUX, new_movie, stripped_movie, scan.size)
+            job.add(COPY, new_dir, dest)
+            return job
+
+        job.add(MOVE if same_device else COPY, new_dir, dest, scan.size)
+        return job
+
+    def plan_placed_movie(self, plan, movie_dir_name, scan, base_name):
+        """Plan placing a movie in the movie directory by place_movie, leaving the release as it is."""
+
+        dir = join(self.scandir, movie_dir_name)
+        job = Job(movie_dir_name, partial(self.place_movie, movie_dir_name, scan), plan.device(dir),
+                  plan.device(self.moviedir), self.moviedir, [movie_dir_name])
+
+        movie = join(dir, scan.movie)
+        temp = join(self.moviedir, '.' + base_name + '.partial')
+        new_movie = join(temp, base_name + path.splitext(scan.movie)[1])
+
+        # A placed movie that is stripped must not share its data with the download, so it is cloned or copied
+        # rather than linked, or written afresh by ffmpeg.
+        edits = metadata.find_edits(movie)
+        if edits:
+            method = self.transfer_engine.method(movie, new_movie, transfer.REFLINK, probe=not self.dry_run)
+            job.add(PLACED_BY[method], movie, new_movie, scan.size)
+            job.add(STRIP, new_movie, bytes=sum(edit[2] for edit in edits))
+        elif edits is None and shutil.which('ffmpeg') is not None:
+            job.add(REMUX, movie, new_movie, scan.size)
+        else:
+            if edits is None:
+                logging.warning('ffmpeg not found; meta-data will be left in [%s].', movie)
+            method = self.transfer_engine.method(movie, new_movie, probe=not self.dry_run)
+            job.add(PLACED_BY[method], movie, new_movie, scan.size)
+
+        if scan.subtitle is not None:
+            subtitle = join(dir, scan.subtitle)
+            new_subtitle = join(temp, base_name + '.en.srt')
+            method = self.transfer_engine.method(subtitle, new_subtitle, probe=not self.dry_run)
+            job.add(PLACED_BY[method], subtitle, new_subtitle, path.getsize(subtitle))
+
+        job.add(RENAME, temp, join(self.moviedir, base_name))
+        return job
+
+    def plan_archive(self, plan, movie_dir_name, scan):
+        """Plan the extraction of a movie packed in an archive set by process_archive, returning the Job or None
+        if it can't be done."""
+
+        dir = join(self.scandir, movie_dir_name)
+        archive_file = join(dir, scan.archive)
+        if not archive.can_extract(archive_file):
+            logging.error('unrar not found; leaving [%s] in place.', dir)
+            return None
+
+        member = archive.main_video(archive_file)
+        if member is None:
+            logging.error('No movie file found in archive [%s]', archive_file)
+            return None
+
+        movie_name = path.basename(member.name)
+        try:
+            base_name = self.movie_base_name(movie_name)
+        except RuntimeError:
+            logging.exception('Could not re-name movie file.')
+            return None
+
+        dest = join(self.moviedir, base_name)
+        if path.exists(dest):
+            if self.transfer_engine.placement != transfer.MOVE:
+                logging.info('[%s] is already extracted to [%s].', dir, dest)
+            else:
+                logging.error('Movie directory [%s] already exists; leaving [%s] in place.', dest, dir)
+            return None
+
+        job = Job(movie_dir_name, partial(self.process_archive, movie_dir_name, archive_file, member, scan),
+                  plan.device(dir), plan.device(self.moviedir), self.moviedir, [movie_dir_name])
+
+        # The movie can only be looked at once it is extracted, so how it is stripped goes by its extension.
+        new_movie = join(dest, base_name + path.splitext(movie_name)[1])
+        job.add(EXTRACT, archive_file, new_movie, member.size)
+        if path.splitext(movie_name)[1].lower() in metadata.MP4_EXTENSIONS | metadata.MKV_EXTENSIONS:
+            job.add(STRIP, new_movie)
+        elif shutil.which('ffmpeg') is None:
+            logging.warning('ffmpeg not found; meta-data will be left in [%s].', new_movie)
+        else:
+            job.add(REMUX, new_movie, bytes=member.size)
+
+        if self.transfer_engine.placement == transfer.MOVE:
+            job.add(DELETE, dir, bytes=scan.total)
+        return job
+
+    def classify(self, names):
+        """Look up all the names in the movie DB at once, returning a dict of name to whether it is a movie."""
+
+        found = tmdb.classify(names, self.tmdb, self.tmdb_cache, workers=self.tmdb_workers,
+                              rate_limit=self.tmdb_rate_limit, timeout=self.tmdb_timeout, index=self.tmdb_index,
+                              fallback=self.tmdb_fallback)
+        self.retry.update(name for name, movie in found.items() if movie is None)
+        return found
+
+    def process_movie(self, movie_dir_name, scan=None):
         """Process a given movie directory.
         
         The following activities are performed:
-        1) Identify the actual movie file. This is the single largest file in the directory.
+        1) Identify the actual movie file. This is the single largest video file anywhere in the directory.
         2) Rename the file and the parent folder to be in the form: <title>.<year>.<extension>
         3) Look for english sub-title files with the srt extension. If found, ensure file is in the same directory as
         the movie file and rename to be in the form: <title>.<year>.en.srt
         4) Remove all other files and sub-directories
-        5) Use ffmpeg to strip all meta-data from the movie file
-        6) Move the directory to the configured Movie directory."""
+        5) Strip all meta-data from the movie file, while
+        6) Moving the directory to the configured Movie directory.
+
+        The directory is walked once to find the movie, the sub-titles and everything else to remove (unless it
+        was already walked while planning)."""
 
         dir = join(self.scandir, movie_dir_name)
 
         if self.moviedir is not None:
-            movie = self.find_largest_file(dir)
+            if scan is None:
+                scan = release.scan_release(dir)
+            if scan.movie is None:
+                logging.error('No movie file found in [%s]', dir)
+                return
+
+            movie = join(dir, scan.movie)
+            if path.dirname(scan.movie):
+                # e.g. the movie is in a Movie/ sub-directory; it goes alongside everything else
+                hoisted = join(dir, path.basename(scan.movie))
+                if path.exists(hoisted):
+                    logging.error('Could not move [%s] up to [%s]; it already exists.', movie, hoisted)
+                    return
+                logging.debug('Moving [%s] up to [%s]', movie, hoisted)
+                rename(movie, hoisted)
+                movie = hoisted
 
             try:
                 base_name, movie, dir = self.rename_movie(movie)
@@ -154,50 +563,231 @@ class CopyMedia:
                 logging.exception('Could not re-name movie file.')
                 return
 
-            subtitle_files = self.process_subtitles(dir, base_name)
+            self.clean_dir(dir, movie, base_name, scan)
 
-            self.clean_dir(dir, movie, subtitle_files)
+            with metrics.stage('strip_and_move_movie') as timer:
+                passes = self.strip_and_move_movie(movie, dir)
+                timer.add(items=1, bytes=sum(report.written for report in passes))
 
-            self.strip_metadata(movie)
+    def place_movie(self, movie_dir_name, scan):
+        """Place a movie in the movie directory, leaving its release as it is, e.g. so that it keeps seeding.
 
-            self.move_movies([dir], self.moviedir, self.scandir)
+        The library folder is built in a temporary directory within the movie directory: the movie is linked or
+        cloned into it, or copied if it can't be, along with the best english sub-titles from the release. A
+        movie whose meta-data is stripped is cloned or copied rather than linked, so the download is never
+        changed, or remuxed by ffmpeg straight into the folder. The folder is then renamed into place."""
+
+        dir = join(self.scandir, movie_dir_name)
+        movie = join(dir, scan.movie)
+        base_name = self.movie_base_name(path.basename(scan.movie))
+        dest = join(self.moviedir, base_name)
+        if path.exists(dest):
+            logging.info('[%s] is already placed in [%s].', dir, dest)
+            return
+
+        # Leftovers of an interrupted run are started again.
+        temp = join(self.moviedir, '.' + base_name + '.partial')
+        if path.exists(temp):
+            shutil.rmtree(temp)
+        makedirs(temp)
+
+        engine = self.transfer_engine
+        new_movie = join(temp, base_name + path.splitext(scan.movie)[1])
+        edits = metadata.find_edits(movie)
+        passes = []
+        with metrics.stage('strip_and_move_movie') as timer:
+            if edits:
+                result = transfer.place(movie, new_movie, engine.method(movie, new_movie, transfer.REFLINK),
+                                        engine.chunk_size, engine.mode)
+                passes.append(PassReport(result.method, movie, result.bytes, result.bytes))
+                passes.append(PassReport('strip in place', movie, 0, metadata.apply_edits(new_movie, edits)))
+            elif edits is None and shutil.which('ffmpeg') is not None and \
+                    metadata.remux(movie, new_movie, self.strip_timeout):
+                passes.append(PassReport('remux', movie, scan.size, path.getsize(new_movie)))
+            else:
+                if edits is None:
+                    logging.error('Could not strip meta-data; placing [%s] as it is.', movie)
+                result = transfer.place(movie, new_movie, engine.method(movie, new_movie), engine.chunk_size,
+                                        engine.mode)
+                passes.append(PassReport(result.method, movie, result.bytes, result.bytes))
+            timer.add(items=1, bytes=sum(report.written for report in passes))
+        self.passes.extend(passes)
+
+        if scan.subtitle is not None:
+            subtitle = join(dir, scan.subtitle)
+            new_subtitle = join(temp, base_name + '.en.srt')
+            transfer.place(subtitle, new_subtitle, engine.method(subtitle, new_subtitle), engine.chunk_size,
+                           engine.mode)
+
+        rename(temp, dest)
+        if self.library is not None:
+            self.library.add(join(dest, path.basename(new_movie)), movie)
+        logging.info('Placed [%s] in [%s], leaving [%s] in place.', movie, dest, dir)
+
+    def process_archive(self, movie_dir_name, archive_file, member, scan):
+        """Process a movie directory whose movie is packed in an archive set.
+
+        The movie is streamed out of the archive straight into a temporary directory within the movie directory,
+        so nothing is unpacked in the scan directory. Its meta-data is stripped there, alongside the best english
+        sub-titles found when the release was scanned, before the temporary directory is renamed into place.
+        Only then is the release removed, unless downloads are left in place (e.g. so that they keep seeding).
+
+        An MP4 or Matroska movie is written once, as it is extracted, and stripped in place. Anything else is
+        written twice: once as it is extracted, and again when ffmpeg remuxes it, since ffmpeg needs to seek
+        in formats such as AVI to read them and so can't be fed the extracted stream as it comes."""
+
+        dir = join(self.scandir, movie_dir_name)
+        movie_name = path.basename(member.name)
+        base_name = self.movie_base_name(movie_name)
+
+        dest = join(self.moviedir, base_name)
+        if path.exists(dest):
+            logging.error('Movie directory [%s] already exists; leaving [%s] in place.', dest, dir)
+            return
+
+        # Leftovers of an interrupted run are started again.
+        temp = join(self.moviedir, '.' + base_name + '.partial')
+        if path.exists(temp):
+            shutil.rmtree(temp)
+        makedirs(temp)
+
+        movie = join(temp, base_name + path.splitext(movie_name)[1])
+        engine = self.transfer_engine or transfer.TransferEngine()
+        with metrics.stage('extract_movie') as timer:
+            written = archive.extract(archive_file, member, movie, engine.chunk_size)
+            timer.add(items=1, bytes=written or 0)
+        if written is None:
+            shutil.rmtree(temp)
+            logging.error('Leaving [%s] in place.', dir)
+            return
+
+        passes = [PassReport('extract', movie, written, written)]
+        self.strip_metadata(movie, self.strip_timeout, passes)
+        for report in passes:
+            logging.info('Pass [%s] over [%s] read [%d] bytes and wrote [%d] bytes.',
+                         report.name, report.file, report.read, report.written)
+        self.passes.extend(passes)
+
+        if scan.subtitle is not None:
+            shutil.copyfile(join(dir, scan.subtitle), join(temp, base_name + '.en.srt'))
+
+        rename(temp, dest)
+        if self.transfer_engine is None or self.transfer_engine.placement == transfer.MOVE:
+            shutil.rmtree(dir)
+        logging.info('Extracted [%s] from [%s] into [%s]', member.name, archive_file, dest)
+
+    def strip_and_move_movie(self, movie, dir):
+        """Strip the meta-data from the movie on its way to the movie directory.
+
+        If the movie directory is on the same filesystem, the meta-data is stripped in place and the directory
+        renamed. Otherwise the directory is copied into a temporary directory within the movie directory and
+        the movie's meta-data is stripped as part of the copy: either the copy is stripped in place or ffmpeg
+        writes straight into the temporary directory. Once complete, the temporary directory is renamed into
+        place and the original removed. Either way, the movie is only read and written once.
+
+        Returns a PassReport for each pass made over the movie."""
+
+        dest = join(self.moviedir, path.basename(dir))
+        if path.exists(dest):
+            logging.error('Movie directory [%s] already exists; leaving [%s] in place.', dest, dir)
+            return []
+
+        size = path.getsize(movie)
+        edits = metadata.find_edits(movie)
+        passes = []
+
+        if transfer.device_of(dir) == transfer.device_of(self.moviedir):
+            if edits is not None:
+                passes.append(PassReport('strip in place', movie, 0, metadata.apply_edits(movie, edits)))
+            else:
+                split_name = path.splitext(movie)
+                stripped_movie = split_name[0] + '.out' + split_name[1]
+                if metadata.remux(movie, stripped_movie, self.strip_timeout):
+                    passes.append(PassReport('remux', movie, size, path.getsize(stripped_movie)))
+                    remove(movie)
+                    rename(stripped_movie, movie)
+
+            # the release has been renamed and cleaned up, so there's nothing left worth keeping in place
+            self.move_movies([dir], self.moviedir, self.scandir, self.transfer_engine, transfer.MOVE)
+            passes.append(PassReport('rename', movie, 0, 0))
+        else:
+            engine = self.transfer_engine or transfer.TransferEngine()
+            copy_file = transfer.safe_copy_file if engine.mode == transfer.SAFE else transfer.copy_file
+
+            def copy(src, dst):
+                if path.abspath(src) != path.abspath(movie):
+                    copy_file(src, dst, engine.chunk_size)
+                elif edits is not None:
+                    passes.append(PassReport('copy', movie, size, copy_file(src, dst, engine.chunk_size)))
+                    passes.append(PassReport('strip in place', movie, 0, metadata.apply_edits(dst, edits)))
+                elif metadata.remux(src, dst, self.strip_timeout):
+                    passes.append(PassReport('remux', movie, size, path.getsize(dst)))
+                else:
+                    logging.error('Could not strip meta-data; moving [%s] as it is.', movie)
+                    passes.append(PassReport('copy', movie, size, copy_file(src, dst, engine.chunk_size)))
+                return dst
+
+            # Leftovers of an interrupted run are started again, unless copying safely, in which case the
+            # journaled copies in them are resumed.
+            temp = join(self.moviedir, '.' + path.basename(dir) + '.partial')
+            if path.exists(temp) and engine.mode != transfer.SAFE:
+                shutil.rmtree(temp)
+
+            logging.debug('Copying [%s] to [%s] while stripping meta-data...', dir, temp)
+            shutil.copytree(dir, temp, copy_function=copy, dirs_exist_ok=engine.mode == transfer.SAFE)
+            rename(temp, dest)
+            shutil.rmtree(dir)
+            logging.info('Successfully moved [%s] to [%s]', dir, dest)
+
+        for report in passes:
+            logging.info('Pass [%s] over [%s] read [%d] bytes and wrote [%d] bytes.',
+                         report.name, report.file, report.read, report.written)
+        self.passes.extend(passes)
+        return passes
 
     @staticmethod
     def find_largest_file(dir):
-        """Identify the actual movie file. This is the single largest file in the directory."""
+        """Identify the actual movie file. This is the single largest video file anywhere in the directory.
+
+        Returns None if there are no files in the directory."""
 
         logging.debug('Looking for largest file in directory: [%s]', dir)
-        full_names = [path.join(dir, fname) for fname in listdir(dir)]
-        logging.debug('Found file list: [%s]', full_names)
-        largest = sorted((path.getsize(s), s) for s in full_names)[-1][1]
+        movie = release.scan_release(dir).movie
+        largest = None if movie is None else join(dir, movie)
 
         logging.debug('Largest file: [%s]', largest)
         return largest
 
     @staticmethod
-    def rename_movie(movie):
-        """Rename the movie file and the parent directory to be in the form: <title>.<year>.<extension>"""
-
-        movie_name = path.basename(movie)
-        dir = path.dirname(movie)
+    def movie_base_name(movie_name):
+        """Work out the name of a movie in the form: <title>.<year>, raising RuntimeError if either is unknown."""
 
         logging.debug('Parsing movie name into meta-data: [%s]', movie_name)
 
-        split_name = path.splitext(movie_name)
-
-        meta = tmdb.clean_name(split_name[0])
+        meta = tmdb.clean_name(path.splitext(movie_name)[0])
         logging.debug('Parsed meta-data: [%s]', meta)
-        ext = split_name[1]
         title = meta['title']
-        year = str(meta['year'])
+        year = meta.get('year')
 
         if title and year:
-            new_base_name = title + '.' + year
-            new_base_name = new_base_name.replace(" ", "_")
-            logging.debug('Base name: [%s]', new_base_name)
+            base_name = title + '.' + str(year)
+            base_name = base_name.replace(" ", "_")
+            logging.debug('Base name: [%s]', base_name)
         else:
             raise RuntimeError('One of movie title or year was not found.')
 
+        return base_name
+
+    @staticmethod
+    def rename_movie(movie):
+        """Rename the movie file and the parent directory to be in the form: <title>.<year>.<extension>"""
+
+        movie_name = path.basename(movie)
+        dir = path.dirname(movie)
+
+        ext = path.splitext(movie_name)[1]
+        new_base_name = CopyMedia.movie_base_name(movie_name)
+
         parent = path.dirname(dir)
         new_dir_name = join(parent, new_base_name)
         logging.debug('Renaming directory [%s] to [%s]', dir, new_dir_name)
@@ -211,81 +801,218 @@ class CopyMedia:
         return new_base_name, new_movie_name, new_dir_name
 
     @staticmethod
-    def process_subtitles(dir, base_name):
-        """Look for usable english sub-title files.
+    def clean_dir(dir, movie, base_name, scan=None):
+        """Look for usable english sub-title files and remove all other files and sub-directories.
 
         If english subtitles found with the srt extension, ensure file is in the same directory as
-        the movie file and rename to be in the form: <title>.<year>.en.srt"""
+        the movie file and rename to be in the form: <title>.<year>.en.srt. Both go by the scan of the
+        directory, which is only walked here if it wasn't scanned already. Returns the path to the sub-titles,
+        if any."""
 
-        # TODO
-        logging.warning('process_subtitles not implemented yet.')
-        return []
+        if scan is None:
+            scan = release.scan_release(dir)
+        subtitle, removed = release.tidy_release(dir, scan, path.basename(movie), base_name + '.en.srt')
+        logging.info('Removed [%d] files and directories from [%s]', removed, dir)
+        return subtitle
 
     @staticmethod
-    def clean_dir(dir, movie, subtitle_files):
-        """Remove all other files and sub-directories except the movie file and any sub-titles."""
-
-        # TODO
-        logging.warning('clean_dir not implemented yet.')
+    def strip_metadata(movie, timeout=metadata.TIMEOUT, passes=None):
+        """Strip all meta-data from the movie file.
 
-    @staticmethod
-    def strip_metadata(movie):
-        """Use ffmpeg to strip all meta-data from the movie file"""
+        MP4 and Matroska files have their meta-data blanked out in place. Anything else is remuxed by ffmpeg
+        without its meta-data, replacing the original only if ffmpeg succeeds within the timeout (in seconds).
+        Returns True if the meta-data was stripped, adding a PassReport for the pass made to passes, if given."""
 
         logging.debug('Stripping meta-data from movie: [%s]', movie)
-        split_name = path.splitext(movie)
-        stripped_movie = split_name[0] + '.out' + split_name[1]
-        subprocess.run(['ffmpeg', '-i', movie, '-map_metadata', '-1', '-c:v', 'copy', '-c:a', 'copy', stripped_movie])
 
-        # Remove original and rename the new one to replace the old one.
-        remove(movie)
-        rename(stripped_movie, movie)
+        with metrics.stage('strip_metadata') as timer:
+            timer.add(items=1)
+            written = metadata.strip_in_place(movie)
+            if written is not None:
+                timer.add(bytes=written)
+                if passes is not None:
+                    passes.append(PassReport('strip in place', movie, 0, written))
+                logging.debug('Stripping meta-data complete; [%d] bytes written in place.', written)
+                return True
+
+            split_name = path.splitext(movie)
+            stripped_movie = split_name[0] + '.out' + split_name[1]
+            if not metadata.remux(movie, stripped_movie, timeout):
+                logging.error('Keeping original movie [%s]', movie)
+                return False
+            timer.add(bytes=path.getsize(stripped_movie))
+            if passes is not None:
+                passes.append(PassReport('remux', movie, path.getsize(movie), path.getsize(stripped_movie)))
+
+            # Remove original and rename the new one to replace the old one.
+            remove(movie)
+            rename(stripped_movie, movie)
 
         logging.debug('Stripping meta-data complete.')
+        return True
 
-    def process_files(self, files):
-        """Process all individual files provided.
+    def process_files(self, files, plan):
+        """Plan the processing of all individual files provided.
 
         Files are generally assumed to be tv show episodes although if no matching TV shows are found then
-        a check will be performed to determine if the file is a stand-alone movie."""
+        a check will be performed to determine if the file is a stand-alone movie. Each check is a stage of
+        a pipeline, and a stage only ever sees the files that the stages before it didn't claim."""
+
+        stages = [Stage('series', partial(self.series_stage, plan))]
+        if self.moviedir is not None:
+            # If there are files that didn't match a configured series and the destination directory
+            # for movies has been specified, then check if the remaining files are movies, and if so move
+            # to the designated movie directory.
+            stages.append(Stage('movie files', partial(self.movie_files_stage, plan)))
+
+        unclaimed, reports = run_pipeline(stages, files)
+        self.reports.extend(reports)
+        logging.debug('Files left unprocessed: [%s]', unclaimed)
+
+    def series_stage(self, plan, files):
+        """Claim the files matching a configured series and plan moving them to their destination directories."""
 
         # Find matching files
-        matches, nonmatches = self.match_files(files, self.series)
+        matches, nonmatches = self.match_files(files, self.matcher)
 
         if matches and self.seriesdir is not None:
             # Move matching series files to their respective destination directories
             logging.debug('Found series matches to move: [%s]', matches)
-            self.move_series(matches, self.seriesdir, self.scandir)
+            # One job for each series, so that a series can be held back without holding back the rest
+            shows = {}
+            for file_name, config_entry in matches:
+                dest, dest_file_name = self.series_destination(file_name, config_entry, self.seriesdir,
+                                                               self.matcher)
+                shows.setdefault(dest, []).append((file_name, config_entry, dest_file_name))
+
+            for dest, show_matches in shows.items():
+                to_move = []
+                duplicates = []
+                job = Job(path.basename(dest), partial(self.run_series, to_move, duplicates, self.scandir),
+                          plan.device(self.scandir), plan.device(dest), dest, [match[0] for match in show_matches])
+                action = self.placement_action(job, join(self.scandir, show_matches[0][0]), dest)
+                for file_name, config_entry, dest_file_name in show_matches:
+                    source = join(self.scandir, file_name)
+                    duplicate = self.find_duplicate(source)
+                    if duplicate is not None:
+                        duplicates.append(file_name)
+                        job.add(DUPLICATE, source, duplicate, path.getsize(source))
+                    else:
+                        to_move.append((file_name, config_entry))
+                        job.add(action, source, join(dest, dest_file_name), path.getsize(source))
+                plan.add(job)
+
+        return [file for file, show in matches], nonmatches
+
+    def run_series(self, matches, duplicates, start_dir):
+        """Move the matching series files, remembering them to send a notification for, and deal with the ones
+        already in the library."""
+
+        self.remove_duplicates(duplicates, start_dir, self.transfer_engine)
+        if matches:
+            results = self.move_series(matches, self.seriesdir, start_dir, self.transfer_engine, self.matcher,
+                                       self.library, self.retry)
+            # only the files actually moved are notified about; the rest are tried again on the next run
+            self.series_moved.extend(match for match, result in zip(matches, results) if result.error is None)
+
+    def find_duplicate(self, source):
+        """Find a file in the library identical to the source, returning its path or None."""
+
+        if self.library is None:
+            return None
+
+        duplicate = self.library.find(source)
+        if duplicate is not None:
+            logging.info('[%s] is already in the library as [%s]', source, duplicate)
+        return duplicate
 
-            if self.ifttt_url is not None:
-                ifttt.send_notification(matches, self.ifttt_url)
+    @staticmethod
+    def remove_duplicates(names, start_dir, engine=None):
+        """Remove files found to be in the library already, unless the engine places files by leaving them
+        where they are."""
 
-        if nonmatches and self.moviedir is not None:
-            # If there are files that didn't match a configured series and the destination directory
-            # for movies has been specified, then check if the remaining files are movies, and if so move
-            # to the designated movie directory.
-            logging.debug('Some files did not have matches. Checking if they are movies...')
-            movie_files = [file for file in files if tmdb.is_movie(file, self.tmdb)]
-            logging.debug('Found movies: [%s]', movie_files)
-            self.move_movies(movie_files, self.moviedir, self.scandir)
+        if engine is not None and engine.placement != transfer.MOVE:
+            return
+
+        for name in names:
+            logging.info('Removing [%s], which is already in the library.', name)
+            remove(join(start_dir, name))
+
+    def placement_action(self, job, source, dest_dir):
+        """The step a job takes to place the source in the destination directory, as the transfer engine will.
+        A dry run doesn't probe whether files can be cloned, so it may show a COPY where a clone will be made."""
+
+        if self.transfer_engine.placement == transfer.MOVE:
+            return MOVE if job.source_device == job.destination_device else COPY
+        destination = join(dest_dir, path.basename(source))
+        return PLACED_BY[self.transfer_engine.method(source, destination, probe=not self.dry_run)]
+
+    def movie_files_stage(self, plan, files):
+        """Claim the files that are movies and plan moving them to the movie directory."""
+
+        logging.debug('Some files did not have matches. Checking if they are movies...')
+        found = self.classify(files)
+        movie_files = [file for file in files if found[file]]
+        logging.debug('Found movies: [%s]', movie_files)
+
+        for movie in movie_files:
+            source = join(self.scandir, movie)
+            duplicate = self.find_duplicate(source)
+            if duplicate is not None:
+                job = Job(movie, partial(self.remove_duplicates, [movie], self.scandir, self.transfer_engine),
+                          plan.device(self.scandir), plan.device(self.moviedir), self.moviedir, [movie])
+                job.add(DUPLICATE, source, duplicate, path.getsize(source))
+            else:
+                job = Job(movie, partial(self.move_movies, [movie], self.moviedir, self.scandir,
+                                         self.transfer_engine, library=self.library, retry=self.retry),
+                          plan.device(self.scandir), plan.device(self.moviedir), self.moviedir, [movie])
+                job.add(self.placement_action(job, source, self.moviedir), source, join(self.moviedir, movie),
+                        path.getsize(source))
+            plan.add(job)
+
+        return movie_files, [file for file in files if not found[file]]
 
     def process_config_file(self, config_file):
-        """Open configuration file, parse json, and pass to processing method."""
+        """Open configuration file, parse json, and pass to processing method.
+
+        The parsed configuration and validated series are loaded from its compiled form when it is up to date."""
 
         logging.debug('Using configuration file: [%s]', config_file)
 
-        # parse config file as json and process settings found inside
-        with open(config_file) as configfile:
-            config = json.load(configfile)
-            return self.process_configs(config)
+        compiled = configcache.load(config_file, self.compile_config)
+        return self.process_configs(compiled.config, compiled)
 
-    def process_configs(self, config):
+    @staticmethod
+    def compile_config(config):
+        """Work out everything that depends on the configuration alone, validating the series on the way."""
+
+        matcher = None
+        if 'series' in config:
+            CopyMedia.validate_series(config['series'])
+            matcher = SeriesMatcher(config['series'])
+        return configcache.CompiledConfig(config, configcache.config_key(config), matcher)
+
+    def process_configs(self, config, compiled=None):
         """Used to process the configuration from the configuration file
            and set global settings that will dictate how the rest of the
            execution will proceed. Primarily, this will control whether a
            single file is processed or if an entire directory is scanned for
            new media. It also determines the destination root level directory
-           and executes a validation step against all the configured series."""
+           and executes a validation step against all the configured series,
+           unless the configuration has already been compiled."""
+
+        if compiled is None:
+            compiled = self.compile_config(config)
+
+        # Only use value from configs if command line argument is not
+        # provided.
+        level = self.log_level or config.get('logLevel')
+        if level is not None:
+            try:
+                logger.set_level(level)
+            except ValueError:
+                logging.error('Unknown log level [%s].', level)
+                raise ConfigurationError('Invalid log level')
 
         # if an individual file is specified either by
         # deluge or via the command line, then just use that.
@@ -342,9 +1069,118 @@ class CopyMedia:
         else:
             logging.debug('TMDB API key not provided.')
 
-        if 'series' in config:
-            self.series = config['series']
-            self.validate_series(self.series)
+        # Use values from configs if they are provided, otherwise use the defaults.
+        self.tmdb_workers = CopyMedia.positive_int(config, 'tmdbWorkers', tmdb.WORKERS)
+        self.tmdb_rate_limit = CopyMedia.positive_number(config, 'tmdbRateLimit', tmdb.RATE_LIMIT)
+        self.tmdb_timeout = CopyMedia.positive_number(config, 'tmdbTimeout', tmdb.TIMEOUT)
+        logging.debug('TMDB queries: [%s] workers, [%s] requests per second, [%s] second timeout',
+                      self.tmdb_workers, self.tmdb_rate_limit, self.tmdb_timeout)
+
+        # Movies can be recognised offline from an index built by titleindex.py, only falling back to the movie
+        # DB for titles that aren't in it if configured to.
+        index_config = config.get('tmdbIndex', {})
+        if index_config.get('enabled', True) and index_config.get('file'):
+            try:
+                self.tmdb_index = titleindex.TitleIndex(index_config['file'])
+            except (OSError, ValueError):
+                logging.error('Could not open title index [%s]; build it with titleindex.py.', index_config['file'])
+                raise ConfigurationError('Invalid title index')
+            self.tmdb_fallback = index_config.get('apiFallback', False)
+            logging.debug('Title index: [%s], falling back to the movie DB: [%s]', index_config['file'],
+                          self.tmdb_fallback)
+        else:
+            self.tmdb_index = None
+            self.tmdb_fallback = False
+
+        self.transfer_engine = transfer.TransferEngine(
+            workers=CopyMedia.positive_int(config, 'transferWorkers', transfer.WORKERS),
+            per_device=CopyMedia.positive_int(config, 'transfersPerDevice', transfer.PER_DEVICE),
+            chunk_size=CopyMedia.positive_int(config, 'transferChunkSize', transfer.CHUNK_SIZE),
+            mode=config.get('transferMode', transfer.FAST), placement=config.get('transferPlacement', transfer.MOVE))
+        if self.transfer_engine.mode not in transfer.MODES:
+            logging.error('Transfer mode must be one of [%s].', transfer.MODES)
+            raise ConfigurationError('Invalid transfer mode')
+        if self.transfer_engine.placement not in transfer.PLACEMENTS:
+            logging.error('Transfer placement must be one of [%s].', transfer.PLACEMENTS)
+            raise ConfigurationError('Invalid transfer placement')
+        logging.debug('Transfers: [%s] workers, [%s] per device, [%s] byte chunks, [%s] mode, [%s] placement',
+                      self.transfer_engine.workers, self.transfer_engine.per_device, self.transfer_engine.chunk_size,
+                      self.transfer_engine.mode, self.transfer_engine.placement)
+
+        self.reserved_space = config.get('reservedSpace', RESERVED_SPACE)
+        if not isinstance(self.reserved_space, int) or self.reserved_space < 0:
+            logging.error('Reserved space must be a whole number of bytes.')
+            raise ConfigurationError('Invalid reserved space')
+
+        self.strip_workers = CopyMedia.positive_int(config, 'stripWorkers', metadata.WORKERS)
+        self.strips_per_device = CopyMedia.positive_int(config, 'stripsPerDevice', metadata.PER_DEVICE)
+        self.strip_timeout = CopyMedia.positive_number(config, 'stripTimeout', metadata.TIMEOUT)
+        logging.debug('Remuxes: [%s] workers, [%s] per device, [%s] second timeout',
+                      self.strip_workers, self.strips_per_device, self.strip_timeout)
+
+        self.extract_workers = CopyMedia.positive_int(config, 'extractWorkers', archive.WORKERS)
+        self.extracts_per_device = CopyMedia.positive_int(config, 'extractsPerDevice', archive.PER_DEVICE)
+        logging.debug('Extractions: [%s] workers, [%s] per device', self.extract_workers, self.extracts_per_device)
+
+        # Entries left in the scan directory are remembered next to the configuration file unless configured
+        # otherwise. Any change to the configuration means they all need another look.
+        state_config = config.get('scanState', {})
+        if state_config.get('enabled', True):
+            state_file = state_config.get('file', join(path.dirname(self.config_file or CONFIG_FILE),
+                                                       scanstate.STATE_FILE))
+            self.scan_state = scanstate.ScanState(state_file, ttl=state_config.get('ttl', scanstate.TTL),
+                                                  key=compiled.key)
+            logging.debug('Scan state: [%s]', state_file)
+        else:
+            logging.debug('Scan state disabled.')
+
+        # Answers from the movie DB are cached next to the configuration file unless configured otherwise.
+        cache_config = config.get('tmdbCache', {})
+        if cache_config.get('enabled', True):
+            cache_file = cache_config.get('file', join(path.dirname(self.config_file or CONFIG_FILE),
+                                                      cache.CACHE_FILE))
+            self.tmdb_cache = cache.LookupCache(cache_file,
+                                                positive_ttl=cache_config.get('positiveTtl', cache.POSITIVE_TTL),
+                                                negative_ttl=cache_config.get('negativeTtl', cache.NEGATIVE_TTL),
+                                                max_entries=cache_config.get('maxEntries', cache.MAX_ENTRIES))
+            logging.debug('TMDB lookup cache: [%s]', cache_file)
+
+            # Parsed release names are kept in the same database.
+            names.set_cache(cache.NameCache(cache_file, max_entries=cache_config.get('maxEntries', cache.MAX_ENTRIES)))
+        else:
+            logging.debug('TMDB lookup cache disabled.')
+            names.set_cache(None)
+
+        # Stage timings are only recorded if a metrics section is configured.
+        metrics_config = config.get('metrics')
+        if metrics_config is not None and metrics_config.get('enabled', True):
+            self.metrics = metrics.Metrics(summary_file=metrics_config.get('summaryFile'),
+                                           textfile=metrics_config.get('textfile'))
+            logging.debug('Metrics enabled; summary file [%s], Prometheus textfile [%s]',
+                          self.metrics.summary_file, self.metrics.textfile)
+        metrics.set_metrics(self.metrics)
+
+        # The library directories are indexed, and the index kept next to the configuration file unless configured
+        # otherwise. A file of null keeps it in memory only.
+        library_config = config.get('libraryIndex', {})
+        if library_config.get('enabled', True):
+            index_file = library_config.get('file', join(path.dirname(self.config_file or CONFIG_FILE),
+                                                         library.INDEX_FILE))
+            self.library = library.LibraryIndex([self.seriesdir, self.moviedir], index_file)
+            logging.debug('Library index: [%s]', index_file)
+        else:
+            logging.debug('Library index disabled.')
+
+        # Notifications wait in a spool next to the configuration file unless configured otherwise.
+        notify_config = config.get('notifications', {})
+        self.notifications = ifttt.NotificationQueue(
+            notify_config.get('spool', join(path.dirname(self.config_file or CONFIG_FILE), ifttt.SPOOL_FILE)),
+            window=notify_config.get('window', ifttt.WINDOW), timeout=notify_config.get('timeout', ifttt.TIMEOUT),
+            attempts=notify_config.get('attempts', ifttt.ATTEMPTS))
+
+        if compiled.matcher is not None:
+            self.matcher = compiled.matcher
+            self.series = self.matcher.series
         else:
             logging.warning('No series configured.')
 
@@ -356,98 +1192,170 @@ class CopyMedia:
            A series must have at least a name and a regex pattern to
            match file names against."""
 
+        trace = logging.getLogger().isEnabledFor(logger.TRACE)
         for show in series:
-            logging.log(logger.TRACE, 'Validate show [%s]', show)
+            if trace:
+                logging.log(logger.TRACE, 'Validate show [%s]', show)
             if 'name' not in show:
                 logging.error('[%s] has no name defined.',
                               str(show))
                 raise KeyError('name')
-            else:
+            elif trace:
                 logging.log(logger.TRACE, 'Found name [%s] for show [%s]', show['name'], show)
             if 'regex' not in show:
                 logging.error('[%s] has no regex pattern defined.',
                               show['name'])
                 raise KeyError('regex')
-            else:
+            elif trace:
                 logging.log(logger.TRACE, 'Found regex [%s] for show name [%s]', show['regex'], show['name'])
         return True
 
     @staticmethod
-    def move_movies(movie_files, move_dir, start_dir):
-        """Move movie files to the specified destination directory"""
+    def positive_int(config, key, default):
+        """The setting from the configuration, or the default if it isn't given. Numbers of workers and the like
+           must be whole numbers of at least one: with none, the work waiting for them would never be done."""
 
-        logging.debug('Moving movie files: [%s]', movie_files)
-        for movie in movie_files:
+        value = config.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            logging.error('[%s] must be a whole number of at least one, not [%s].', key, value)
+            raise ConfigurationError('Invalid %s' % key)
+        return value
 
-            # Move file to destination folder, renaming on the way
-            start_path = movie
-            dest_path = join(move_dir, path.basename(movie))
-            logging.debug('Moving [%s] to [%s]...', start_path, dest_path)
-            shutil.move(start_path, dest_path)
-            logging.info('Successfully moved [%s] to [%s]', start_path, dest_path)
+    @staticmethod
+    def positive_number(config, key, default):
+        """The setting from the configuration, or the default if it isn't given. Rates and timeouts may be
+           fractions, but must be more than zero: a rate of zero can't be spaced out, and a timeout of zero
+           gives up straight away."""
+
+        value = config.get(key, default)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+            logging.error('[%s] must be a number greater than zero, not [%s].', key, value)
+            raise ConfigurationError('Invalid %s' % key)
+        return value
 
     @staticmethod
-    def move_series(matches, move_dir, start_dir):
-        """Move matching series files to their respective destination directory"""
+    def move_movies(movie_files, move_dir, start_dir, engine=None, placement=None, library=None, retry=None):
+        """Move movie files to the specified destination directory, or place them there with the given placement
+        (by default, the engine's). Files moved are recorded in the library index, if there is one, and the
+        names of any that couldn't be moved are added to retry."""
 
-        destinations = set()
+        if engine is None:
+            engine = transfer.TransferEngine()
 
-        for file_name, config_entry in matches:
+        logging.debug('Moving movie files: [%s]', movie_files)
+
+        # Move file to destination folder, renaming on the way
+        with metrics.stage('move_movies') as timer:
+            results = engine.run(((join(start_dir, movie), join(move_dir, path.basename(movie)))
+                                  for movie in movie_files), placement)
+            timer.add(items=len(results), bytes=sum(result.bytes for result in results))
+
+        for movie, result in zip(movie_files, results):
+            if result.error is not None:
+                if retry is not None:
+                    retry.add(movie)
+            elif library is not None and path.isfile(result.destination):
+                library.add(result.destination, result.source)
+        return results
+
+    @staticmethod
+    def series_destination(file_name, config_entry, move_dir, matcher=None):
+        """Work out the directory a matching series file is moved to, and its name there.
+
+        The replace template is applied by the SeriesMatcher the series was matched with, if there is one."""
 
-            # Determine destination file_name if a replace attribute
-            # was specified
-            dest_file_name = file_name
-            if 'replace' in config_entry:
+        # Determine destination file_name if a replace attribute
+        # was specified
+        dest_file_name = file_name
+        if 'replace' in config_entry:
+            if matcher is not None:
+                dest_file_name = matcher.rename(file_name, config_entry)
+            else:
                 dest_file_name = re.sub(config_entry['regex'],
                                         config_entry['replace'],
                                         file_name)
-                logging.debug('New name for [%s] will be [%s]',
-                              file_name, dest_file_name)
+            logging.debug('New name for [%s] will be [%s]',
+                          file_name, dest_file_name)
 
-            # Build destination directory path
-            if 'destination' in config_entry:
-                dest = join(move_dir, config_entry['destination'])
-            else:
-                dest = join(move_dir, config_entry['name'])
+        # Build destination directory path
+        if 'destination' in config_entry:
+            dest = join(move_dir, config_entry['destination'])
+        else:
+            dest = join(move_dir, config_entry['name'])
 
+        return dest, dest_file_name
+
+    @staticmethod
+    def move_series(matches, move_dir, start_dir, engine=None, matcher=None, library=None, retry=None):
+        """Move matching series files to their respective destination directory
+
+        If there is a library index, it is asked whether the destination directories exist, and told about the
+        files moved. The names of any files that couldn't be moved are added to retry. Returns the result of each
+        move, in the order of the matches."""
+
+        if engine is None:
+            engine = transfer.TransferEngine()
+
+        destinations = set()
+        jobs = []
+
+        for file_name, config_entry in matches:
+
+            dest, dest_file_name = CopyMedia.series_destination(file_name, config_entry, move_dir, matcher)
             logging.debug('Destination directory: [%s]', dest)
 
             # Create destination directory if it doesn't already exist
-            if not path.exists(dest):
-                logging.info('Destination does not exist; creating [%s]', dest)
-                makedirs(dest)
+            if dest not in destinations:
+                if library is not None:
+                    library.makedirs(dest)
+                elif not path.exists(dest):
+                    logging.info('Destination does not exist; creating [%s]', dest)
+                    makedirs(dest)
 
             # Move file to destination folder, renaming on the way
-            logging.debug('Moving [%s] to [%s]...',
-                          join(start_dir, file_name), join(dest, dest_file_name))
-            shutil.move(join(start_dir, file_name), join(dest, dest_file_name))
-            logging.info('Successfully moved [%s] to [%s]',
-                         join(start_dir, file_name), join(dest, dest_file_name))
+            jobs.append((join(start_dir, file_name), join(dest, dest_file_name)))
 
             destinations.add(dest)
 
-        return destinations
+        with metrics.stage('move_series') as timer:
+            results = engine.run(jobs)
+            timer.add(items=len(results), bytes=sum(result.bytes for result in results))
+
+        for (file_name, config_entry), result in zip(matches, results):
+            if result.error is not None:
+                if retry is not None:
+                    retry.add(file_name)
+            elif library is not None:
+                library.add(result.destination, result.source)
+
+        return results
 
     @staticmethod
     def match_files(files, series):
-        """Find matching files given a list of files and a list of series."""
+        """Find matching files given a list of files and a list of series.
+
+        The series may either be the configured list of series or a SeriesMatcher already compiled from it."""
+
+        if not isinstance(series, SeriesMatcher):
+            series = SeriesMatcher(series)
 
         matches = []
         nonmatches = []
-        for f in files:
-            matched = False
-            for show in series:
-                logging.log(logger.TRACE, 'Checking [%s] against [%s] using pattern [%s]',
-                            f, show['name'], show['regex'])
-                if re.match(show['regex'], f):
+        info = logging.getLogger().isEnabledFor(logging.INFO)
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        with metrics.stage('match_files') as timer:
+            for f in files:
+                show = series.match(f)
+                if show is not None:
                     matches.append((f, show))
-                    matched = True
-                    logging.info('File [%s] matches series [%s]',
-                                 f, show['name'])
-                    break
-            if not matched:
-                logging.debug('Adding [%s] to list of non-matches', f)
-                nonmatches.append(f)
+                    if info:
+                        logging.info('File [%s] matches series [%s]',
+                                     f, show['name'])
+                else:
+                    if debug:
+                        logging.debug('Adding [%s] to list of non-matches', f)
+                    nonmatches.append(f)
+            timer.add(items=len(files))
 
         return matches, nonmatches
 
@@ -482,8 +1390,13 @@ def main():
     try:
         c = CopyMedia(logfile=args.log, config_file=args.config, ifttt_url=trigger_url,
                       scandir=args.scan, seriesdir=args.dest, file=file, tmdb=args.tmdb,
-                      moviedir=args.moviedest)
-        c.execute()
+                      moviedir=args.moviedest, log_level=args.log_level, dry_run=args.dry_run)
+        if args.watch:
+            c.watch()
+        else:
+            c.execute()
+            # One run per download mustn't linger for the notification window; a later run sends the rest.
+            c.notifications.finish()
     except Exception:
         logging.exception('Error on execution.')
         raise
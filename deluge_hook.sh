@@ -0,0 +1,12 @@
+#!/bin/sh
+# Hook for deluge's Execute plugin "Torrent Complete" event. Hands the finished torrent's path to a
+# running `copy_files.py --watch` through its FIFO, and only starts the script itself if nothing is
+# listening on the FIFO.
+
+FIFO=${COPY_MEDIA_FIFO:-./copy-media.fifo}
+
+if [ -p "$FIFO" ] && timeout 2 sh -c 'printf "%s\n" "$1" > "$2"' sh "$3/$2" "$FIFO"; then
+    exit 0
+fi
+
+exec python3 "$(dirname "$0")/copy_files.py" "$@"
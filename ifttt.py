@@ -1,24 +1,176 @@
-import requests
+import json
 import logging
+import threading
+import time
+
+import requests
+
+from atomic import locked, write_atomically
 
 IFTTT_URL_BASE = 'https://maker.ifttt.com/trigger'
 
+SPOOL_FILE = 'ifttt-spool.json'
+
+# Seconds to wait for more series to mention before sending a notification, seconds to wait for IFTTT to answer,
+# and attempts at sending (backing off between them) before leaving a notification for the next run.
+WINDOW = 60
+TIMEOUT = 10
+ATTEMPTS = 3
+BACKOFF = 2
 
-def send_notification(matches, trigger_url):
+
+def series_names(matches):
+    """Names of the series of the matching files, each only once."""
+
+    return list(dict.fromkeys(config['name'] for file, config in matches))
+
+
+def send_notification(matches, trigger_url, timeout=TIMEOUT):
     """Send IFTTT notification to phone whenever the script fires with the names
         of the new episodes"""
 
     # Only send notification if there is at least one matching file.
     if matches and trigger_url:
-        # Get series name for each matching file and concatenate
-        # into a string separated by ' and '
-        names = [config['name'] for file, config in matches]
-        name_string = ' and '.join(names)
-
-        logging.debug('Sending notification with name string: [%s] to IFTTT',
-                      name_string)
-
-        r = requests.post(trigger_url, data={'value1': name_string})
-        logging.debug('IFTTT POST status: [%s] with reason: [%s]',
-                      r.status_code, r.reason)
-        return r
+        return post(series_names(matches), trigger_url, timeout)
+
+
+def post(names, trigger_url, timeout=TIMEOUT):
+    # Concatenate the series names into a string separated by ' and '
+    name_string = ' and '.join(names)
+
+    logging.debug('Sending notification with name string: [%s] to IFTTT',
+                  name_string)
+
+    r = requests.post(trigger_url, data={'value1': name_string}, timeout=timeout)
+    logging.debug('IFTTT POST status: [%s] with reason: [%s]',
+                  r.status_code, r.reason)
+    return r
+
+
+class NotificationQueue:
+    """Notifications waiting to be sent, kept in a spool file shared by every run.
+
+    The series names for each trigger URL are merged into one message, each only once, which a background
+    thread sends once the first of them has waited window seconds. As the spool is on disk, runs in parallel
+    or one after the other add to the same message, and a message that couldn't be sent is kept for the
+    next run. A run that ends before the window is up calls finish, leaving its message to a later run
+    rather than waiting for it."""
+
+    def __init__(self, spool_file=SPOOL_FILE, window=WINDOW, timeout=TIMEOUT, attempts=ATTEMPTS, backoff=BACKOFF):
+        self.spool_file = spool_file
+        self.window = window
+        self.timeout = timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.sender = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.spool_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning('Could not read notification spool [%s]; ignoring it.', self.spool_file)
+            return {}
+
+    def write(self, spool):
+        # Replaced in one step, so the spool can be read at any time without the lock. Callers already hold it.
+        write_atomically(self.spool_file, json.dumps(spool))
+
+    def add(self, matches, trigger_url):
+        """Queue a notification of the series of the matching files, and make sure it will be sent."""
+
+        names = series_names(matches)
+        if names:
+            with locked(self.spool_file + '.lock'):
+                spool = self.read()
+                pending = spool.setdefault(trigger_url, {'names': [], 'since': time.time()})
+                pending['names'] = list(dict.fromkeys(pending['names'] + names))
+                self.write(spool)
+            logging.debug('Queued notification of [%s]', names)
+
+        self.start()
+
+    def start(self):
+        """Start the background sender, unless it is already running."""
+
+        with self.lock:
+            if self.sender is None or not self.sender.is_alive():
+                self.stopping.clear()
+                self.sender = threading.Thread(target=self.run, name='notifications', daemon=True)
+                self.sender.start()
+
+    def close(self):
+        """Stop the background sender, leaving anything it hasn't sent yet in the spool."""
+
+        self.stopping.set()
+        if self.sender is not None:
+            self.sender.join()
+
+    def finish(self):
+        """Send whatever is already due and stop the background sender, without waiting for the rest. Anything
+        not sent is left in the spool for the next run, or a watching one, to send."""
+
+        self.close()
+        if self.read():
+            self.flush()
+
+    def run(self):
+        """Send each notification once it is due, for as long as there are any this process can send."""
+
+        while True:
+            spool = self.read()
+            if not spool:
+                return
+
+            delay = min(pending['since'] for pending in spool.values()) + self.window - time.time()
+            if delay > 0:
+                if self.stopping.wait(delay):
+                    return
+            elif not self.flush():
+                return
+
+    def flush(self, force=False):
+        """Send every notification that is due, or all of them if forced.
+
+        Only one process sends at a time. Returns False if another one is sending, or if any notification
+        couldn't be sent, in which case it is kept in the spool."""
+
+        with locked(self.spool_file + '.send.lock', blocking=False) as sending:
+            if not sending:
+                logging.debug('Notifications are being sent by another run.')
+                return False
+
+            now = time.time()
+            due = {url: pending['names'] for url, pending in self.read().items()
+                   if force or now - pending['since'] >= self.window}
+            sent = [url for url, names in due.items() if self.send(names, url)]
+
+            # Series added while sending are left for the next notification.
+            with locked(self.spool_file + '.lock'):
+                spool = self.read()
+                for url in sent:
+                    left = [name for name in spool[url]['names'] if name not in due[url]]
+                    if left:
+                        spool[url] = {'names': left, 'since': now}
+                    else:
+                        del spool[url]
+                self.write(spool)
+
+        return len(sent) == len(due)
+
+    def send(self, names, trigger_url):
+        for attempt in range(self.attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                if post(names, trigger_url, self.timeout).ok:
+                    return True
+            except requests.exceptions.RequestException:
+                logging.warning('IFTTT notification failed on attempt [%d].', attempt + 1, exc_info=True)
+
+        logging.error('Could not send notification of [%s]; keeping it for the next run.', names)
+        return False
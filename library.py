@@ -0,0 +1,273 @@
+import filecmp
+import hashlib
+import json
+import logging
+import os
+import threading
+from os import path
+
+import atomic
+
+INDEX_FILE = 'library-index.json'
+
+# Bytes read from the start, middle and end of a file for its sampled hash.
+SAMPLE_SIZE = 64 * 1024
+
+
+def sample_hash(file_path, size):
+    """Hash of a file's size and a few samples of its content, which tells media files apart without reading
+    all of them."""
+
+    digest = hashlib.sha1(str(size).encode())
+    with open(file_path, 'rb') as f:
+        for offset in sorted({0, max(0, size // 2 - SAMPLE_SIZE // 2), max(0, size - SAMPLE_SIZE)}):
+            f.seek(offset)
+            digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+class LibraryIndex:
+    """Index of the files in the library directories, by size, along with every directory in them.
+
+    The index answers whether a directory exists, and whether a file is already in the library (under any
+    name), without going back to the library's disks each time. It is brought up to date once per batch by
+    refresh, which only lists the directories that have changed since they were last listed: everything else
+    costs a single stat per directory. Sampled hashes are only worked out for files that are the same size as
+    one being looked for, and a file whose sampled hash matches is only taken to be the same once the whole of
+    both files has been compared. Files left in place when they were placed in the library are remembered, so
+    that they are known without being compared again. If an index file is given, the index is kept there
+    between runs."""
+
+    def __init__(self, roots, index_file=None):
+        self.roots = [path.abspath(root) for root in roots if root]
+        self.index_file = index_file
+        self.dirs = None
+        # source -> [size, mtime, destination] of files placed in the library while being left where they were
+        self.placed = {}
+        self.sizes = {}
+        self.stale = True
+        self.lock = threading.RLock()
+
+    def load(self):
+        self.dirs, self.placed = self.read()
+
+    def read(self):
+        if self.index_file is None:
+            return {}, {}
+        try:
+            with open(self.index_file) as f:
+                saved = json.load(f)
+            return saved['dirs'], saved['placed']
+        except FileNotFoundError:
+            logging.debug('No library index found at [%s].', self.index_file)
+        except (ValueError, KeyError, TypeError):
+            logging.warning('Could not read library index [%s]; building it again.', self.index_file)
+        return {}, {}
+
+    def save(self):
+        """Save the index, merged with whatever other runs have saved since it was loaded.
+
+        The index file is read again and written back holding its lock, so runs at the same time (e.g. one per
+        finished torrent) take turns and neither loses what the other found. Of a directory known to both, the
+        listing made at its later modification time is kept."""
+
+        if self.index_file is None or self.dirs is None:
+            return
+
+        with self.lock, atomic.locked(self.index_file + atomic.LOCK_SUFFIX):
+            dirs, placed = self.read()
+            for directory, known in self.dirs.items():
+                saved = dirs.get(directory)
+                if saved is None or (known['mtime'] or 0) >= (saved['mtime'] or 0):
+                    dirs[directory] = known
+            placed.update(self.placed)
+            self.dirs, self.placed = dirs, placed
+
+            # Replaced in one step, so an interrupted run can't leave a truncated index.
+            atomic.write_atomically(self.index_file, json.dumps({'dirs': dirs, 'placed': placed}))
+        logging.debug('Saved library index of [%d] directories to [%s].', len(dirs), self.index_file)
+
+    def refresh(self):
+        """Bring the index up to date with the library directories."""
+
+        with self.lock:
+            if self.dirs is None:
+                self.load()
+
+            fresh = {}
+            listed = 0
+            stack = list(self.roots)
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+
+                known = self.dirs.get(directory)
+                if known is None or known['mtime'] != mtime:
+                    known = self.list(directory, mtime, known)
+                    listed += 1
+                fresh[directory] = known
+                stack.extend(path.join(directory, name) for name in known['dirs'])
+
+            self.dirs = fresh
+            self.stale = False
+            self.sizes = {}
+            for directory, known in fresh.items():
+                for name, (size, mtime, digest) in known['files'].items():
+                    self.sizes.setdefault(size, []).append(path.join(directory, name))
+
+            # forget placed files whose copy in the library has gone or changed
+            self.placed = {source: entry for source, entry in self.placed.items()
+                           if entry[2] in self.sizes.get(entry[0], ())}
+
+        logging.debug('Library index has [%d] directories; listed [%d] of them again.', len(fresh), listed)
+
+    @staticmethod
+    def list(directory, mtime, known=None):
+        """List a directory, keeping the sampled hashes of files that haven't changed."""
+
+        previous = known['files'] if known else {}
+        listing = {'mtime': mtime, 'dirs': [], 'files': {}}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    listing['dirs'].append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    old = previous.get(entry.name)
+                    digest = old[2] if old and old[:2] == [st.st_size, st.st_mtime_ns] else None
+                    listing['files'][entry.name] = [st.st_size, st.st_mtime_ns, digest]
+        return listing
+
+    def invalidate(self):
+        """Have the index brought up to date again the next time it is used, e.g. for the next batch."""
+
+        self.stale = True
+
+    def ensure(self):
+        if self.stale:
+            self.refresh()
+
+    def indexed(self, directory):
+        directory = path.abspath(directory)
+        return directory, any(directory == root or directory.startswith(root + os.sep) for root in self.roots)
+
+    def has_dir(self, directory):
+        """True if the directory exists, answered from the index for directories within the library."""
+
+        directory, indexed = self.indexed(directory)
+        if not indexed:
+            return path.isdir(directory)
+
+        with self.lock:
+            self.ensure()
+            return directory in self.dirs
+
+    def makedirs(self, directory):
+        """Create the directory, and any missing parents, unless the index already knows it exists."""
+
+        if self.has_dir(directory):
+            return
+
+        logging.info('Destination does not exist; creating [%s]', directory)
+        os.makedirs(directory, exist_ok=True)
+
+        directory, indexed = self.indexed(directory)
+        if indexed:
+            with self.lock:
+                # Recorded as never listed, so the next refresh lists it along with whatever was placed in it.
+                while directory not in self.dirs:
+                    self.dirs[directory] = {'mtime': None, 'dirs': [], 'files': {}}
+                    parent, indexed = self.indexed(path.dirname(directory))
+                    if not indexed:
+                        break
+                    if parent in self.dirs:
+                        self.dirs[parent]['dirs'].append(path.basename(directory))
+                        break
+                    directory = parent
+
+    def add(self, file_path, source=None):
+        """Record a file placed in the library, along with the source it was placed from if that was left where
+        it was."""
+
+        directory, indexed = self.indexed(path.dirname(file_path))
+        if not indexed:
+            return
+
+        st = os.stat(file_path)
+        try:
+            source_st = source and os.stat(source)
+        except FileNotFoundError:
+            source_st = None
+        with self.lock:
+            self.ensure()
+            known = self.dirs.get(directory)
+            if known is not None:
+                known['files'][path.basename(file_path)] = [st.st_size, st.st_mtime_ns, None]
+                self.sizes.setdefault(st.st_size, []).append(path.join(directory, path.basename(file_path)))
+                if source_st:
+                    self.placed[path.abspath(source)] = [source_st.st_size, source_st.st_mtime_ns,
+                                                         path.join(directory, path.basename(file_path))]
+
+    def find(self, source):
+        """Find a file in the library identical to the source. Candidates are narrowed down by size and sampled
+        hash, then compared byte for byte, as files can differ outside the samples (e.g. a fresh download of a
+        file that is corrupt in the library). Returns its path, or None if there isn't one. Empty files are
+        never treated as identical.
+
+        A source that is the candidate itself (e.g. hardlinked into the library), or that the index recorded
+        as placed and that hasn't changed since, is known without reading either file."""
+
+        st = os.stat(source)
+        size = st.st_size
+        if not size:
+            return None
+
+        with self.lock:
+            self.ensure()
+            candidates = list(self.sizes.get(size, ()))
+            placed = self.placed.get(path.abspath(source))
+        if not candidates:
+            return None
+
+        if placed is not None and placed[:2] == [size, st.st_mtime_ns] and placed[2] in candidates:
+            return placed[2]
+        for candidate in candidates:
+            try:
+                if path.samestat(st, os.stat(candidate)):
+                    return candidate
+            except FileNotFoundError:
+                continue
+
+        digest = sample_hash(source, size)
+        for candidate in candidates:
+            if self.digest(candidate) == digest:
+                same = filecmp.cmp(source, candidate, shallow=False)
+                # filecmp remembers every pair it has compared, which would only grow in watch mode
+                filecmp.clear_cache()
+                if same:
+                    return candidate
+                logging.info('[%s] has the same samples as [%s], but different content.', source, candidate)
+        return None
+
+    def digest(self, file_path):
+        """Sampled hash of a file in the index, worked out the first time it is needed and checked against the
+        file's current size and modification time."""
+
+        directory, name = path.split(file_path)
+        with self.lock:
+            entry = self.dirs.get(directory, {}).get('files', {}).get(name)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+
+        if entry is None or entry[:2] != [st.st_size, st.st_mtime_ns] or entry[2] is None:
+            entry = [st.st_size, st.st_mtime_ns, sample_hash(file_path, st.st_size)]
+            with self.lock:
+                known = self.dirs.get(directory)
+                if known is not None:
+                    known['files'][name] = entry
+        return entry[2]
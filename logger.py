@@ -1,8 +1,18 @@
+import atexit
 import logging
+import logging.handlers
+import os
 import platform
-import subprocess
+import queue
+import re
+
+import atomic
 
 LOG_FILE = './copy-files.log'
+
+# The log file is rotated once it grows past this many bytes, keeping this many of the rotated files.
+MAX_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
 FORMAT = '[%(asctime)-15s %(filename)s:%(lineno)s - %(funcName)20s() %(levelname)s] %(message)s'
 
 TRACE = 8
@@ -20,15 +30,108 @@ logging.Logger.trace = trace
 
 logLevel = logging.DEBUG
 
+CYGWIN = 'CYGWIN' in platform.system()
+
+# Writes records to the log file on a background thread, once logging has been configured.
+_listener = None
+
+
+class RotatingFileHandler(logging.handlers.WatchedFileHandler):
+    """Writes to a log file shared with other runs, rotating it once it grows past max_bytes.
+
+    Only one run rotates the file at a time, holding its lock, and only if it is still too big once the lock is
+    held, so that a file another run has just rotated isn't rotated again. Every other run notices the file has
+    been moved away and opens it again under its name, as it would if logrotate or the like had rotated it."""
+
+    def __init__(self, filename, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+        super().__init__(filename, mode='a')
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def emit(self, record):
+        if self.max_bytes and self.stream is not None and os.fstat(self.stream.fileno()).st_size >= self.max_bytes:
+            try:
+                self.rotate()
+            except OSError:
+                self.handleError(record)
+        super().emit(record)
+
+    def rotate(self):
+        with atomic.locked(self.baseFilename + atomic.LOCK_SUFFIX):
+            try:
+                if os.stat(self.baseFilename).st_size < self.max_bytes:
+                    return
+            except FileNotFoundError:
+                return
+
+            for i in range(self.backup_count - 1, 0, -1):
+                backup = '%s.%d' % (self.baseFilename, i)
+                if os.path.exists(backup):
+                    os.replace(backup, '%s.%d' % (self.baseFilename, i + 1))
+            if self.backup_count:
+                os.replace(self.baseFilename, self.baseFilename + '.1')
+            else:
+                os.remove(self.baseFilename)
+        # opened again under its name by emit, as the file has been moved away
+
+
+def config(logfile=LOG_FILE, level=None, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    """Log to the file, rotating it once it grows past max_bytes (see RotatingFileHandler).
+
+    Records are handed over to a background thread through a queue, so the caller never waits for the file
+    to be written. That thread is the only one that writes or rotates the file. Like logging.basicConfig,
+    this does nothing if logging has already been configured."""
+
+    global _listener
+
+    root = logging.getLogger()
+    if root.handlers:
+        return
+
+    file_handler = RotatingFileHandler(get_path(logfile), max_bytes, backup_count)
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    atexit.register(stop)
+
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(logLevel if level is None else parse_level(level))
+
+
+def stop():
+    """Write out anything still queued and stop the background thread."""
+
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def set_level(level):
+    """Change the level everything is logged at, given either a level name such as 'INFO' or a number."""
+
+    logging.getLogger().setLevel(parse_level(level))
+
+
+def parse_level(level):
+    if isinstance(level, int):
+        return level
 
-def config(logfile=LOG_FILE):
-    logging.basicConfig(filename=get_path(logfile),
-                        level=logLevel, format=FORMAT, filemode='a')
+    value = logging.getLevelName(str(level).upper())
+    if not isinstance(value, int):
+        raise ValueError('Unknown log level [%s]' % level)
+    return value
 
 
 def get_path(argpath):
     """Convert path to cygwin format if running on a cygwin platform"""
 
-    if 'CYGWIN' in platform.system():
-        argpath = subprocess.getoutput('cygpath ' + argpath)
-    return argpath
\ No newline at end of file
+    if CYGWIN:
+        # e.g. C:\Users\media -> /cygdrive/c/Users/media, as cygpath would
+        drive = re.match(r'^([A-Za-z]):[\\/]*(.*)$', argpath)
+        if drive:
+            argpath = '/cygdrive/%s/%s' % (drive.group(1).lower(), drive.group(2))
+        argpath = argpath.replace('\\', '/')
+    return argpath
@@ -0,0 +1,191 @@
+import logging
+import re
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+import logger
+
+
+class SeriesMatcher:
+    """Compiled matcher for the configured series.
+
+    Every series regex is compiled once up front. Each pattern is also inspected for the longest
+    literal string that any match must contain (e.g. the series name in the usual
+    '(.*)(Series Name)( - )(\\d{1,})(.*)' patterns) so that a file only has its full regex run against
+    the handful of series whose literal actually appears in the name. Candidates are always tried in
+    configuration order, so the first configured series that matches still wins.
+
+    The 'replace' templates are parsed up front too. The analysis can be saved as plain JSON with state() and
+    a matcher made again from it with from_state() (see configcache), in which case each regex is compiled
+    again the first time it is needed."""
+
+    def __init__(self, series):
+        self.series = list(series or [])
+        self.patterns = [re.compile(show['regex']) for show in self.series]
+        self.templates = [parse_template(show['replace']) if 'replace' in show else None for show in self.series]
+
+        # literal -> indexes of the series requiring it, plus the series we couldn't index
+        self.literals = {}
+        self.unindexed = []
+        trace = logging.getLogger().isEnabledFor(logger.TRACE)
+        for index, show in enumerate(self.series):
+            literal = required_literal(self.patterns[index])
+            if literal:
+                self.literals.setdefault(literal, []).append(index)
+            else:
+                self.unindexed.append(index)
+
+            if trace:
+                logging.log(logger.TRACE, 'Indexed series [%s] under literal [%s]', show['name'], literal)
+
+        # Quick rejection of names that contain none of the literals at all.
+        self.prefilter = None
+        if self.literals and not self.unindexed:
+            self.prefilter = re.compile('|'.join(re.escape(literal) for literal in
+                                                 sorted(self.literals, key=len, reverse=True)))
+
+        self.indexes = {id(show): index for index, show in enumerate(self.series)}
+
+        logging.debug('Compiled [%d] series patterns; [%d] indexed by literal, [%d] unindexed.',
+                      len(self.series), len(self.series) - len(self.unindexed), len(self.unindexed))
+
+    def state(self):
+        """The analysis of the series, as data that can be saved as JSON. The series themselves aren't included."""
+
+        return {'templates': self.templates, 'literals': self.literals, 'unindexed': self.unindexed,
+                'prefilter': self.prefilter and self.prefilter.pattern}
+
+    @classmethod
+    def from_state(cls, series, state):
+        """A matcher for the series made from the state() of one compiled from the same series, without
+        analysing them again."""
+
+        matcher = cls.__new__(cls)
+        matcher.series = list(series)
+        matcher.patterns = [None] * len(matcher.series)
+        matcher.templates = state['templates']
+        matcher.literals = state['literals']
+        matcher.unindexed = state['unindexed']
+        matcher.prefilter = state['prefilter'] and re.compile(state['prefilter'])
+        matcher.indexes = {id(show): index for index, show in enumerate(matcher.series)}
+        if len(matcher.templates) != len(matcher.series):
+            raise ValueError('State is for [%d] series, not [%d]' % (len(matcher.templates), len(matcher.series)))
+        return matcher
+
+    def __len__(self):
+        return len(self.series)
+
+    def pattern(self, index):
+        pattern = self.patterns[index]
+        if pattern is None:
+            pattern = self.patterns[index] = re.compile(self.series[index]['regex'])
+        return pattern
+
+    def candidates(self, name):
+        """Indexes of the series that could possibly match the name, in configuration order."""
+
+        if self.prefilter is not None and not self.prefilter.search(name):
+            return []
+
+        found = list(self.unindexed)
+        for literal, indexes in self.literals.items():
+            if literal in name:
+                found.extend(indexes)
+        found.sort()
+        return found
+
+    def match(self, name):
+        """Return the first configured series matching the name, or None if there isn't one."""
+
+        candidates = self.candidates(name)
+        if logging.getLogger().isEnabledFor(logger.TRACE):
+            logging.log(logger.TRACE, 'Candidate series for [%s]: [%s]', name, candidates)
+
+        for index in candidates:
+            if self.pattern(index).match(name):
+                return self.series[index]
+        return None
+
+    def rename(self, name, show):
+        """Apply the show's 'replace' template to a name it matches, as re.sub would."""
+
+        index = self.indexes.get(id(show))
+        if index is None:
+            return re.sub(show['regex'], show['replace'], name)
+
+        template = self.templates[index]
+        return self.pattern(index).sub(lambda match: expand(match, template), name)
+
+
+def required_literal(pattern):
+    """Find the longest run of literal characters that every match of the compiled pattern must contain.
+
+    Returns None if no such run could be determined (e.g. the pattern is case insensitive or only made of
+    character classes and repeats)."""
+
+    if pattern.flags & re.IGNORECASE:
+        return None
+
+    try:
+        parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        logging.debug('Could not parse pattern [%s] for literals.', pattern.pattern)
+        return None
+
+    runs = ['']
+
+    def walk(items):
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                runs[-1] += chr(av)
+            elif op is sre_parse.AT:
+                # zero width assertions such as ^ and \b don't consume anything
+                continue
+            elif op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+                walk(av[-1])
+            else:
+                runs.append('')
+
+    walk(parsed)
+
+    longest = max(runs, key=len)
+    return longest or None
+
+
+TEMPLATE_ESCAPE = re.compile(r'\\(?:g<([^>]*)>|([1-9][0-9]?)|(.))', re.DOTALL)
+ESCAPES = {'\\': '\\', 'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a', 'b': '\b', '0': '\0'}
+
+
+def parse_template(replace):
+    """Split a replacement template such as '\\1New Name\\3' into (literal, group) parts and the literal text
+    after the last group. Raises ValueError for escapes that re.sub would also reject."""
+
+    parts = []
+    literal = ''
+    position = 0
+    for escape in TEMPLATE_ESCAPE.finditer(replace):
+        literal += replace[position:escape.start()]
+        position = escape.end()
+
+        name, number, char = escape.groups()
+        if char is not None:
+            if char in ESCAPES:
+                literal += ESCAPES[char]
+            elif char.isascii() and char.isalnum():
+                raise ValueError('Bad escape [\\%s] in replacement [%s]' % (char, replace))
+            else:
+                literal += '\\' + char
+        else:
+            group = number or name
+            parts.append((literal, int(group) if group.isdigit() else group))
+            literal = ''
+
+    return parts, literal + replace[position:]
+
+
+def expand(match, template):
+    parts, tail = template
+    return ''.join(literal + (match.group(group) or '') for literal, group in parts) + tail
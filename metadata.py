@@ -0,0 +1,258 @@
+import logging
+import struct
+import subprocess
+from os import path, remove
+
+import logger
+
+# MP4 atoms holding tags and titles. They are turned into 'free' atoms of the same size, which every
+# player skips over, so nothing else in the file has to move.
+MP4_CONTAINERS = {b'moov', b'trak'}
+MP4_METADATA = {b'udta', b'meta'}
+MP4_FREE = b'free'
+MP4_FIRST = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide'}
+
+# Matroska elements holding tags and titles. They are turned into Void elements of the same size.
+MKV_EBML = 0x1A45DFA3
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TITLE = 0x7BA9
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_NAME = 0x536E
+MKV_TAGS = 0x1254C367
+MKV_VOID = 0xEC
+MKV_CONTAINERS = {MKV_INFO, MKV_TRACKS, MKV_TRACK_ENTRY}
+MKV_METADATA = {MKV_TITLE, MKV_TRACK_NAME, MKV_TAGS}
+
+MP4_EXTENSIONS = {'.mp4', '.m4v', '.mov'}
+MKV_EXTENSIONS = {'.mkv', '.mk3d', '.mka', '.webm'}
+
+CHUNK_SIZE = 1024 * 1024
+
+# Defaults for remuxing with ffmpeg: remuxes running at once overall, remuxes reading from or writing to any
+# one device at once, and seconds before a remux is given up on.
+WORKERS = 4
+PER_DEVICE = 2
+TIMEOUT = 6 * 60 * 60
+
+
+class UnsupportedFile(Exception):
+    """The file isn't laid out in a way that can be stripped in place."""
+    pass
+
+
+def strip_in_place(movie):
+    """Blank out the metadata of an MP4 or Matroska file without rewriting the audio and video.
+
+    Only the bytes of the metadata itself are overwritten. Returns the number of bytes written, or None if
+    the file isn't a format (or layout) that can be stripped in place, in which case it is left untouched."""
+
+    # Find everything to blank out before writing anything, so a file we can't fully
+    # understand is left exactly as it was.
+    edits = find_edits(movie)
+    if edits is None:
+        return None
+    return apply_edits(movie, edits)
+
+
+def find_edits(movie):
+    """Find the metadata of an MP4 or Matroska file, returning the edits that would blank it out.
+
+    The edits only depend on the layout of the file, so they can equally be applied to an exact copy of it.
+    Returns None if the file isn't a format (or layout) that can be stripped in place."""
+
+    ext = path.splitext(movie)[1].lower()
+    if ext in MP4_EXTENSIONS:
+        find = mp4_metadata
+    elif ext in MKV_EXTENSIONS:
+        find = mkv_metadata
+    else:
+        logging.debug('No in place stripping for [%s] files.', ext)
+        return None
+
+    try:
+        with open(movie, 'rb') as f:
+            size = f.seek(0, 2)
+            return list(find(f, size))
+    except (UnsupportedFile, struct.error) as e:
+        logging.info('Could not strip [%s] in place: [%s]', movie, e)
+        return None
+
+
+def apply_edits(movie, edits):
+    """Apply the edits found by find_edits, returning the number of bytes written."""
+
+    with open(movie, 'r+b') as f:
+        written = sum(apply(f, edit) for edit in edits)
+
+    logging.debug('Blanked [%d] metadata elements in [%s], writing [%d] bytes.', len(edits), movie, written)
+    return written
+
+
+def remux(movie, stripped_movie, timeout=TIMEOUT):
+    """Use ffmpeg to copy the movie's audio and video to a new file without any metadata.
+
+    Returns True if ffmpeg succeeded within the timeout (in seconds). If it didn't, any partial output is
+    removed. Anything ffmpeg reports is logged."""
+
+    try:
+        result = subprocess.run(['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'warning', '-y', '-i', movie,
+                                 '-map_metadata', '-1', '-c:v', 'copy', '-c:a', 'copy', stripped_movie],
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logging.error('ffmpeg took more than [%s] seconds on [%s]; stopped it.', timeout, movie)
+        result = None
+    except OSError:
+        logging.exception('Could not run ffmpeg on [%s]', movie)
+        return False
+
+    if result is not None:
+        stderr = result.stderr.decode(errors='replace').strip()
+        if result.returncode == 0:
+            if stderr:
+                logging.debug('ffmpeg reported on [%s]: %s', movie, stderr)
+            return True
+        logging.error('ffmpeg failed on [%s] with exit status [%d]: %s', movie, result.returncode, stderr)
+
+    if path.exists(stripped_movie):
+        remove(stripped_movie)
+    return False
+
+
+def apply(f, edit):
+    """Write a replacement header at the offset and zero the rest of the element."""
+
+    offset, header, length = edit
+    f.seek(offset)
+    f.write(header)
+
+    zeros = bytes(min(CHUNK_SIZE, length))
+    remaining = length - len(header)
+    while remaining > 0:
+        remaining -= f.write(zeros[:min(len(zeros), remaining)])
+    return length
+
+
+def mp4_metadata(f, size, start=0, end=None):
+    """Edits turning every metadata atom between start and end into a free atom."""
+
+    end = size if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        atom_size, atom_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if atom_size == 1:
+            atom_size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif atom_size == 0:
+            atom_size = end - offset
+
+        if atom_size < header_size or offset + atom_size > end:
+            raise UnsupportedFile('atom [%r] at [%d] has invalid size [%d]' % (atom_type, offset, atom_size))
+
+        if offset == 0 and atom_type not in MP4_FIRST:
+            raise UnsupportedFile('not an MP4 file')
+
+        logging.log(logger.TRACE, 'MP4 atom [%s] at [%d], [%d] bytes', atom_type, offset, atom_size)
+
+        if atom_type in MP4_METADATA:
+            if header_size == 16:
+                header = struct.pack('>I4sQ', 1, MP4_FREE, atom_size)
+            else:
+                header = struct.pack('>I4s', atom_size, MP4_FREE)
+            yield offset, header, atom_size
+        elif atom_type in MP4_CONTAINERS:
+            yield from mp4_metadata(f, size, offset + header_size, offset + atom_size)
+
+        offset += atom_size
+
+    if start == 0 and offset == 0:
+        raise UnsupportedFile('no MP4 atoms found')
+
+
+def read_vint(f, keep_marker):
+    """Read an EBML variable length integer, returning its value and its length in bytes.
+
+    Element ids keep their length marker bit, sizes don't. A size with every bit set means unknown, which
+    is returned as None."""
+
+    first = f.read(1)
+    if not first:
+        raise UnsupportedFile('unexpected end of file')
+    first = first[0]
+
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise UnsupportedFile('invalid EBML integer')
+
+    value = first if keep_marker else first & (0xFF >> length)
+    rest = f.read(length - 1)
+    if len(rest) != length - 1:
+        raise UnsupportedFile('unexpected end of file')
+    for byte in rest:
+        value = (value << 8) | byte
+
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def void_header(length):
+    """Header of a Void element taking up exactly length bytes in total."""
+
+    size_length = min(8, length - 1)
+    data_size = length - 1 - size_length
+    return bytes([MKV_VOID]) + ((1 << (7 * size_length)) | data_size).to_bytes(size_length, 'big')
+
+
+def mkv_metadata(f, size):
+    """Edits turning the title, track names and tags of a Matroska file into Void elements."""
+
+    f.seek(0)
+    element_id, id_length = read_vint(f, True)
+    if element_id != MKV_EBML:
+        raise UnsupportedFile('not an EBML file')
+    data_size, size_length = read_vint(f, False)
+    if data_size is None:
+        raise UnsupportedFile('EBML header has unknown size')
+    offset = id_length + size_length + data_size
+
+    # Everything of interest is inside the segment, with clusters of media in between that are skipped over.
+    f.seek(offset)
+    element_id, id_length = read_vint(f, True)
+    if element_id != MKV_SEGMENT:
+        raise UnsupportedFile('no segment found')
+    data_size, size_length = read_vint(f, False)
+    start = offset + id_length + size_length
+    end = size if data_size is None else min(size, start + data_size)
+
+    yield from mkv_children(f, start, end)
+
+
+def mkv_children(f, start, end):
+    offset = start
+    while offset < end:
+        f.seek(offset)
+        element_id, id_length = read_vint(f, True)
+        data_size, size_length = read_vint(f, False)
+        if data_size is None:
+            # e.g. a cluster written while streaming; there's no telling where it ends without parsing it
+            raise UnsupportedFile('element [%x] at [%d] has unknown size' % (element_id, offset))
+
+        length = id_length + size_length + data_size
+        if offset + length > end:
+            raise UnsupportedFile('element [%x] at [%d] overruns its parent' % (element_id, offset))
+
+        logging.log(logger.TRACE, 'MKV element [%x] at [%d], [%d] bytes', element_id, offset, length)
+
+        if element_id in MKV_METADATA:
+            yield offset, void_header(length), length
+        elif element_id in MKV_CONTAINERS:
+            yield from mkv_children(f, offset + id_length + size_length, offset + length)
+
+        offset += length
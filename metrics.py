@@ -0,0 +1,138 @@
+import json
+import logging
+import threading
+import time
+
+import atomic
+
+# Prefix of every metric written for Prometheus.
+PREFIX = 'copy_media'
+
+# The metrics every stage records to in this process, if enabled with set_metrics.
+_metrics = None
+
+
+class StageTimer:
+    """Times one call of a stage, to which the items handled and bytes moved can be added as it goes."""
+
+    __slots__ = ('metrics', 'name', 'items', 'bytes', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+
+    def add(self, items=0, bytes=0):
+        self.items += items
+        self.bytes += bytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start, self.items, self.bytes)
+
+
+class NullTimer:
+    """Stands in for a StageTimer when metrics are disabled, doing nothing at all."""
+
+    __slots__ = ()
+
+    def add(self, items=0, bytes=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Metrics:
+    """Wall time, items and bytes recorded for each stage, summed over every call of it."""
+
+    FIELDS = ('calls', 'seconds', 'max_seconds', 'items', 'bytes')
+
+    def __init__(self, summary_file=None, textfile=None):
+        self.summary_file = summary_file
+        self.textfile = textfile
+        self.stages = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        return StageTimer(self, name)
+
+    def record(self, name, seconds, items=0, bytes=0):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = dict.fromkeys(self.FIELDS, 0)
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            stage['max_seconds'] = max(stage['max_seconds'], seconds)
+            stage['items'] += items
+            stage['bytes'] += bytes
+
+    def summary(self):
+        """Everything recorded so far, as a dict that can be dumped as JSON."""
+
+        with self.lock:
+            return {'started': self.started,
+                    'finished': time.time(),
+                    'stages': {name: dict(stage) for name, stage in self.stages.items()}}
+
+    def prometheus(self, summary):
+        """Render the summary in the Prometheus text exposition format."""
+
+        lines = []
+        for field, kind, description in [('calls', 'counter', 'Number of times each stage ran.'),
+                                         ('seconds', 'counter', 'Wall time spent in each stage.'),
+                                         ('max_seconds', 'gauge', 'Longest single run of each stage.'),
+                                         ('items', 'counter', 'Items handled by each stage.'),
+                                         ('bytes', 'counter', 'Bytes moved or written by each stage.')]:
+            metric = '%s_stage_%s%s' % (PREFIX, field, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s %s' % (metric, kind))
+            for name, stage in sorted(summary['stages'].items()):
+                lines.append('%s{stage="%s"} %s' % (metric, name.replace('"', '\\"'), repr(stage[field])))
+
+        lines.append('# HELP %s_last_run_timestamp_seconds When the last run finished.' % PREFIX)
+        lines.append('# TYPE %s_last_run_timestamp_seconds gauge' % PREFIX)
+        lines.append('%s_last_run_timestamp_seconds %s' % (PREFIX, repr(summary['finished'])))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Log the summary and write it to the summary file and Prometheus textfile, if configured."""
+
+        summary = self.summary()
+        summary_json = json.dumps(summary, sort_keys=True)
+        logging.info('Run summary: %s', summary_json)
+
+        if self.summary_file:
+            atomic.write_atomically(self.summary_file, summary_json + '\n')
+        if self.textfile:
+            atomic.write_atomically(self.textfile, self.prometheus(summary))
+        return summary
+
+
+def set_metrics(metrics):
+    """Record every stage run by this process to the given Metrics, or stop recording if it is None."""
+
+    global _metrics
+    _metrics = metrics
+
+
+def stage(name):
+    """Time a stage for the configured Metrics, e.g. ``with metrics.stage('match_files') as timer:``.
+
+    When metrics are disabled this returns a timer that does nothing."""
+
+    if _metrics is None:
+        return NULL_TIMER
+    return _metrics.stage(name)
@@ -0,0 +1,190 @@
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import PTN
+
+import logger
+
+# Number of parsed names kept in memory, and the number of uncached names it takes before a batch is worth
+# spreading over a pool of processes.
+LRU_SIZE = 4096
+POOL_THRESHOLD = 2000
+
+# The cache shared by every parse in this process, if one has been configured with set_cache.
+_cache = None
+
+
+class ParsedName:
+    """Immutable result of parsing a release name.
+
+    The fields used to identify media (title, year, season and episode) are attributes. Like the dict
+    returned by PTN, the record can also be indexed by field name, and only contains the fields that were
+    actually found in the name."""
+
+    __slots__ = ('name', 'title', 'year', 'season', 'episode', 'extra')
+
+    MAIN_FIELDS = ('title', 'year', 'season', 'episode')
+
+    def __init__(self, name, fields):
+        set_field = super().__setattr__
+        set_field('name', name)
+        for field in self.MAIN_FIELDS:
+            set_field(field, freeze(fields.get(field)))
+        set_field('extra', tuple((key, freeze(value)) for key, value in fields.items()
+                                 if key not in self.MAIN_FIELDS))
+
+    def __setattr__(self, key, value):
+        raise AttributeError('ParsedName is immutable')
+
+    def __delattr__(self, key):
+        raise AttributeError('ParsedName is immutable')
+
+    def __getitem__(self, key):
+        if key in self.MAIN_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        else:
+            for extra_key, value in self.extra:
+                if extra_key == key:
+                    return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [field for field in self.MAIN_FIELDS if getattr(self, field) is not None] + \
+               [key for key, value in self.extra]
+
+    def fields(self):
+        """The parsed fields as a plain dict, as PTN would have returned them."""
+
+        return {key: self[key] for key in self.keys()}
+
+    def __eq__(self, other):
+        return isinstance(other, ParsedName) and self.name == other.name and self.fields() == other.fields()
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __repr__(self):
+        return 'ParsedName(%r, %r)' % (self.name, self.fields())
+
+
+def freeze(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+class RecentNames:
+    """Bounded, thread safe record of the most recently parsed names."""
+
+    def __init__(self, maxsize=LRU_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            parsed = self.entries.get(name)
+            if parsed is not None:
+                self.entries.move_to_end(name)
+            return parsed
+
+    def put(self, parsed):
+        with self.lock:
+            self.entries[parsed.name] = parsed
+            self.entries.move_to_end(parsed.name)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_recent = RecentNames()
+
+
+def set_cache(name_cache):
+    """Use the given NameCache for all parsing in this process, or stop using one if it is None."""
+
+    global _cache
+    _cache = name_cache
+    _recent.clear()
+
+
+def parse_fields(name):
+    """Parse the name with PTN. Kept at module level so it can run in a process pool."""
+
+    return PTN.parse(name)
+
+
+def pool_context():
+    """Start the worker processes fresh rather than forking this one, which may have other threads running (e.g.
+    movie DB lookups or transfers) whose locks a forked child would inherit held."""
+
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def parse(name):
+    """Parse a single release name into a ParsedName."""
+
+    return clean_names([name])[0]
+
+
+def clean_names(names, workers=None):
+    """Parse a batch of release names, returning a ParsedName for each in the same order.
+
+    Names recently parsed by this process or found in the configured NameCache aren't parsed again. If a large
+    number of names are left to parse, they are spread over a pool of worker processes."""
+
+    names = list(names)
+    results = {}
+    missing = []
+    for name in dict.fromkeys(names):
+        parsed = _recent.get(name)
+        if parsed is None:
+            missing.append(name)
+        else:
+            results[name] = parsed
+
+    if missing and _cache is not None:
+        for name, fields in _cache.get_many(missing).items():
+            results[name] = ParsedName(name, fields)
+            _recent.put(results[name])
+        missing = [name for name in missing if name not in results]
+
+    if missing:
+        if len(missing) >= POOL_THRESHOLD:
+            logging.debug('Parsing [%d] names in a process pool.', len(missing))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+                parsed = dict(zip(missing, executor.map(parse_fields, missing, chunksize=100)))
+        else:
+            parsed = {name: parse_fields(name) for name in missing}
+
+        trace = logging.getLogger().isEnabledFor(logger.TRACE)
+        for name, fields in parsed.items():
+            if trace:
+                logging.log(logger.TRACE, 'Parsed [%s] into [%s]', name, fields)
+            results[name] = ParsedName(name, fields)
+            _recent.put(results[name])
+
+        if _cache is not None:
+            _cache.put_many(parsed)
+
+    return [results[name] for name in names]
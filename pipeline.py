@@ -0,0 +1,46 @@
+import logging
+import time
+from collections import namedtuple
+
+StageReport = namedtuple('StageReport', ['name', 'handled', 'claimed', 'seconds'])
+PassReport = namedtuple('PassReport', ['name', 'file', 'read', 'written'])
+
+
+class Stage:
+    """A single step of processing within a pipeline.
+
+    A stage is handed the items that no earlier stage has claimed. Its claim function processes the items
+    it is responsible for and returns a tuple of the claimed items and the rest, which are handed on to
+    the next stage."""
+
+    def __init__(self, name, claim):
+        self.name = name
+        self.claim = claim
+
+    def run(self, items):
+        """Run the stage over the items, returning the claimed items, the unclaimed items, and a StageReport."""
+
+        start = time.perf_counter()
+        claimed, unclaimed = self.claim(items)
+        report = StageReport(self.name, len(items), len(claimed), time.perf_counter() - start)
+
+        logging.info('Stage [%s] handled [%d] items and claimed [%d] in [%.3f] seconds.',
+                     report.name, report.handled, report.claimed, report.seconds)
+        return claimed, unclaimed, report
+
+
+def run_pipeline(stages, items):
+    """Pass the items through each stage in turn, each stage only seeing what the ones before it left unclaimed.
+
+    Returns the items no stage claimed along with a StageReport for each stage that was run. Stages after
+    the point where every item has been claimed are skipped."""
+
+    reports = []
+    for stage in stages:
+        if not items:
+            logging.debug('Nothing left for stage [%s]; skipping.', stage.name)
+            break
+        claimed, items, report = stage.run(items)
+        reports.append(report)
+
+    return items, reports
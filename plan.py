@@ -0,0 +1,160 @@
+import logging
+import os
+from collections import namedtuple
+
+import transfer
+
+# What a step does: rename within a filesystem, copy to another filesystem (removing the original unless it
+# is left in place), hard link or reflink clone leaving the original in place, skip a file that is already
+# in the library (removing the original, if moving), extract a file from an archive set into the library,
+# strip meta-data in place, strip it by remuxing with ffmpeg, or delete.
+MOVE = 'move'
+COPY = 'copy'
+LINK = 'link'
+CLONE = 'clone'
+DUPLICATE = 'duplicate'
+EXTRACT = 'extract'
+RENAME = 'rename'
+STRIP = 'strip'
+REMUX = 'remux'
+DELETE = 'delete'
+
+# The step for each way the transfer engine can place a file while leaving the original in place.
+PLACED_BY = {transfer.HARDLINK: LINK, transfer.REFLINK: CLONE, transfer.COPY: COPY}
+
+# A single operation and an estimate of the bytes involved: the size of what is moved, copied or extracted,
+# the bytes written to strip meta-data, or the bytes freed by deleting. The destination is None for strips,
+# remuxes in place and deletes, and the file already in the library for duplicates. A remux with a destination
+# writes the stripped movie there, leaving the source as it is.
+Step = namedtuple('Step', ['action', 'source', 'destination', 'bytes'])
+
+# Bytes left free on every destination filesystem by default, on top of what is planned to be copied onto it.
+RESERVED_SPACE = 0
+
+# Free space found on a destination filesystem that isn't enough for everything planned to be copied onto it.
+Shortfall = namedtuple('Shortfall', ['device', 'directory', 'needed', 'free'])
+
+
+class Job:
+    """Steps that are carried out together, in order, by a single call to run.
+
+    Jobs don't depend on each other, so different jobs can run at the same time. The entries are the names,
+    within the scan directory, of the files and directories the job deals with."""
+
+    def __init__(self, name, run, source_device, destination_device, destination, entries=()):
+        self.name = name
+        self.entries = list(entries)
+        self.run = run
+        self.source_device = source_device
+        self.destination_device = destination_device
+        self.destination = destination
+        self.steps = []
+
+    def add(self, action, source, destination=None, bytes=0):
+        self.steps.append(Step(action, source, destination, bytes))
+
+    def copy_bytes(self):
+        return sum(step.bytes for step in self.steps
+                   if step.action in (COPY, EXTRACT) or (step.action == REMUX and step.destination is not None))
+
+
+class Plan:
+    """Everything a run is going to do, worked out before any of it is done."""
+
+    def __init__(self):
+        self.jobs = []
+        self.devices = {}
+
+    def add(self, job):
+        self.jobs.append(job)
+
+    def device(self, directory):
+        """Device the directory is (or would be) on, looking each directory up only once."""
+
+        device = self.devices.get(directory)
+        if device is None:
+            device = self.devices[directory] = transfer.device_of(directory)
+        return device
+
+    def steps(self):
+        return [step for job in self.jobs for step in job.steps]
+
+    def ordered(self, jobs=None):
+        """The jobs (or just those given) grouped by the devices they read from and write to."""
+
+        return sorted(self.jobs if jobs is None else jobs, key=lambda job: (job.source_device, job.destination_device))
+
+    def needed(self):
+        """Bytes to be copied or extracted onto each destination filesystem, along with a directory on it, by
+        device."""
+
+        needed = {}
+        for job in self.jobs:
+            copy_bytes = job.copy_bytes()
+            if copy_bytes:
+                directory, total = needed.get(job.destination_device, (job.destination, 0))
+                needed[job.destination_device] = directory, total + copy_bytes
+        return needed
+
+    def shortfalls(self, reserve=RESERVED_SPACE):
+        """Check every destination filesystem has room for everything that will be copied onto it, while still
+        leaving reserve bytes free. Each filesystem is only checked once."""
+
+        shortfalls = []
+        for device, (directory, total) in self.needed().items():
+            free = max(0, free_space(directory) - reserve)
+            logging.debug('[%d] bytes to copy to [%s], which has [%d] bytes free to use.', total, directory, free)
+            if total > free:
+                shortfalls.append(Shortfall(device, directory, total, free))
+        return shortfalls
+
+    def admit(self, reserve=RESERVED_SPACE):
+        """Split the jobs into those there is room for, and those that have to be held back until there is.
+
+        Where everything doesn't fit onto a destination filesystem, the jobs copying onto it are admitted
+        smallest first, so that as many as possible get done. Both lists keep the order of the plan."""
+
+        held = set()
+        for shortfall in self.shortfalls(reserve):
+            free = shortfall.free
+            for job in sorted((job for job in self.jobs
+                               if job.destination_device == shortfall.device and job.copy_bytes()),
+                              key=Job.copy_bytes):
+                if job.copy_bytes() <= free:
+                    free -= job.copy_bytes()
+                else:
+                    held.add(job)
+
+        return [job for job in self.jobs if job not in held], [job for job in self.jobs if job in held]
+
+    def describe(self, reserve=RESERVED_SPACE):
+        """The plan as text, one step per line, marking the jobs that would be held back for lack of space."""
+
+        held = self.admit(reserve)[1]
+        steps = self.steps()
+        lines = ['Plan: %d jobs, %d steps, %s to copy' % (len(self.jobs), len(steps),
+                                                           format_bytes(sum(job.copy_bytes() for job in self.jobs)))]
+        for job in self.ordered():
+            lines.append('%s:%s' % (job.name, ' (held back: not enough space)' if job in held else ''))
+            for step in job.steps:
+                if step.destination is None:
+                    lines.append('  %-6s %s (%s)' % (step.action, step.source, format_bytes(step.bytes)))
+                else:
+                    lines.append('  %-6s %s -> %s (%s)' % (step.action, step.source, step.destination,
+                                                            format_bytes(step.bytes)))
+        return '\n'.join(lines)
+
+
+def free_space(directory):
+    """Bytes available to us on the filesystem the directory is (or would be) on."""
+
+    stats = os.statvfs(transfer.existing_ancestor(directory))
+    return stats.f_bavail * stats.f_frsize
+
+
+def format_bytes(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1000:
+            return ('%d %s' if unit == 'bytes' else '%.1f %s') % (size, unit)
+        size /= 1000
+    return '%.1f TB' % size
@@ -0,0 +1,184 @@
+import logging
+import os
+import re
+import shutil
+from collections import deque, namedtuple
+from os import path
+
+import logger
+
+VIDEO_EXTENSIONS = {'.mkv', '.mp4', '.m4v', '.avi', '.mov', '.wmv', '.mpg', '.mpeg', '.ts', '.m2ts', '.webm'}
+SUBTITLE_EXTENSIONS = {'.srt'}
+ENGLISH = {'en', 'eng', 'english'}
+
+# Volumes of an archive set, with the name of the set and where each comes in it: name.part01.rar,
+# name.part02.rar...; name.rar, name.r00, name.r01...; or a single name.zip.
+RAR = 'rar'
+ZIP = 'zip'
+ARCHIVE_VOLUMES = [(re.compile(r'(.+)\.part(\d+)\.rar$', re.IGNORECASE), RAR, 0),
+                   (re.compile(r'(.+)\.rar$', re.IGNORECASE), RAR, None),
+                   (re.compile(r'(.+)\.r(\d{2,3})$', re.IGNORECASE), RAR, 1),
+                   (re.compile(r'(.+)\.zip$', re.IGNORECASE), ZIP, None)]
+
+# Path within the release directory of the movie file, its size, and the size of every file in the directory.
+# If the movie is packed in an archive set that is bigger than any video file, the path of the set's first
+# volume and the size of the whole set. Also the path of the best english sub-titles, if there are any, and
+# the path of every entry in the directory, each with whether it is a directory, in the order they were found.
+ReleaseScan = namedtuple('ReleaseScan', ['movie', 'size', 'total', 'archive', 'archive_size', 'subtitle', 'contents'],
+                         defaults=(None, 0, None, ()))
+
+
+def archive_volume(name):
+    """The kind and name of the archive set a file is a volume of, along with its place in the set, or None if
+    it isn't an archive."""
+
+    for pattern, kind, offset in ARCHIVE_VOLUMES:
+        match = pattern.match(name)
+        if match:
+            number = 0 if offset is None else int(match.group(2)) + offset
+            return kind, match.group(1).lower(), number
+    return None
+
+
+def walk(dir):
+    """Yield every entry below the directory along with its path relative to it.
+
+    The tree is walked breadth first, so everything at the top level comes before anything in a sub-directory."""
+
+    pending = deque([''])
+    while pending:
+        relative = pending.popleft()
+        with os.scandir(path.join(dir, relative)) as entries:
+            for entry in entries:
+                entry_path = path.join(relative, entry.name)
+                yield entry, entry_path
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry_path)
+
+
+def scan_release(dir):
+    """Walk a release directory once to find the movie.
+
+    The movie is the largest file with a video extension anywhere in the tree; if there are several of the
+    same size, the one nearest the top wins. If there are no video files at all, the largest file of any
+    kind is used. The movie is None if the directory has no files.
+
+    Archive sets are gathered in the same walk. If the biggest one is bigger than any video file, as when a
+    release comes as a RAR set next to a small sample, the movie is taken to be packed in it. So are the best
+    english sub-titles and everything else in the directory, so that the release can be tidied up afterwards
+    without walking it again (see tidy_release)."""
+
+    movie = None
+    movie_size = -1
+    other = None
+    other_size = -1
+    total = 0
+    archives = {}
+    subtitle = None
+    subtitle_rank_found = None
+    contents = []
+
+    trace = logging.getLogger().isEnabledFor(logger.TRACE)
+    for entry, entry_path in walk(dir):
+        is_dir = entry.is_dir(follow_symlinks=False)
+        contents.append((entry_path, is_dir))
+        if is_dir:
+            continue
+
+        size = entry.stat(follow_symlinks=False).st_size
+        total += size
+        if trace:
+            logging.log(logger.TRACE, 'Found [%s] of [%d] bytes', entry_path, size)
+
+        if entry.is_file(follow_symlinks=False):
+            rank = subtitle_rank(entry.name, size)
+            if rank is not None and (subtitle_rank_found is None or rank > subtitle_rank_found):
+                subtitle, subtitle_rank_found = entry_path, rank
+
+        if path.splitext(entry.name)[1].lower() in VIDEO_EXTENSIONS:
+            if size > movie_size:
+                movie, movie_size = entry_path, size
+            continue
+
+        volume = archive_volume(entry.name)
+        if volume is not None:
+            kind, name, number = volume
+            first, first_path, set_size = archives.get((path.dirname(entry_path), kind, name), (number, entry_path, 0))
+            if number < first:
+                first, first_path = number, entry_path
+            archives[path.dirname(entry_path), kind, name] = first, first_path, set_size + size
+
+        if size > other_size:
+            other, other_size = entry_path, size
+
+    archive, archive_size = None, 0
+    for first, first_path, set_size in archives.values():
+        if set_size > max(movie_size, archive_size):
+            archive, archive_size = first_path, set_size
+
+    if movie is None and other is not None:
+        if archive is None:
+            logging.warning('No video files found in [%s]; using the largest file instead.', dir)
+        movie, movie_size = other, other_size
+
+    logging.debug('Scanned [%s]: movie [%s] of [%d] bytes, archive [%s] of [%d] bytes, sub-titles [%s]', dir, movie,
+                  movie_size, archive, archive_size, subtitle)
+    return ReleaseScan(movie, movie_size, total, archive, archive_size, subtitle, contents)
+
+
+def subtitle_rank(name, size):
+    """Rank an english .srt sub-title file against others, higher being better. Returns None for anything else.
+
+    Forced sub-titles only cover foreign language dialogue, so any full set is preferred; after that, the
+    largest wins."""
+
+    stem, ext = path.splitext(name)
+    if ext.lower() not in SUBTITLE_EXTENSIONS:
+        return None
+
+    tokens = set(re.split('[^a-z0-9]+', stem.lower()))
+    if not tokens & ENGLISH:
+        return None
+    return 'forced' not in tokens, size
+
+
+def tidy_release(dir, scan, movie_name, subtitle_name):
+    """Remove everything from a release directory except the movie and the best english sub-titles.
+
+    The movie is the file movie_name at the top of the directory. The sub-titles and everything else were
+    found by scan_release, so the directory isn't walked again: the sub-titles are moved to subtitle_name next
+    to the movie, and the rest is removed, the deepest entries first. Entries that have gone since the scan,
+    such as the movie's name before it was renamed, are passed over; anything added since is removed along
+    with its directory.
+
+    Returns the path to the sub-titles, or None if there weren't any, along with the number of entries
+    removed."""
+
+    subtitle = path.join(dir, subtitle_name)
+    if scan.subtitle is not None and scan.subtitle != subtitle_name:
+        logging.debug('Using sub-titles [%s]', path.join(dir, scan.subtitle))
+        os.replace(path.join(dir, scan.subtitle), subtitle)
+
+    removed = 0
+    trace = logging.getLogger().isEnabledFor(logger.TRACE)
+    # walked breadth first, so going backwards empties every directory before it is removed
+    for entry_path, is_dir in reversed(scan.contents):
+        if entry_path in (movie_name, subtitle_name, scan.subtitle):
+            continue
+
+        if trace:
+            logging.log(logger.TRACE, 'Removing [%s]', entry_path)
+        try:
+            if is_dir:
+                shutil.rmtree(path.join(dir, entry_path))
+            else:
+                os.remove(path.join(dir, entry_path))
+        except FileNotFoundError:
+            continue
+        removed += 1
+
+    if not path.exists(subtitle):
+        subtitle = None
+
+    logging.debug('Removed [%d] entries from [%s]; sub-titles [%s]', removed, dir, subtitle)
+    return subtitle, removed
@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import time
+import zlib
+
+import atomic
+
+STATE_FILE = 'scan-state.json'
+
+# Seconds before an unchanged entry is looked at again anyway, e.g. in case the movie DB has caught up with it.
+TTL = 24 * 60 * 60
+
+
+class ScanState:
+    """Persistent record of the entries left behind in scan directories by earlier runs.
+
+    Each entry is remembered by name along with its inode, size and modification time, so an entry that
+    hasn't changed since it was last processed can be skipped. The record is tied to a key describing the
+    configuration (e.g. a hash of the configured series); if the configuration changes, everything is
+    looked at again."""
+
+    def __init__(self, state_file=STATE_FILE, ttl=TTL, key=''):
+        self.state_file = state_file
+        self.ttl = ttl
+        self.key = key
+        self.state = None
+
+    def load(self):
+        if self.state is None:
+            self.state = self.read()
+        return self.state
+
+    def read(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state.get('key') == self.key:
+                return state.get('dirs', {})
+            logging.info('Configuration has changed since [%s] was written; ignoring it.', self.state_file)
+        except FileNotFoundError:
+            logging.debug('No scan state found at [%s].', self.state_file)
+        except ValueError:
+            logging.warning('Could not read scan state [%s]; ignoring it.', self.state_file)
+        return {}
+
+    def unchanged(self, scandir, name, signature):
+        """True if the entry was seen by an earlier run and hasn't changed since then."""
+
+        seen = self.load().get(scandir, {}).get(name)
+        return seen is not None and seen[:3] == list(signature) and time.time() - seen[3] < self.ttl
+
+    def save(self, scandir, signatures, checked):
+        """Replace what is remembered about the scan directory with the given entries' signatures.
+
+        Entries named in checked were processed by this run. The others were skipped and keep the time they
+        were last processed, so that they still expire.
+
+        The state file is read again and written back holding its lock, so that runs at the same time take
+        turns. Whatever another run has recorded since this one loaded the state is kept, unless this run saw
+        the same entry."""
+
+        now = time.time()
+        previous = self.load().get(scandir, {})
+        entries = {}
+        for name, signature in signatures.items():
+            seen = previous.get(name)
+            last_checked = now if name in checked or seen is None else seen[3]
+            entries[name] = list(signature) + [last_checked]
+
+        if entries == previous:
+            logging.debug('Scan state for [%s] is unchanged.', scandir)
+            return
+
+        with atomic.locked(self.state_file + atomic.LOCK_SUFFIX):
+            self.state = self.read()
+            for name, seen in self.state.get(scandir, {}).items():
+                if name not in entries and seen != previous.get(name):
+                    entries[name] = seen
+            self.state[scandir] = entries
+
+            # Replaced in one step, so an interrupted run can't leave a truncated state.
+            atomic.write_atomically(self.state_file, json.dumps({'key': self.key, 'dirs': self.state}))
+
+        logging.debug('Saved scan state of [%d] entries for [%s].', len(entries), scandir)
+
+
+def signature(entry):
+    """Inode, size and modification time of a DirEntry, which change whenever the entry is replaced or written to.
+
+    For a directory, the size is instead a checksum of the inode and modification time of every directory
+    nested in it. A directory's modification time changes whenever anything is added to it, removed from it or
+    renamed within it, so together with its own these notice such changes anywhere inside a release directory,
+    without looking at any of its files. A file that is only written to where it is isn't noticed."""
+
+    st = entry.stat()
+    if not entry.is_dir():
+        return entry.inode(), st.st_size, st.st_mtime_ns
+
+    nested = []
+    pending = [entry.path]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for sub_entry in entries:
+                    if sub_entry.is_dir(follow_symlinks=False):
+                        nested.append((sub_entry.inode(), sub_entry.stat(follow_symlinks=False).st_mtime_ns))
+                        pending.append(sub_entry.path)
+        except FileNotFoundError:
+            continue
+    return entry.inode(), zlib.crc32(json.dumps(sorted(nested)).encode()), st.st_mtime_ns
@@ -1,13 +1,41 @@
 #!/usr/bin/python3
 
+import gzip
+import json
+import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from unittest import mock
 
+import archive
+import atomic
+import benchmark
+import cache
+import configcache
 import ifttt
+import library
 import logger
+import matcher
+import metadata
+import metrics
+import names
+import release
+import scanstate
+import test_helpers
+import titleindex
 import tmdb
-from copy_files import CopyMedia
+import transfer
+import watch
+from copy_files import CONFIG_FILE, CopyMedia
 from exceptions import ConfigurationError
+from matcher import SeriesMatcher, required_literal
+from plan import COPY, MOVE, Job, Plan
 
 TEST_CONFIG = r'./test_resources/test_CopyMedia.json'
 TEST_RESOURCES = r'./test_resources'
@@ -17,8 +45,27 @@ TMDB_CONTEXT_VAR = 'TMDB_CONTEXT'
 logger.config()
 
 
+def copy_config(test, config_file=TEST_CONFIG):
+    """Copy the configuration file into a temporary directory removed after the test, so that what runs keep
+    next to it (compiled configuration, scan state, caches, library index) is never written into the source
+    tree."""
+
+    tmp = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, tmp)
+    return shutil.copy(config_file, tmp)
+
+
 class TestCopyMedia(unittest.TestCase):
 
+    def setUp(self):
+        self.test_config = copy_config(self)
+        self.config_file = copy_config(self, CONFIG_FILE)
+
+    def tearDown(self):
+        # loading the test configuration points the name cache next to it
+        names.set_cache(None)
+        metrics.set_metrics(None)
+
     def test_notifications(self):
 
         ifttt_context = os.getenv(IFTTT_CONTEXT_VAR)
@@ -30,10 +77,104 @@ class TestCopyMedia(unittest.TestCase):
 
         self.assertEqual(r.status_code, 200)
 
+    def test_notification_queue(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch('requests.post') as post:
+            spool = os.path.join(tmp, ifttt.SPOOL_FILE)
+
+            # two runs queue notifications, which are merged into one message with each series only once
+            first = ifttt.NotificationQueue(spool, window=60)
+            second = ifttt.NotificationQueue(spool, window=60)
+            first.add([('a', {'name': 'World Trigger'}), ('b', {'name': 'World Trigger'})], 'url')
+            second.add([('c', {'name': 'Goblin Slayer'}), ('d', {'name': 'World Trigger'})], 'url')
+            first.close()
+            second.close()
+
+            # nothing is sent before the window is up
+            self.assertTrue(second.flush())
+            self.assertFalse(post.called)
+
+            self.assertTrue(first.flush(force=True))
+            post.assert_called_once_with('url', data={'value1': 'World Trigger and Goblin Slayer'},
+                                         timeout=ifttt.TIMEOUT)
+            self.assertEqual({}, first.read())
+
+            # a notification that can't be sent is retried, then kept for the next run
+            post.reset_mock()
+            post.return_value.ok = False
+            queue = ifttt.NotificationQueue(spool, window=0, attempts=2, backoff=0)
+            queue.add([('e', {'name': 'Goblin Slayer'})], 'url')
+            queue.sender.join()
+            self.assertEqual(2, post.call_count)
+            self.assertEqual(['Goblin Slayer'], queue.read()['url']['names'])
+
+            # a run that is done doesn't wait out the window, leaving what isn't due in the spool
+            post.reset_mock()
+            post.return_value.ok = True
+            queue = ifttt.NotificationQueue(spool, window=60)
+            waiting = queue.read()
+            waiting['url']['since'] -= 120
+            queue.write(waiting)
+            queue.add([('f', {'name': 'World Trigger'})], 'other url')
+            self.assertTrue(queue.sender.daemon)
+            started = time.monotonic()
+            queue.finish()
+            self.assertLess(time.monotonic() - started, 5)
+            self.assertFalse(queue.sender.is_alive())
+            self.assertEqual(['World Trigger'], queue.read()['other url']['names'])
+            # while the notification that was already due is sent
+            post.assert_called_once_with('url', data={'value1': 'Goblin Slayer'}, timeout=ifttt.TIMEOUT)
+
     def test_find_largest_file(self):
         largest = CopyMedia.find_largest_file(TEST_RESOURCES)
         self.assertEqual(os.path.basename(largest), 'big_file.mp4')
 
+    def test_scan_release(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, size in [('Movie/Some.Movie.2019.1080p.mkv', 5000), ('Sample/sample.mkv', 500),
+                               ('Sample/Subs/English.srt', 20), ('Some.Movie.2019.nfo', 100), ('RARBG.txt', 10)]:
+                os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(b'\0' * size)
+
+            scan = release.scan_release(tmp)
+            self.assertEqual(os.path.join('Movie', 'Some.Movie.2019.1080p.mkv'), scan.movie)
+            self.assertEqual(5000, scan.size)
+
+            # a sub-directory bigger than any file is never taken for the movie
+            self.assertEqual(os.path.join(tmp, 'Movie', 'Some.Movie.2019.1080p.mkv'), CopyMedia.find_largest_file(tmp))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertIsNone(release.scan_release(tmp).movie)
+            self.assertIsNone(CopyMedia.find_largest_file(tmp))
+
+    def test_clean_dir(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, content in [('Some_Movie.2019.mkv', b'movie'), ('Some.Movie.2019.nfo', b'info'),
+                                  ('Sample/sample.mkv', b'sample'), ('Subs/2_English.srt', b'english'),
+                                  ('Subs/3_English.forced.srt', b'english forced, but larger'),
+                                  ('Subs/4_French.srt', b'french'), ('Subs/Extra/eng.srt', b'en'),
+                                  ('Some.Movie.2019.srt', b'no language')] + \
+                                 [('Screens/%d.jpg' % i, b'') for i in range(2000)]:
+                os.makedirs(os.path.dirname(os.path.join(tmp, name)), exist_ok=True)
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(content)
+
+            # the scan finds the sub-titles and everything to remove, so the release isn't walked again
+            scan = release.scan_release(tmp)
+            self.assertEqual(os.path.join('Subs', '2_English.srt'), scan.subtitle)
+            with mock.patch.object(release, 'walk', side_effect=AssertionError):
+                subtitle = CopyMedia.clean_dir(tmp, os.path.join(tmp, 'Some_Movie.2019.mkv'), 'Some_Movie.2019', scan)
+
+            self.assertEqual(os.path.join(tmp, 'Some_Movie.2019.en.srt'), subtitle)
+            self.assertEqual(['Some_Movie.2019.en.srt', 'Some_Movie.2019.mkv'], sorted(os.listdir(tmp)))
+            with open(subtitle, 'rb') as f:
+                self.assertEqual(b'english', f.read())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            open(os.path.join(tmp, 'Some_Movie.2019.mkv'), 'w').close()
+            self.assertIsNone(CopyMedia.clean_dir(tmp, os.path.join(tmp, 'Some_Movie.2019.mkv'), 'Some_Movie.2019'))
+            self.assertEqual(['Some_Movie.2019.mkv'], os.listdir(tmp))
+
     def test_rename_movie(self):
         starting_dir_name = 'Toy.Story.4.2019.1080p.BluRay.H264.AAC-RARBG'
         new_dir_name = 'Toy_Story_4.2019'
@@ -70,6 +211,498 @@ class TestCopyMedia(unittest.TestCase):
                                        'Mid-town.1080p.AMZN.WEB-DL.DDP5.1.H.264-NTb', tmdb_key))
         self.assertFalse(tmdb.is_movie('sherlock.3x02.the_sign_of_three.720p_hdtv_x264-fov', tmdb_key))
 
+    def test_is_movie_cache(self):
+        names = ['Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'Not.A.Real.Film.2012.1080p.WEB-DL',
+                 'Planet.Earth.II.S01E06']
+
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(movies=['Brave']) as server:
+            lookups = cache.LookupCache(os.path.join(tmp, cache.CACHE_FILE))
+            cold = [tmdb.is_movie(name, 'key', lookups) for name in names]
+            self.assertEqual([True, False, False], cold)
+            # the episode never needs a query
+            self.assertEqual(2, len(server.requests))
+            lookups.close()
+
+            # a warm re-scan from a fresh process answers everything from disk
+            lookups = cache.LookupCache(os.path.join(tmp, cache.CACHE_FILE))
+            self.assertEqual(cold, [tmdb.is_movie(name, 'key', lookups) for name in names])
+            self.assertEqual(2, len(server.requests))
+
+            # expired negative answers are looked up again, positive ones are still cached
+            lookups.negative_ttl = -1
+            self.assertEqual(cold, [tmdb.is_movie(name, 'key', lookups) for name in names])
+            self.assertEqual(3, len(server.requests))
+            lookups.close()
+
+    def test_title_index(self):
+        names = ['Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'Amelie.2001.1080p.BluRay.x264-GROUP',
+                 'Not.A.Real.Film.2012.1080p.WEB-DL', 'Planet.Earth.II.S01E06']
+
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(movies=['Not A Real Film']) as server:
+            export = os.path.join(tmp, 'movie_ids_05_15_2024.json.gz')
+            with gzip.open(export, 'wt') as f:
+                for record in [{'id': 1, 'original_title': 'Brave', 'adult': False},
+                               {'id': 2, 'original_title': 'Amélie', 'adult': False},
+                               {'id': 3, 'original_title': 'Brave', 'adult': False},
+                               {'id': 4, 'original_title': 'Planet Earth II', 'adult': True}]:
+                    f.write(json.dumps(record) + '\n')
+                f.write('not json\n')
+
+            index_file = os.path.join(tmp, titleindex.INDEX_FILE)
+            self.assertEqual(2, titleindex.build(export, index_file))
+            index = titleindex.TitleIndex(index_file)
+            self.assertIn('BRAVE', index)
+            self.assertNotIn('Brave New World', index)
+
+            # answered offline, without an API key
+            self.assertEqual({names[0]: True, names[1]: True, names[2]: False, names[3]: False},
+                             tmdb.classify(names, None, index=index))
+            self.assertEqual(0, len(server.requests))
+
+            # only titles missing from the index go to the movie DB, and only if configured to
+            self.assertTrue(tmdb.is_movie(names[2], 'key', index=index, fallback=True))
+            self.assertEqual(1, len(server.requests))
+            index.close()
+
+            with open(index_file, 'r+b') as f:
+                f.write(b'JUNK')
+            with self.assertRaises(ValueError):
+                titleindex.TitleIndex(index_file)
+
+    def test_classify(self):
+        names = ['Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'Not.A.Real.Film.2012.1080p.WEB-DL',
+                 'Slow.Film.2012.1080p.WEB-DL', 'Brave.2012.1080p.BluRay.x264.AC3-HDChina']
+
+        with test_helpers.StubTmdbServer(movies=['Brave', 'Slow Film'], throttled=2, slow=['Slow Film']) as server:
+            found = tmdb.classify(names, 'key', workers=3, rate_limit=50, timeout=0.5)
+
+        # the timed out lookup is reported as unknown, rather than holding up the others
+        self.assertEqual({names[0]: True, names[1]: False, names[2]: None}, found)
+        # duplicates are only looked up once; throttled requests are retried
+        self.assertEqual(5, len(server.requests))
+
+        # answers that aren't a search result are left for a later run, without holding up the others
+        broken = {'Bad Key': (401, b'{"status_code": 7}'), 'Down': (503, b'<html>Down</html>'),
+                  'Odd': (200, b'{"results": []}')}
+        names = ['Bad.Key.2012.1080p', 'Down.2012.1080p', 'Odd.2012.1080p', 'Brave.2012.1080p']
+        with test_helpers.StubTmdbServer(movies=['Brave'], broken=broken):
+            found = tmdb.classify(names, 'key', workers=2)
+        self.assertEqual({names[0]: None, names[1]: None, names[2]: None, names[3]: True}, found)
+
+    def test_process_files_skips_series_lookups(self):
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer() as server:
+            scan_dir = os.path.join(tmp, 'scan')
+            series_dir = os.path.join(tmp, 'series')
+            movie_dir = os.path.join(tmp, 'movies')
+            os.makedirs(scan_dir)
+            os.makedirs(movie_dir)
+            for episode in range(1000):
+                open(os.path.join(scan_dir, '[HorribleSubs] World Trigger - %d [1080p].mkv' % episode), 'w').close()
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=series_dir, moviedir=movie_dir,
+                          tmdb='key')
+            c.scan_state.state_file = os.path.join(tmp, scanstate.STATE_FILE)
+            c.execute()
+
+            self.assertFalse(server.requests)
+            self.assertFalse(os.listdir(scan_dir))
+            self.assertEqual(1000, len(os.listdir(os.path.join(series_dir, 'World Trigger'))))
+            self.assertEqual([('series', 1000, 1000)], [report[:3] for report in c.reports])
+
+    def test_scan_state(self):
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(slow=['Slow Film']) as server:
+            scan_dir = os.path.join(tmp, 'scan')
+            os.makedirs(scan_dir)
+            os.makedirs(os.path.join(scan_dir, 'Not.A.Real.Film.2012.1080p.WEB-DL'))
+            for name in ['Slow.Film.2012.1080p.WEB-DL.mkv', 'Unknown.Film.2011.720p.mkv', 'notes.txt']:
+                open(os.path.join(scan_dir, name), 'w').close()
+
+            def run():
+                c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                              moviedir=os.path.join(tmp, 'movies'), tmdb='key')
+                c.tmdb_cache = None
+                names.set_cache(None)
+                c.tmdb_timeout = 0.5
+                c.scan_state.state_file = os.path.join(tmp, scanstate.STATE_FILE)
+                c.execute()
+                return c
+
+            run()
+            self.assertEqual(3, len(server.requests))
+
+            # only the lookup which timed out is tried again
+            run()
+            self.assertEqual(4, len(server.requests))
+
+            # as is anything which changes
+            with open(os.path.join(scan_dir, 'Unknown.Film.2011.720p.mkv'), 'w') as f:
+                f.write('more')
+            c = run()
+            self.assertEqual(6, len(server.requests))
+
+            # files, dirs and signatures are gathered in one pass; unchanged entries are skipped
+            files, dirs, signatures = c.scan()
+            self.assertEqual(['Slow.Film.2012.1080p.WEB-DL.mkv'], files)
+            self.assertEqual([], dirs)
+            self.assertEqual(4, len(signatures))
+
+            # as is a directory with anything changed inside it
+            os.makedirs(os.path.join(scan_dir, 'Not.A.Real.Film.2012.1080p.WEB-DL', 'Subs'))
+            run()
+            self.assertEqual(8, len(server.requests))
+            with open(os.path.join(scan_dir, 'Not.A.Real.Film.2012.1080p.WEB-DL', 'Subs', 'English.srt'), 'w') as f:
+                f.write('1')
+            run()
+            self.assertEqual(10, len(server.requests))
+
+            # a job that fails leaves its entries to be looked at again
+            job = Job('Failing', mock.Mock(side_effect=OSError('disk gone')), 1, 1, tmp, ['Unknown.Film.2011.720p.mkv'])
+            c.run_job(job)
+            self.assertEqual({'Unknown.Film.2011.720p.mkv'}, c.retry & set(job.entries))
+            # as does a file that couldn't be moved
+            results = CopyMedia.move_series([('Gone - 01.mkv', {'name': 'Gone'})], os.path.join(tmp, 'series'),
+                                            scan_dir, retry=c.retry)
+            self.assertIsNotNone(results[0].error)
+            self.assertIn('Gone - 01.mkv', c.retry)
+            # and isn't notified about as moved
+            c.series_moved = []
+            c.run_series([('Gone - 01.mkv', {'name': 'Gone'})], [], scan_dir)
+            self.assertEqual([], c.series_moved)
+
+            # runs saving at once keep what each other saw
+            state_file = os.path.join(tmp, 'shared-state.json')
+            first, second = scanstate.ScanState(state_file), scanstate.ScanState(state_file)
+            first.load()
+            second.save(scan_dir, {'a.mkv': (1, 1, 1)}, {'a.mkv'})
+            first.save(scan_dir, {'b.mkv': (2, 2, 2)}, {'b.mkv'})
+            self.assertEqual(['a.mkv', 'b.mkv'], sorted(scanstate.ScanState(state_file).load()[scan_dir]))
+
+    def test_strip_and_move_movie(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            scan_dir = os.path.join(tmp, 'scan')
+            movie_dir = os.path.join(tmp, 'movies')
+            os.makedirs(os.path.join(scan_dir, 'Some.Movie.2019.1080p.BluRay-GROUP'))
+            os.makedirs(movie_dir)
+            test_helpers.synthetic_mkv(os.path.join(scan_dir, 'Some.Movie.2019.1080p.BluRay-GROUP',
+                                                 'Some.Movie.2019.1080p.BluRay-GROUP.mkv'), 1000000)
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=movie_dir)
+            names.set_cache(None)
+
+            # pretend the movie directory is on another device, so the movie is copied and stripped in one pass
+            with mock.patch.object(transfer, 'device_of', side_effect=lambda p: p.startswith(movie_dir)):
+                c.process_movie('Some.Movie.2019.1080p.BluRay-GROUP')
+
+            movie = os.path.join(movie_dir, 'Some_Movie.2019', 'Some_Movie.2019.mkv')
+            size = os.path.getsize(movie)
+            self.assertEqual(['copy', 'strip in place'], [report.name for report in c.passes])
+            self.assertEqual(size, c.passes[0].read)
+            self.assertEqual(size, c.passes[0].written)
+            self.assertEqual(0, c.passes[1].read)
+            self.assertLess(c.passes[1].written, 2000)
+
+            with open(movie, 'rb') as f:
+                self.assertNotIn(b'GROUP', f.read())
+            self.assertEqual(['Some_Movie.2019'], os.listdir(movie_dir))
+            self.assertFalse(os.listdir(scan_dir))
+
+    def test_strip_and_move_movie_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            scan_dir = os.path.join(tmp, 'scan')
+            movie_dir = os.path.join(tmp, 'movies')
+            os.makedirs(os.path.join(scan_dir, 'Some_Movie.2019'))
+            os.makedirs(movie_dir)
+            movie = os.path.join(scan_dir, 'Some_Movie.2019', 'Some_Movie.2019.mkv')
+            test_helpers.synthetic_mkv(movie, 1000000)
+            size = os.path.getsize(movie)
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=movie_dir)
+            c.transfer_engine.mode = transfer.SAFE
+            c.transfer_engine.chunk_size = 65536
+
+            # die part way through the copy, after a few chunks have been journaled
+            fsync = os.fsync
+            calls = []
+
+            def failing_fsync(fd):
+                calls.append(fd)
+                if len(calls) > 8:
+                    raise OSError('interrupted')
+                fsync(fd)
+
+            with mock.patch.object(transfer, 'device_of', side_effect=lambda p: p.startswith(movie_dir)):
+                with mock.patch.object(transfer.os, 'fsync', side_effect=failing_fsync):
+                    with self.assertRaises(OSError):
+                        c.strip_and_move_movie(movie, os.path.dirname(movie))
+
+                # the next run carries on from the journal rather than starting again
+                passes = c.strip_and_move_movie(movie, os.path.dirname(movie))
+
+            self.assertEqual(['copy', 'strip in place'], [report.name for report in passes])
+            self.assertEqual(size - 4 * 65536, passes[0].written)
+            self.assertEqual(['Some_Movie.2019'], os.listdir(movie_dir))
+            self.assertEqual(['Some_Movie.2019.mkv'], os.listdir(os.path.join(movie_dir, 'Some_Movie.2019')))
+
+    def test_placed_movie(self):
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(movies=['Some Movie']):
+            scan_dir = os.path.join(tmp, 'scan')
+            movie_dir = os.path.join(tmp, 'movies')
+            release_dir = os.path.join(scan_dir, 'Some.Movie.2019.1080p.BluRay-GROUP')
+            os.makedirs(os.path.join(release_dir, 'Subs'))
+            os.makedirs(movie_dir)
+            movie = os.path.join(release_dir, 'Some.Movie.2019.1080p.BluRay-GROUP.mkv')
+            test_helpers.synthetic_mkv(movie, 1000000)
+            with open(os.path.join(release_dir, 'Subs', 'English.srt'), 'w') as f:
+                f.write('1\n00:00:01,000 --> 00:00:02,000\nHello\n')
+            with open(movie, 'rb') as f:
+                original = f.read()
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=movie_dir, tmdb='key')
+            c.tmdb_cache = None
+            c.scan_state = None
+            names.set_cache(None)
+            c.transfer_engine.placement = transfer.HARDLINK
+
+            # a dry run doesn't write probe files to find out whether the movie can be cloned
+            c.dry_run = True
+            with mock.patch.object(transfer, 'can_reflink', side_effect=AssertionError), \
+                    mock.patch('builtins.print'):
+                plan = c.process_entries(*c.scan()[:2])
+            self.assertEqual(['copy', 'strip', 'link', 'rename'], [step.action for step in plan.steps()])
+            self.assertFalse(os.listdir(movie_dir))
+
+            c.dry_run = False
+            with mock.patch.object(transfer, 'can_reflink', return_value=False):
+                plan = c.process_entries(*c.scan()[:2])
+
+            # the movie is copied to be stripped, the sub-titles linked, and the release left seeding as it was
+            self.assertEqual(['copy', 'strip', 'link', 'rename'], [step.action for step in plan.steps()])
+            self.assertEqual(['Some.Movie.2019.1080p.BluRay-GROUP.mkv', 'Subs'], sorted(os.listdir(release_dir)))
+            with open(movie, 'rb') as f:
+                self.assertEqual(original, f.read())
+
+            placed = os.path.join(movie_dir, 'Some_Movie.2019')
+            self.assertEqual(['Some_Movie.2019.en.srt', 'Some_Movie.2019.mkv'], sorted(os.listdir(placed)))
+            with open(os.path.join(placed, 'Some_Movie.2019.mkv'), 'rb') as f:
+                self.assertNotIn(b'GROUP', f.read())
+            self.assertTrue(os.path.samefile(os.path.join(release_dir, 'Subs', 'English.srt'),
+                                             os.path.join(placed, 'Some_Movie.2019.en.srt')))
+
+            # a later run finds it already placed
+            self.assertEqual([], c.process_entries(*c.scan()[:2]).jobs)
+            self.assertEqual(['Some_Movie.2019'], os.listdir(movie_dir))
+
+    def test_archive_release(self):
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(movies=['Some Movie']):
+            scan_dir = os.path.join(tmp, 'scan')
+            movie_dir = os.path.join(tmp, 'movies')
+            release_dir = os.path.join(scan_dir, 'Some.Movie.2019.1080p.BluRay-GROUP')
+            os.makedirs(os.path.join(release_dir, 'Subs'))
+            os.makedirs(movie_dir)
+            packed = os.path.join(tmp, 'Some.Movie.2019.1080p.BluRay-GROUP.mkv')
+            test_helpers.synthetic_mkv(packed, 1000000)
+            with zipfile.ZipFile(os.path.join(release_dir, 'some.movie.2019.zip'), 'w') as z:
+                z.write(packed, os.path.basename(packed))
+                z.writestr('some.movie.2019.nfo', 'nfo')
+            test_helpers.write_file(os.path.join(release_dir, 'sample.mkv'), 1000)
+            with open(os.path.join(release_dir, 'Subs', 'English.srt'), 'w') as f:
+                f.write('1\n00:00:01,000 --> 00:00:02,000\nHello\n')
+
+            scan = release.scan_release(release_dir)
+            self.assertEqual('some.movie.2019.zip', scan.archive)
+            self.assertEqual('sample.mkv', scan.movie)
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=movie_dir, tmdb='key')
+            c.tmdb_cache = None
+            names.set_cache(None)
+            plan = c.process_entries(*c.scan()[:2])
+
+            self.assertEqual(['extract', 'strip', 'delete'], [step.action for step in plan.steps()])
+            self.assertEqual(os.path.getsize(packed), plan.jobs[0].copy_bytes())
+            # a Matroska movie is only written once, as it is extracted
+            self.assertEqual(['extract', 'strip in place'], [report.name for report in c.passes])
+
+            # extracted, stripped and sub-titled in the movie directory, with nothing left behind
+            movie = os.path.join(movie_dir, 'Some_Movie.2019', 'Some_Movie.2019.mkv')
+            self.assertEqual(['Some_Movie.2019'], os.listdir(movie_dir))
+            self.assertEqual(['Some_Movie.2019.en.srt', 'Some_Movie.2019.mkv'],
+                             sorted(os.listdir(os.path.dirname(movie))))
+            self.assertEqual(os.path.getsize(packed), os.path.getsize(movie))
+            with open(movie, 'rb') as f:
+                self.assertNotIn(b'GROUP', f.read())
+            self.assertFalse(os.listdir(scan_dir))
+
+            # releases left seeding are extracted just the same, but kept
+            shutil.rmtree(os.path.dirname(movie))
+            os.makedirs(release_dir)
+            with zipfile.ZipFile(os.path.join(release_dir, 'some.movie.2019.zip'), 'w') as z:
+                z.write(packed, os.path.basename(packed))
+            c.transfer_engine.placement = transfer.HARDLINK
+            plan = c.process_entries(*c.scan()[:2])
+            self.assertEqual(['extract', 'strip'], [step.action for step in plan.steps()])
+            self.assertTrue(os.path.isfile(movie))
+            self.assertEqual(['some.movie.2019.zip'], os.listdir(release_dir))
+
+            # anything else is written twice: extracted, then remuxed by ffmpeg
+            shutil.rmtree(os.path.dirname(movie))
+            with zipfile.ZipFile(os.path.join(release_dir, 'some.movie.2019.zip'), 'w') as z:
+                z.writestr('Some.Movie.2019.1080p.BluRay-GROUP.avi', b'\0' * 1000000)
+            c.passes = []
+
+            def remux(source, stripped, timeout):
+                shutil.copyfile(source, stripped)
+                return True
+
+            with mock.patch('shutil.which', return_value='/usr/bin/ffmpeg'), \
+                    mock.patch.object(metadata, 'remux', side_effect=remux):
+                plan = c.process_entries(*c.scan()[:2])
+            self.assertEqual(['extract', 'remux'], [step.action for step in plan.steps()])
+            self.assertEqual([('extract', 1000000, 1000000), ('remux', 1000000, 1000000)],
+                             [(report.name, report.read, report.written) for report in c.passes])
+            self.assertEqual(['Some_Movie.2019.avi'], os.listdir(os.path.join(movie_dir, 'Some_Movie.2019')))
+
+    def test_archive_sets(self):
+        self.assertEqual(('rar', 'movie', 1), release.archive_volume('Movie.part01.rar'))
+        self.assertEqual(('rar', 'movie', 0), release.archive_volume('movie.rar'))
+        self.assertEqual(('rar', 'movie', 3), release.archive_volume('movie.r02'))
+        self.assertIsNone(release.archive_volume('movie.mkv'))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, size in [('movie.part02.rar', 5000), ('movie.part01.rar', 5000), ('movie.part03.rar', 100),
+                               ('sample.mkv', 6000)]:
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(b'\0' * size)
+            scan = release.scan_release(tmp)
+            self.assertEqual(('movie.part01.rar', 10100), (scan.archive, scan.archive_size))
+
+        # the technical listing of unrar, with its directories left out
+        listing = ('        Name: Movie\n        Type: Directory\n\n'
+                   '        Name: Movie/movie.mkv\n        Type: File\n        Size: 9000\n\n'
+                   '        Name: movie.nfo\n        Type: File\n        Size: 12\n')
+        with mock.patch('subprocess.run', return_value=mock.Mock(returncode=0, stdout=listing.encode())):
+            self.assertEqual(archive.Member('Movie/movie.mkv', 9000), archive.main_video('movie.part01.rar'))
+
+    def test_plan(self):
+        with tempfile.TemporaryDirectory() as tmp, test_helpers.StubTmdbServer(movies=['Some Movie']):
+            scan_dir = os.path.join(tmp, 'scan')
+            movie_dir = os.path.join(tmp, 'movies')
+            release_dir = os.path.join(scan_dir, 'Some.Movie.2019.1080p.BluRay-GROUP')
+            os.makedirs(os.path.join(release_dir, 'Movie'))
+            os.makedirs(movie_dir)
+            test_helpers.synthetic_mkv(os.path.join(release_dir, 'Movie', 'Some.Movie.2019.1080p.BluRay-GROUP.mkv'),
+                                    1000000)
+            test_helpers.write_file(os.path.join(release_dir, 'sample.mkv'), 1000)
+            open(os.path.join(scan_dir, '[HorribleSubs] World Trigger - 1 [1080p].mkv'), 'w').close()
+
+            c = CopyMedia(config_file=self.test_config, scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=movie_dir, tmdb='key', dry_run=True)
+            c.tmdb_cache = None
+            names.set_cache(None)
+            before = sorted(os.listdir(scan_dir))
+
+            # pretend the movie directory is on another device, so the movie is copied
+            with mock.patch.object(transfer, 'device_of', side_effect=lambda p: p.startswith(movie_dir)), \
+                    mock.patch('builtins.print'):
+                plan = c.process_entries(*c.scan()[:2])
+
+                # a dry run only plans
+                self.assertEqual(before, sorted(os.listdir(scan_dir)))
+                self.assertFalse(os.listdir(movie_dir))
+                self.assertEqual(['move', 'move', 'rename', 'rename', 'delete', 'strip', 'copy'],
+                                 [step.action for step in plan.steps()])
+                self.assertEqual(1000, plan.steps()[4].bytes)
+                self.assertLess(plan.steps()[5].bytes, 2000)
+                # the copy in the movie directory is stripped, not the download
+                self.assertEqual(os.path.join(movie_dir, '.Some_Movie.2019.partial', 'Some_Movie.2019.mkv'),
+                                 plan.steps()[5].source)
+                self.assertEqual(os.path.join(movie_dir, 'Some_Movie.2019'), plan.steps()[6].destination)
+
+                # without room for the copy the movie is held back for the next run, but the series still move
+                c.dry_run = False
+                with mock.patch('plan.free_space', return_value=0):
+                    plan = c.process_entries(*c.scan()[:2])
+                self.assertEqual(['Some.Movie.2019.1080p.BluRay-GROUP'], os.listdir(scan_dir))
+                self.assertEqual({'Some.Movie.2019.1080p.BluRay-GROUP'}, c.retry)
+                self.assertEqual(['World Trigger', 'Some.Movie.2019.1080p.BluRay-GROUP'],
+                                 [job.name for job in plan.jobs])
+
+                c.process_entries(*c.scan()[:2])
+
+            self.assertFalse(os.listdir(scan_dir))
+            self.assertEqual(['Some_Movie.2019.mkv'], os.listdir(os.path.join(movie_dir, 'Some_Movie.2019')))
+            self.assertEqual(1, len(os.listdir(os.path.join(tmp, 'series', 'World Trigger'))))
+
+    def test_admit(self):
+        plan = Plan()
+        for name, size in [('large', 600), ('small', 100), ('medium', 300)]:
+            job = Job(name, None, 1, 2, '/movies', [name])
+            job.add(COPY, name, '/movies/' + name, size)
+            plan.add(job)
+        renamed = Job('renamed', None, 2, 2, '/movies')
+        renamed.add(MOVE, 'renamed', '/movies/renamed', 5000)
+        plan.add(renamed)
+
+        # one check of the free space, less the reserve; the smallest copies are let through first
+        with mock.patch('plan.free_space', return_value=1000) as free_space:
+            admitted, held = plan.admit(reserve=100)
+        free_space.assert_called_once_with('/movies')
+        self.assertEqual(['small', 'medium', 'renamed'], [job.name for job in admitted])
+        self.assertEqual(['large'], [job.name for job in held])
+
+        with mock.patch('plan.free_space', return_value=1000):
+            self.assertEqual(4, len(plan.admit()[0]))
+
+    def test_metrics(self):
+        self.assertIs(metrics.NULL_TIMER, metrics.stage('execute'))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            scan_dir = os.path.join(tmp, 'scan')
+            test_helpers.synthetic_scan_dir(scan_dir, ['[SubGroup] Synthetic Show 1 - 01 [1080p].mkv', 'notes.txt'])
+            with open(os.path.join(scan_dir, 'notes.txt'), 'w') as f:
+                f.write('not a series')
+            with open(os.path.join(scan_dir, '[SubGroup] Synthetic Show 1 - 01 [1080p].mkv'), 'wb') as f:
+                f.write(b'\0' * 1000)
+
+            config_file = os.path.join(tmp, 'CopyMedia.json')
+            with open(config_file, 'w') as f:
+                json.dump({'scanDir': scan_dir, 'seriesDir': os.path.join(tmp, 'series'),
+                           'movieDir': os.path.join(tmp, 'movies'), 'series': benchmark.synthetic_series(3),
+                           'metrics': {'summaryFile': os.path.join(tmp, 'summary.json'),
+                                       'textfile': os.path.join(tmp, 'copy_media.prom')}}, f)
+
+            CopyMedia(config_file=config_file).execute()
+
+            with open(os.path.join(tmp, 'summary.json')) as f:
+                stages = json.load(f)['stages']
+            self.assertEqual(2, stages['execute']['items'])
+            self.assertEqual(2, stages['match_files']['items'])
+            self.assertEqual(1, stages['move_series']['items'])
+            # within a filesystem the file is renamed, so no bytes are copied
+            self.assertEqual(0, stages['move_series']['bytes'])
+            # no API key, so no requests
+            self.assertNotIn('tmdb.http', stages)
+
+            with open(os.path.join(tmp, 'copy_media.prom')) as f:
+                textfile = f.read()
+            self.assertIn('# TYPE copy_media_stage_seconds_total counter\n', textfile)
+            self.assertIn('copy_media_stage_items_total{stage="move_series"} 1\n', textfile)
+
+    def test_lookup_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            lookups = cache.LookupCache(os.path.join(tmp, cache.CACHE_FILE), max_entries=2)
+            lookups.put('first|2001', True)
+            lookups.put('second|2002', False)
+            lookups.put('third|2003', True)
+
+            self.assertIsNone(lookups.get('first|2001'))
+            self.assertFalse(lookups.get('second|2002'))
+            self.assertTrue(lookups.get('third|2003'))
+            lookups.close()
+
     def test_clean_name(self):
 
         meta = tmdb.clean_name('22 Jump Street 2014 1080p BluRay x265 HEVC 10bit AAC 5.1-LordVako')
@@ -102,9 +735,101 @@ class TestCopyMedia(unittest.TestCase):
         self.assertEqual(3, meta['season'])
         self.assertEqual(2, meta['episode'])
 
+    def test_clean_names(self):
+        batch = ['Brave.2012.1080p.BluRay.x264.AC3-HDChina', 'Planet.Earth.II.S01E06',
+                 'Brave.2012.1080p.BluRay.x264.AC3-HDChina']
+
+        with tempfile.TemporaryDirectory() as tmp:
+            names.set_cache(cache.NameCache(os.path.join(tmp, cache.CACHE_FILE)))
+            try:
+                # small enough threshold that the batch is parsed in a process pool
+                with mock.patch.object(names, 'POOL_THRESHOLD', 2):
+                    parsed = names.clean_names(batch)
+                self.assertEqual(['Brave', 'Planet Earth II', 'Brave'], [meta.title for meta in parsed])
+                self.assertIs(parsed[0], parsed[2])
+                self.assertEqual(2012, parsed[0]['year'])
+                self.assertEqual('HDChina', parsed[0]['group'])
+                self.assertNotIn('year', parsed[1])
+                self.assertEqual(6, parsed[1].get('episode'))
+
+                with self.assertRaises(AttributeError):
+                    parsed[0].title = 'Something Else'
+                # as are lists in any field, such as the episodes of a multi-episode release
+                multi = names.ParsedName('Show.S01E01E02', {'title': 'Show', 'episode': [1, 2], 'language': ['en']})
+                self.assertEqual((1, 2), multi.episode)
+                self.assertEqual(('en',), multi['language'])
+
+                # a new process finds them in the persistent cache rather than parsing them again
+                names.set_cache(cache.NameCache(os.path.join(tmp, cache.CACHE_FILE)))
+                with mock.patch.object(names, 'parse_fields', side_effect=AssertionError('parsed again')):
+                    self.assertEqual(parsed, names.clean_names(batch))
+                    self.assertEqual(parsed[1], tmdb.clean_name('Planet.Earth.II.S01E06'))
+            finally:
+                names.set_cache(None)
+
+    def test_logger(self):
+        self.assertEqual(logger.TRACE, logger.parse_level('trace'))
+        self.assertEqual(logging.INFO, logger.parse_level('INFO'))
+        with self.assertRaises(ValueError):
+            logger.parse_level('LOUD')
+
+        with mock.patch.object(logger, 'CYGWIN', True):
+            self.assertEqual('/cygdrive/z/Shared Videos/Movies', logger.get_path('Z:\\Shared Videos\\Movies'))
+            self.assertEqual('./copy-files.log', logger.get_path('./copy-files.log'))
+
+        root = logging.getLogger()
+        handlers, level, listener = root.handlers, root.level, logger._listener
+        root.handlers = []
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                log_file = os.path.join(tmp, 'copy-files.log')
+                logger.config(log_file, level='INFO')
+                self.assertEqual(logging.INFO, root.level)
+                for i in range(25):
+                    logging.info('Message [%d]', i)
+                    logging.debug('Not logged [%d]', i)
+                for _ in range(100):
+                    with open(log_file) as f:
+                        if 'Message [24]' in f.read():
+                            break
+                    time.sleep(0.01)
+
+                # rotated away, as logrotate would, the file is opened again under its name
+                os.rename(log_file, log_file + '.1')
+                for i in range(25, 50):
+                    logging.info('Message [%d]', i)
+                logger.stop()
+
+                with open(log_file + '.1') as f:
+                    first = f.read()
+                with open(log_file) as f:
+                    last = f.read()
+                self.assertIn('Message [24]', first)
+                self.assertNotIn('Message [25]', first)
+                self.assertIn('Message [25]', last)
+                self.assertIn('Message [49]', last)
+
+                # runs sharing a log file rotate it once it's too big, and only one of them does each time
+                runs = [logger.RotatingFileHandler(log_file, max_bytes=1000, backup_count=2) for _ in range(2)]
+                for i in range(200):
+                    for handler in runs:
+                        handler.emit(logging.makeLogRecord({'msg': 'Rotated [%d]', 'args': (i,)}))
+                for handler in runs:
+                    handler.close()
+                self.assertEqual(['copy-files.log', 'copy-files.log.1', 'copy-files.log.2', 'copy-files.log.lock'],
+                                 sorted(os.listdir(tmp)))
+                for name in ('copy-files.log', 'copy-files.log.1'):
+                    self.assertLess(os.path.getsize(os.path.join(tmp, name)), 1100)
+                with open(log_file) as f:
+                    self.assertEqual(2, f.read().count('Rotated [199]'))
+                self.assertNotIn('Not logged', first + last)
+        finally:
+            root.handlers, logger._listener = handlers, listener
+            root.setLevel(level)
+
     def test_process_configs(self):
         with self.assertRaises(ConfigurationError):
-            CopyMedia(config_file=TEST_CONFIG)
+            CopyMedia(config_file=self.test_config)
 
         scan_path = '/home/test/blah'
         series_path = '/remote/test/series'
@@ -112,24 +837,38 @@ class TestCopyMedia(unittest.TestCase):
         test_file = '/home/test/dir/file'
 
         with self.assertRaises(ConfigurationError):
-            CopyMedia(config_file=TEST_CONFIG, scandir=scan_path)
+            CopyMedia(config_file=self.test_config, scandir=scan_path)
 
         with self.assertRaises(ConfigurationError):
-            CopyMedia(config_file=TEST_CONFIG, seriesdir=series_path)
+            CopyMedia(config_file=self.test_config, seriesdir=series_path)
 
-        c = CopyMedia(config_file=TEST_CONFIG, seriesdir=series_path, file=test_file, moviedir=movie_path)
+        c = CopyMedia(config_file=self.test_config, seriesdir=series_path, file=test_file, moviedir=movie_path)
 
         self.assertEqual(3, len(c.configs['series']))
         self.assertEqual(series_path, c.seriesdir)
 
         self.assertIsNone(c.scandir)
 
-        c = CopyMedia(config_file=TEST_CONFIG, scandir=scan_path, seriesdir=series_path, moviedir=movie_path)
+        c = CopyMedia(config_file=self.test_config, scandir=scan_path, seriesdir=series_path, moviedir=movie_path)
 
         self.assertEqual(scan_path, c.scandir)
 
+        # workers and per device limits must be at least one, or the work waiting for them would never be done
+        self.assertEqual(3, CopyMedia.positive_int({'stripWorkers': 3}, 'stripWorkers', 1))
+        self.assertEqual(1, CopyMedia.positive_int({}, 'stripWorkers', 1))
+        for value in (0, -1, 1.5, '2', True, None):
+            with self.assertRaises(ConfigurationError):
+                CopyMedia.positive_int({'transfersPerDevice': value}, 'transfersPerDevice', 1)
+
+        # rates and timeouts may be fractions, but a rate of zero divides by zero and a timeout of zero never waits
+        self.assertEqual(0.5, CopyMedia.positive_number({'tmdbTimeout': 0.5}, 'tmdbTimeout', 10))
+        self.assertEqual(20, CopyMedia.positive_number({}, 'tmdbRateLimit', 20))
+        for value in (0, -1, -0.5, '2', True, None):
+            with self.assertRaises(ConfigurationError):
+                CopyMedia.positive_number({'stripTimeout': value}, 'stripTimeout', 1)
+
     def test_match_files(self):
-        c = CopyMedia()
+        c = CopyMedia(config_file=self.config_file)
 
         files = ['testFile1', 'testFile2']
 
@@ -143,6 +882,77 @@ class TestCopyMedia(unittest.TestCase):
         self.assertEqual(len(matches), 2)
         self.assertEqual(len(nonmatches), 0)
 
+    def test_series_matcher(self):
+        series = [{'name': 'Slime', 'regex': '(.*)(Tensei Shitara Slime Datta Ken)( - )(\\d{1,})(.*)'},
+                  {'name': 'Slime S2', 'regex': '(.*)(Tensei Shitara Slime Datta Ken 2nd Season)( - )(\\d{1,})(.*)'},
+                  {'name': 'Anything', 'regex': '(?i).*slime.*'}]
+        matcher = SeriesMatcher(series)
+
+        # first configured series to match wins, even when a later one is a closer match
+        self.assertEqual('Slime', matcher.match('[SubsPlease] Tensei Shitara Slime Datta Ken - 05')['name'])
+        self.assertEqual('Slime S2', matcher.match('[Subs] Tensei Shitara Slime Datta Ken 2nd Season - 05')['name'])
+        self.assertEqual('Anything', matcher.match('some SLIME episode')['name'])
+        self.assertIsNone(matcher.match('testFile1'))
+
+        self.assertEqual('World Trigger - ', required_literal(re.compile('(.*)(World Trigger)( - )(\\d{1,})(.*)')))
+        self.assertIsNone(required_literal(re.compile('(?i)(.*)(World Trigger)(.*)')))
+
+    def test_compiled_config(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            config_file = os.path.join(tmp, 'CopyMedia.json')
+            series = [{'name': 'World Trigger', 'regex': '(.*)(World Trigger)( - )(\\d{1,})(.*)'},
+                      {'name': 'Smartphone', 'regex': '(.*)(Isekai wa Smartphone to Tomo ni.)( - )(\\d{1,})(.*)',
+                       'replace': '\\1In Another World With My Smartphone\\3\\g<4>\\5'}]
+            with open(config_file, 'w') as f:
+                json.dump({'series': series}, f)
+
+            compile_config = mock.Mock(side_effect=CopyMedia.compile_config)
+            compiled = configcache.load(config_file, compile_config)
+            self.assertEqual(1, compile_config.call_count)
+
+            # the compiled matcher and templates give the same answers as the configuration
+            name = '[HorribleSubs] Isekai wa Smartphone to Tomo ni. - 01 [1080p].mkv'
+            loaded = configcache.load(config_file, compile_config)
+            self.assertEqual(1, compile_config.call_count)
+            self.assertEqual(series[1], loaded.matcher.match(name))
+            self.assertEqual(re.sub(series[1]['regex'], series[1]['replace'], name),
+                             loaded.matcher.rename(name, loaded.matcher.match(name)))
+            self.assertEqual(compiled.key, loaded.key)
+
+            # it is saved as plain JSON, and compiled again by any other version of the code
+            with open(configcache.compiled_file(config_file)) as f:
+                self.assertEqual({'series': series}, json.load(f)['config'])
+            with mock.patch.object(configcache, 'code_version', return_value='other'):
+                configcache.load(config_file, compile_config)
+            self.assertEqual(2, compile_config.call_count)
+            configcache.load(config_file, compile_config)
+            self.assertEqual(3, compile_config.call_count)
+
+            # touching the file only means its hash is checked again
+            os.utime(config_file, ns=(1, 1))
+            configcache.load(config_file, compile_config)
+            self.assertEqual(3, compile_config.call_count)
+
+            with open(config_file, 'w') as f:
+                json.dump({'series': series[:1]}, f)
+            self.assertEqual(1, len(configcache.load(config_file, compile_config).matcher))
+            self.assertEqual(4, compile_config.call_count)
+
+            # invalid series are never saved
+            with open(config_file, 'w') as f:
+                json.dump({'series': [{'name': 'No Regex'}]}, f)
+            with self.assertRaises(KeyError):
+                configcache.load(config_file, compile_config)
+
+    def test_parse_template(self):
+        pattern = '(.*)(Goblin Slayer)( - )(?P<episode>\\d{1,})(.*)'
+        name = '[HorribleSubs] Goblin Slayer - 03 [1080p].mkv'
+        for replace in ['\\1Goblin Slayer S01E\\4\\5', '\\g<episode> - \\2', 'no groups', '\\1\\\\\\-x\\5']:
+            template = matcher.parse_template(replace)
+            self.assertEqual(re.sub(pattern, replace, name),
+                             re.compile(pattern).sub(lambda match: matcher.expand(match, template), name))
+        self.assertRaises(ValueError, matcher.parse_template, '\\q')
+
     def test_validate_series(self):
 
         # Needs to have a name- regex by itself isn't enough
@@ -164,5 +974,412 @@ class TestCopyMedia(unittest.TestCase):
         self.assertTrue(CopyMedia.validate_series(series))
 
 
+class TestMetadata(unittest.TestCase):
+
+    def test_strip_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, build in [('movie.mp4', test_helpers.synthetic_mp4), ('movie.mkv', test_helpers.synthetic_mkv)]:
+                movie = os.path.join(tmp, name)
+                build(movie, 1000000)
+                with open(movie, 'rb') as f:
+                    before = f.read()
+                self.assertIn(b'GROUP', before)
+                self.assertIn(b'Video Track', before)
+
+                written = metadata.strip_in_place(movie)
+                with open(movie, 'rb') as f:
+                    after = f.read()
+
+                self.assertLess(written, 2000)
+                self.assertEqual(len(before), len(after))
+                self.assertLessEqual(sum(a != b for a, b in zip(before, after)), written)
+                self.assertNotIn(b'GROUP', after)
+                self.assertNotIn(b'Video Track', after)
+
+                # still well formed, with nothing left to strip
+                self.assertEqual(0, metadata.strip_in_place(movie))
+
+    def test_strip_unsupported(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            movie = os.path.join(tmp, 'movie.mp4')
+            with open(os.path.join(TEST_RESOURCES, 'big_file.mp4'), 'rb') as f:
+                original = f.read()
+            with open(movie, 'wb') as f:
+                f.write(original)
+
+            self.assertIsNone(metadata.strip_in_place(movie))
+            with open(movie, 'rb') as f:
+                self.assertEqual(original, f.read())
+
+            # ffmpeg can't make anything of it either, so the original is kept
+            self.assertFalse(CopyMedia.strip_metadata(movie))
+            self.assertEqual(['movie.mp4'], os.listdir(tmp))
+
+    def test_remux(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # stand-in for ffmpeg that writes its output, complains, and then behaves as told
+            ffmpeg = os.path.join(tmp, 'ffmpeg')
+            with open(ffmpeg, 'w') as f:
+                f.write('#!/bin/sh\nfor last; do :; done\necho partial > "$last"\necho "odd stream" >&2\n'
+                        'case "$FAKE_FFMPEG" in fail) exit 1;; hang) exec sleep 5;; esac\n')
+            os.chmod(ffmpeg, 0o755)
+            movie = os.path.join(tmp, 'movie.avi')
+            stripped = os.path.join(tmp, 'movie.out.avi')
+            path = tmp + os.pathsep + os.environ.get('PATH', '')
+
+            with mock.patch.dict(os.environ, {'PATH': path, 'FAKE_FFMPEG': 'ok'}):
+                with self.assertLogs(level='DEBUG') as logs:
+                    self.assertTrue(metadata.remux(movie, stripped))
+                self.assertTrue(os.path.exists(stripped))
+                self.assertIn('odd stream', '\n'.join(logs.output))
+
+            with mock.patch.dict(os.environ, {'PATH': path, 'FAKE_FFMPEG': 'fail'}):
+                with self.assertLogs(level='ERROR') as logs:
+                    self.assertFalse(metadata.remux(movie, stripped))
+                self.assertFalse(os.path.exists(stripped))
+                self.assertIn('exit status [1]: odd stream', '\n'.join(logs.output))
+
+            with mock.patch.dict(os.environ, {'PATH': path, 'FAKE_FFMPEG': 'hang'}):
+                started = time.monotonic()
+                with self.assertLogs(level='ERROR'):
+                    self.assertFalse(metadata.remux(movie, stripped, timeout=0.5))
+                self.assertLess(time.monotonic() - started, 4)
+                self.assertFalse(os.path.exists(stripped))
+
+
+class TestTransfer(unittest.TestCase):
+
+    def test_copy_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source.mkv')
+            with open(source, 'wb') as f:
+                f.write(os.urandom(100000))
+
+            # small chunks so the copy takes several passes
+            destination = os.path.join(tmp, 'destination.mkv')
+            self.assertEqual(100000, transfer.copy_file(source, destination, chunk_size=4096))
+            with open(source, 'rb') as s, open(destination, 'rb') as d:
+                self.assertEqual(s.read(), d.read())
+
+            # a kernel that copies nothing falls back to a buffered copy
+            with mock.patch('os.copy_file_range', return_value=0, create=True), \
+                    mock.patch('os.sendfile', return_value=0, create=True):
+                self.assertEqual(100000, transfer.copy_file(source, destination, chunk_size=4096))
+            with open(source, 'rb') as s, open(destination, 'rb') as d:
+                self.assertEqual(s.read(), d.read())
+
+            # and a short copy never costs the source
+            os.makedirs(os.path.join(tmp, 'library'))
+            with mock.patch.object(transfer, 'kernel_copy', return_value=4096), \
+                    mock.patch.object(transfer, 'device_of', side_effect=lambda p: p.startswith(tmp + '/library')):
+                with self.assertRaises(OSError):
+                    transfer.move(source, os.path.join(tmp, 'library', 'source.mkv'))
+            self.assertEqual(100000, os.path.getsize(source))
+
+    def test_library_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            show_dir = os.path.join(tmp, 'series', 'World Trigger')
+            os.makedirs(show_dir)
+            os.makedirs(os.path.join(tmp, 'movies'))
+            episode = os.path.join(show_dir, 'World Trigger - 01.mkv')
+            test_helpers.write_file(episode, 200000)
+            index_file = os.path.join(tmp, library.INDEX_FILE)
+
+            index = library.LibraryIndex([os.path.join(tmp, 'series'), os.path.join(tmp, 'movies')], index_file)
+            self.assertTrue(index.has_dir(show_dir))
+            self.assertFalse(index.has_dir(os.path.join(tmp, 'series', 'Goblin Slayer')))
+
+            # the same content under another name is found; different content of the same size isn't
+            scan_dir = os.path.join(tmp, 'scan')
+            os.makedirs(scan_dir)
+            shutil.copy(episode, os.path.join(scan_dir, 'World Trigger - 01 (repack).mkv'))
+            with open(os.path.join(scan_dir, 'World Trigger - 02.mkv'), 'wb') as f:
+                f.write(os.urandom(200000))
+            open(os.path.join(scan_dir, 'empty.mkv'), 'w').close()
+            self.assertEqual(episode, index.find(os.path.join(scan_dir, 'World Trigger - 01 (repack).mkv')))
+            self.assertIsNone(index.find(os.path.join(scan_dir, 'World Trigger - 02.mkv')))
+            self.assertIsNone(index.find(os.path.join(scan_dir, 'empty.mkv')))
+
+            # nor is a file differing only away from the samples, such as a fresh copy of a corrupt episode
+            with open(episode, 'rb') as f:
+                content = bytearray(f.read())
+            content[66000] ^= 0xFF
+            with open(os.path.join(scan_dir, 'World Trigger - 01 (fixed).mkv'), 'wb') as f:
+                f.write(content)
+            self.assertEqual(library.sample_hash(episode, 200000),
+                             library.sample_hash(os.path.join(scan_dir, 'World Trigger - 01 (fixed).mkv'), 200000))
+            self.assertIsNone(index.find(os.path.join(scan_dir, 'World Trigger - 01 (fixed).mkv')))
+            os.remove(os.path.join(scan_dir, 'World Trigger - 01 (fixed).mkv'))
+
+            # a file hardlinked into the library is known without reading either file, as is one placed from a
+            # source left in place
+            linked = os.path.join(scan_dir, 'World Trigger - 01 (seeding).mkv')
+            os.link(episode, linked)
+            placed = os.path.join(scan_dir, 'World Trigger - 01 (placed).mkv')
+            shutil.copy2(episode, placed)
+            index.add(episode, placed)
+            with mock.patch.object(library.filecmp, 'cmp', side_effect=AssertionError('compared')):
+                self.assertEqual(episode, index.find(linked))
+                self.assertEqual(episode, index.find(placed))
+            os.remove(linked)
+            os.remove(placed)
+
+            # a run saving after another one keeps what the other one found
+            other = library.LibraryIndex([os.path.join(tmp, 'series'), os.path.join(tmp, 'movies')], index_file)
+            other.makedirs(os.path.join(tmp, 'movies', 'Brave (2012)'))
+            other.save()
+            index.save()
+            saved = library.LibraryIndex([os.path.join(tmp, 'series'), os.path.join(tmp, 'movies')], index_file)
+            saved.load()
+            self.assertIn(os.path.join(tmp, 'movies', 'Brave (2012)'), saved.dirs)
+            self.assertIn(show_dir, saved.dirs)
+            index.invalidate()
+            index.refresh()
+            index.save()
+            self.assertEqual([library.INDEX_FILE, library.INDEX_FILE + atomic.LOCK_SUFFIX, 'movies', 'scan', 'series'],
+                             sorted(os.listdir(tmp)))
+
+            # a later run only lists the directories that have changed
+            index = library.LibraryIndex([os.path.join(tmp, 'series'), os.path.join(tmp, 'movies')], index_file)
+            with mock.patch.object(library.LibraryIndex, 'list', wraps=library.LibraryIndex.list) as listed:
+                index.refresh()
+                self.assertFalse(listed.called)
+
+                test_helpers.write_file(os.path.join(show_dir, 'World Trigger - 03.mkv'), 1000)
+                index.refresh()
+                self.assertEqual(1, listed.call_count)
+
+            # files already in the library are removed from the scan directory rather than moved again
+            c = CopyMedia(config_file=copy_config(self), scandir=scan_dir, seriesdir=os.path.join(tmp, 'series'),
+                          moviedir=os.path.join(tmp, 'movies'))
+            c.library = index
+            plan = c.process_entries(['World Trigger - 01 (repack).mkv', 'World Trigger - 02.mkv'], [])
+            self.assertEqual(['duplicate', 'move'], [step.action for step in plan.steps()])
+            self.assertEqual(['empty.mkv'], os.listdir(scan_dir))
+            self.assertEqual(['World Trigger - 01.mkv', 'World Trigger - 02.mkv', 'World Trigger - 03.mkv'],
+                             sorted(os.listdir(show_dir)))
+            self.assertIsNotNone(index.find(os.path.join(show_dir, 'World Trigger - 02.mkv')))
+
+    def test_placement(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'scan', 'episode.mkv')
+            os.makedirs(os.path.dirname(source))
+            test_helpers.write_file(source, 1000)
+            library = os.path.join(tmp, 'library')
+            os.makedirs(library)
+
+            # on the same filesystem a hard link is placed, and the download is left to keep seeding
+            engine = transfer.TransferEngine(placement=transfer.HARDLINK)
+            result = engine.transfer(source, os.path.join(library, 'linked.mkv'))
+            self.assertEqual((transfer.HARDLINK, 0), (result.method, result.bytes))
+            self.assertTrue(os.path.samefile(source, os.path.join(library, 'linked.mkv')))
+
+            # placing it again finds it already there
+            self.assertIsNone(engine.run([(source, os.path.join(library, 'linked.mkv'))])[0].error)
+
+            # clones are used where the filesystem supports them, otherwise files are copied; either way only
+            # probed once
+            engine = transfer.TransferEngine(placement=transfer.REFLINK)
+            with mock.patch.object(transfer, 'can_reflink', return_value=False) as can_reflink:
+                results = engine.run([(source, os.path.join(library, 'copied.mkv')),
+                                      (source, os.path.join(library, 'copied again.mkv'))])
+            self.assertEqual([(transfer.COPY, 1000)] * 2, [(result.method, result.bytes) for result in results])
+            can_reflink.assert_called_once()
+
+            engine = transfer.TransferEngine(placement=transfer.REFLINK)
+            with mock.patch.object(transfer, 'can_reflink', return_value=True), \
+                    mock.patch.object(transfer, 'reflink', side_effect=shutil.copy2) as reflink:
+                result = engine.transfer(source, os.path.join(library, 'cloned.mkv'))
+            self.assertEqual(transfer.REFLINK, result.method)
+            reflink.assert_called_once_with(source, os.path.join(library, 'cloned.mkv'))
+
+            # moving the file is still the default
+            transfer.TransferEngine().transfer(source, os.path.join(library, 'moved.mkv'))
+            self.assertFalse(os.path.exists(source))
+
+    def test_safe_copy_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source.mkv')
+            destination = os.path.join(tmp, 'destination.mkv')
+            with open(source, 'wb') as f:
+                f.write(os.urandom(100000))
+
+            # die part way through, after the fifth chunk has been written and journaled
+            fsync = os.fsync
+            calls = []
+
+            def failing_fsync(fd):
+                calls.append(fd)
+                if len(calls) > 10:
+                    raise OSError('interrupted')
+                fsync(fd)
+
+            with mock.patch.object(transfer.os, 'fsync', side_effect=failing_fsync):
+                with self.assertRaises(OSError):
+                    transfer.safe_copy_file(source, destination, chunk_size=4096)
+            self.assertFalse(os.path.exists(destination))
+            self.assertTrue(os.path.exists(destination + transfer.PARTIAL_SUFFIX))
+
+            # the next attempt only copies what is left
+            self.assertEqual(100000 - 5 * 4096, transfer.safe_copy_file(source, destination, chunk_size=4096))
+            with open(source, 'rb') as s, open(destination, 'rb') as d:
+                self.assertEqual(s.read(), d.read())
+            self.assertEqual(['destination.mkv', 'source.mkv'], sorted(os.listdir(tmp)))
+
+    def test_engine(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source_dir = os.path.join(tmp, 'scan')
+            dest_dir = os.path.join(tmp, 'library')
+            os.makedirs(os.path.join(source_dir, 'Movie.2019', 'Subs'))
+            os.makedirs(dest_dir)
+            for name in ['a.mkv', 'b.mkv', os.path.join('Movie.2019', 'movie.mkv'),
+                         os.path.join('Movie.2019', 'Subs', 'en.srt')]:
+                with open(os.path.join(source_dir, name), 'wb') as f:
+                    f.write(b'x' * 1000)
+
+            jobs = [(os.path.join(source_dir, name), os.path.join(dest_dir, name))
+                    for name in ['a.mkv', 'b.mkv', 'Movie.2019']]
+
+            results = transfer.TransferEngine(workers=2).run(jobs[:1])
+            self.assertEqual(['rename'], [result.method for result in results])
+
+            # pretend the library is on another device so everything has to be copied
+            with mock.patch.object(transfer, 'device_of', side_effect=lambda p: p.startswith(dest_dir)):
+                results = transfer.TransferEngine(workers=2).run(jobs[1:])
+
+            self.assertEqual(['copy', 'copy'], [result.method for result in results])
+            self.assertEqual([1000, 2000], [result.bytes for result in results])
+            self.assertEqual(['Movie.2019', 'a.mkv', 'b.mkv'], sorted(os.listdir(dest_dir)))
+            self.assertTrue(os.path.isfile(os.path.join(dest_dir, 'Movie.2019', 'Subs', 'en.srt')))
+            self.assertFalse(os.listdir(source_dir))
+
+    def test_run_on_devices(self):
+        lock = threading.Lock()
+        busy = {}
+        most = {}
+
+        def task(index, devices):
+            with lock:
+                for device in devices:
+                    busy[device] = busy.get(device, 0) + 1
+                    most[device] = max(most.get(device, 0), busy[device])
+            time.sleep(0.02)
+            with lock:
+                for device in devices:
+                    busy[device] -= 1
+            return index
+
+        # every task reads from one of two download disks and writes to the same library disk
+        tasks = [(('scan%d' % (i % 2), 'library'), (i, ('scan%d' % (i % 2), 'library'))) for i in range(8)]
+        tasks.append((('other', 'other'), (8, ('other',))))
+        results = transfer.run_on_devices([(devices, lambda args=args: task(*args)) for devices, args in tasks],
+                                          workers=4, per_device=2)
+
+        self.assertEqual(list(range(9)), results)
+        self.assertEqual(2, most['library'])
+        self.assertEqual(1, most['other'])
+        self.assertEqual([], transfer.run_on_devices([]))
+
+
+class TestWatch(unittest.TestCase):
+
+    def test_debouncer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            download = os.path.join(tmp, 'download.mkv')
+            with open(download, 'wb') as f:
+                f.write(b'x')
+
+            debouncer = watch.Debouncer(settle=0.2)
+            debouncer.add(download)
+            debouncer.add(os.path.join(tmp, 'gone.mkv'))
+            self.assertEqual([], debouncer.ready())
+
+            # still being written
+            time.sleep(0.1)
+            with open(download, 'ab') as f:
+                f.write(b'x')
+            self.assertEqual([], debouncer.ready())
+            time.sleep(0.1)
+            self.assertEqual([], debouncer.ready())
+
+            time.sleep(0.2)
+            self.assertEqual([download], debouncer.ready())
+            self.assertFalse(debouncer.pending)
+
+    def test_watcher(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            scan_dir = os.path.join(tmp, 'scan')
+            other_dir = os.path.join(tmp, 'elsewhere')
+            os.makedirs(scan_dir)
+            os.makedirs(other_dir)
+            open(os.path.join(scan_dir, 'already there.mkv'), 'w').close()
+
+            # the first attempt at the flaky file is left to be tried again, as a movie DB timeout would be
+            processed = []
+
+            def process_paths(paths):
+                processed.extend(paths)
+                copy_media.retry.update(os.path.basename(entry) for entry in paths
+                                        if entry.endswith('flaky.mkv') and processed.count(entry) == 1)
+
+            copy_media = mock.Mock(scandir=scan_dir, retry=set())
+            copy_media.process_paths.side_effect = process_paths
+
+            fifo_file = os.path.join(tmp, 'watch.fifo')
+            watcher = watch.Watcher(copy_media, fifo_file=fifo_file, settle=0.1, poll_interval=0.05,
+                                    retry_interval=0.2)
+            thread = threading.Thread(target=watcher.run)
+            thread.start()
+            try:
+                while not os.path.exists(fifo_file):
+                    time.sleep(0.01)
+                time.sleep(0.1)
+
+                with open(os.path.join(scan_dir, 'new episode.mkv'), 'w') as f:
+                    f.write('x')
+                with open(os.path.join(other_dir, 'handed over.mkv'), 'w') as f:
+                    f.write('x')
+                with open(fifo_file, 'w') as fifo:
+                    fifo.write(os.path.join(other_dir, 'handed over.mkv') + '\n')
+                with open(os.path.join(scan_dir, 'flaky.mkv'), 'w') as f:
+                    f.write('x')
+
+                deadline = time.monotonic() + 5
+                while len(processed) < 4 and time.monotonic() < deadline:
+                    time.sleep(0.05)
+            finally:
+                watcher.stop()
+                thread.join()
+
+            self.assertEqual(sorted([os.path.join(scan_dir, 'new episode.mkv'), os.path.join(scan_dir, 'flaky.mkv'),
+                                     os.path.join(scan_dir, 'flaky.mkv'), os.path.join(other_dir, 'handed over.mkv')]),
+                             sorted(processed))
+            self.assertEqual(set(), copy_media.retry)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_json_report(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            benchmark.main(['--files', '20', '--series', '5', '--names', '20', '--lookups', '8', '--tmdb-latency', '0',
+                            '--transfer-files', '2', '--transfer-size', '1', '--media-size', '1', '--repeat', '1',
+                            '--startup-runs', '1', '--index-titles', '100', '--index-lookups', '10', '--dir', tmp,
+                            '--tmpfs', tmp, '--json', output])
+
+            with open(output) as f:
+                report = json.load(f)
+
+        stages = {result['stage']: result for result in report['stages']}
+        for stage in ['match_files', 'execute', 'startup compiled config', 'classify cold cache', 'title index lookup',
+                      'move_series same filesystem', 'strip_metadata mkv disk']:
+            self.assertIn(stage, stages)
+        self.assertEqual(20, stages['match_files']['items'])
+        self.assertEqual(['max', 'p50', 'p90', 'p99'], sorted(stages['classify cold cache']['latency_ms']))
+        self.assertEqual(0, stages['classify warm cache']['tmdb_requests'])
+        self.assertEqual(5, stages['title index lookup']['found'])
+        self.assertEqual(2 * 1024 * 1024, stages['move_series same filesystem']['bytes'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+import json
+import os
+import struct
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import metadata
+import tmdb
+
+
+class StubTmdbServer:
+    """Local stand-in for the movie DB search API. Any query for one of the given titles is a movie.
+
+    The first throttled requests are answered with a 429, queries for any of the slow titles take a second
+    to answer, and every query takes at least delay seconds. Queries for any of the broken titles are answered
+    with the (status, body) given for them."""
+
+    def __init__(self, movies=(), throttled=0, slow=(), delay=0, broken=None):
+        self.movies = set(movies)
+        self.broken = broken or {}
+        self.throttled = throttled
+        self.slow = set(slow)
+        self.delay = delay
+        self.requests = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                if len(stub.requests) <= stub.throttled:
+                    self.send_response(429)
+                    self.send_header('Retry-After', '0.1')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if any(urllib.parse.quote(title) in self.path for title in stub.slow):
+                    time.sleep(1)
+                elif stub.delay:
+                    time.sleep(stub.delay)
+                found = any(urllib.parse.quote(movie) in self.path for movie in stub.movies)
+                status, body = next((answer for title, answer in stub.broken.items()
+                                     if urllib.parse.quote(title) in self.path),
+                                    (200, json.dumps({'total_results': 1 if found else 0}).encode()))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port + tmdb.URL_CONTEXT
+        self.patch = mock.patch.object(tmdb, 'BASE_URL', self.base_url)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.patch.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_file(file_name, size, block=os.urandom(1024 * 1024)):
+    with open(file_name, 'wb') as f:
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+
+
+def synthetic_scan_dir(directory, files):
+    """Create an empty file in the directory for each of the names."""
+
+    os.makedirs(directory, exist_ok=True)
+    for file_name in files:
+        open(os.path.join(directory, file_name), 'w').close()
+
+
+def mp4_atom(atom_type, *children, payload=b''):
+    body = payload + b''.join(children)
+    return struct.pack('>I4s', 8 + len(body), atom_type) + body
+
+
+def synthetic_mp4(file_name, media_size):
+    """Write an MP4 file with a title, a track name and tags, around media_size bytes of (sparse) media data."""
+
+    tags = mp4_atom(b'udta', mp4_atom(b'meta', payload=b'\0' * 4 + b'Some.Movie.2019.1080p.BluRay-GROUP' * 20))
+    track = mp4_atom(b'trak', mp4_atom(b'tkhd', payload=b'\0' * 84), mp4_atom(b'udta', payload=b'Video Track'))
+    moov = mp4_atom(b'moov', mp4_atom(b'mvhd', payload=b'\0' * 100), track, tags)
+
+    with open(file_name, 'wb') as f:
+        f.write(mp4_atom(b'ftyp', payload=b'isom\0\0\2\0isomiso2mp41'))
+        f.write(struct.pack('>I4sQ', 1, b'mdat', 16 + media_size))
+        f.seek(media_size, 1)
+        f.write(moov)
+
+
+def ebml_size(size, length=8):
+    return ((1 << (7 * length)) | size).to_bytes(length, 'big')
+
+
+def mkv_element(element_id, *children, payload=b''):
+    body = payload + b''.join(children)
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big') + ebml_size(len(body)) + body
+
+
+def synthetic_mkv(file_name, media_size):
+    """Write a Matroska file with a title, a track name and tags, around media_size bytes of (sparse) media data."""
+
+    header = mkv_element(metadata.MKV_EBML, mkv_element(0x4282, payload=b'matroska'))
+    info = mkv_element(metadata.MKV_INFO, mkv_element(metadata.MKV_TITLE, payload=b'Some.Movie.2019.1080p-GROUP'),
+                       mkv_element(0x4D80, payload=b'benchmark'))
+    tracks = mkv_element(metadata.MKV_TRACKS,
+                         mkv_element(metadata.MKV_TRACK_ENTRY, mkv_element(0xD7, payload=b'\1'),
+                                     mkv_element(metadata.MKV_TRACK_NAME, payload=b'Video Track')))
+    tags = mkv_element(metadata.MKV_TAGS, mkv_element(0x7373, payload=b'Encoded by GROUP' * 50))
+    cluster_header = (0x1F43B675).to_bytes(4, 'big') + ebml_size(media_size)
+    segment_size = len(info) + len(tracks) + len(cluster_header) + media_size + len(tags)
+
+    with open(file_name, 'wb') as f:
+        f.write(header)
+        f.write((metadata.MKV_SEGMENT).to_bytes(4, 'big') + ebml_size(segment_size))
+        f.write(info + tracks + cluster_header)
+        f.seek(media_size, 1)
+        f.write(tags)
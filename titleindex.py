@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+import argparse
+import bisect
+import gzip
+import hashlib
+import json
+import logging
+import mmap
+import re
+import struct
+import sys
+import unicodedata
+
+import atomic
+import names
+
+INDEX_FILE = 'tmdb-titles.idx'
+
+# The index file is a header followed by the sorted 64 bit hashes of every normalized title, little endian.
+MAGIC = b'CMTI'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+ENTRY = struct.Struct('<Q')
+
+
+def normalize(title):
+    """Title reduced to lower case words without accents or punctuation, so that 'Amélie' matches 'amelie' and
+    'Spider-Man: Homecoming' matches 'Spider Man Homecoming'."""
+
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(c for c in title if not unicodedata.combining(c)).casefold()
+    return ' '.join(re.sub(r'[\W_]+', ' ', title).split())
+
+
+def title_hash(title):
+    return ENTRY.unpack(hashlib.blake2b(normalize(title).encode(), digest_size=ENTRY.size).digest())[0]
+
+
+def export_titles(export_file):
+    """Titles of the movies in a TMDB daily ID export (e.g. movie_ids_05_15_2024.json.gz), which has one JSON
+    object per line. Both the original title and any other title given are used. Adult titles are left out,
+    as they are when searching the movie DB."""
+
+    opener = gzip.open if export_file.endswith('.gz') else open
+    with opener(export_file, 'rt', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping line [%d] of [%s]: not JSON.', number, export_file)
+                continue
+            if record.get('adult'):
+                continue
+            for field in ('original_title', 'title'):
+                if record.get(field):
+                    yield record[field]
+
+
+def build(export_file, index_file=INDEX_FILE):
+    """Build the title index from a TMDB export, returning the number of distinct titles in it."""
+
+    hashes = sorted({title_hash(title) for title in export_titles(export_file)})
+
+    # Replaced in one step, so that a running lookup never sees half an index.
+    content = bytearray(HEADER.pack(MAGIC, VERSION, len(hashes)))
+    for start in range(0, len(hashes), 65536):
+        chunk = hashes[start:start + 65536]
+        content += struct.pack('<%dQ' % len(chunk), *chunk)
+    atomic.write_atomically(index_file, bytes(content))
+
+    logging.info('Built title index [%s] of [%d] titles from [%s]', index_file, len(hashes), export_file)
+    return len(hashes)
+
+
+class TitleIndex:
+    """Movie titles known to the movie DB, answered from an index file without any network access.
+
+    The file is memory mapped and binary searched, so only the few pages a lookup touches are read and the
+    whole index is shared between runs through the page cache. Raises ValueError if the file isn't an index."""
+
+    def __init__(self, index_file=INDEX_FILE):
+        self.index_file = index_file
+        with open(index_file, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < HEADER.size:
+            raise ValueError('Not a title index: %s' % index_file)
+        magic, version, self.count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or len(self.map) != HEADER.size + self.count * ENTRY.size:
+            raise ValueError('Not a title index, or from another version: %s' % index_file)
+        logging.debug('Opened title index [%s] of [%d] titles.', index_file, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        return ENTRY.unpack_from(self.map, HEADER.size + position * ENTRY.size)[0]
+
+    def __contains__(self, title):
+        key = title_hash(title)
+        position = bisect.bisect_left(self, key)
+        return position < self.count and self[position] == key
+
+    def close(self):
+        self.map.close()
+
+
+argParser = argparse.ArgumentParser(description='Build and query the offline index of movie DB titles.')
+subparsers = argParser.add_subparsers(dest='command', required=True)
+
+buildParser = subparsers.add_parser('build', help='Build the index from a TMDB daily movie ID export')
+buildParser.add_argument('export', help='Export file, e.g. movie_ids_05_15_2024.json.gz')
+buildParser.add_argument('index', nargs='?', default=INDEX_FILE, help='Index file to write')
+
+lookupParser = subparsers.add_parser('lookup', help='Look up release names or titles in the index')
+lookupParser.add_argument('index', help='Index file to read')
+lookupParser.add_argument('names', nargs='+', help='Release names or titles')
+
+
+def main(argv=None):
+    args = argParser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.command == 'build':
+        build(args.export, args.index)
+        return 0
+
+    index = TitleIndex(args.index)
+    found = True
+    for name in args.names:
+        title = names.parse(name)['title']
+        print('%s\t%s\t%s' % ('movie' if title in index else '-', normalize(title), name))
+        found = found and title in index
+    index.close()
+    return 0 if found else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
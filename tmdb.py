@@ -1,11 +1,16 @@
 import json
 import logging
+import threading
+import time
 import urllib
-import PTN
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import logger
+import metrics
+import names
 
 URL_CONTEXT = '/3/search/movie?api_key=API_KEY&include_adult=false&query=QUERY_STRING'
 YEAR_BASE = '&year='
@@ -13,24 +18,106 @@ DNS_NAME = 'api.themoviedb.org'
 PROTOCOL = 'https://'
 BASE_URL = PROTOCOL + DNS_NAME + URL_CONTEXT
 
+# Defaults for querying the movie DB: seconds before giving up on a response, size of the worker pool for
+# batch lookups, requests per second across all workers, and attempts when the movie DB answers with a 429.
+TIMEOUT = 10
+WORKERS = 4
+RATE_LIMIT = 20
+ATTEMPTS = 4
+BACKOFF = 1
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+
+class RateLimiter:
+    """Spaces requests out so that no more than rate of them start each second, across all threads."""
+
+    def __init__(self, rate=RATE_LIMIT):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the caller may send its next request."""
+
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Hold back every caller for the given number of seconds, e.g. when the server asks us to slow down."""
+
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+def get_session(workers=None):
+    """Shared keep-alive session, so that consecutive queries reuse the same connections.
+
+    Its connection pool keeps two connections for each of the workers using it (by default, WORKERS of them),
+    and is made bigger if more workers are given later, so that no worker's connection is thrown away."""
+
+    global _session, _session_pool_size
+    pool_size = (workers or WORKERS) * 2
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+            _session_pool_size = pool_size
+        return _session
+
 
 def clean_name(name):
-    """Used to parse the name of the media so that the title and year can be sent in an API query"""
+    """Used to parse the name of the media so that the title and year can be sent in an API query.
+
+    Returns an immutable ParsedName, which can be indexed by field name like the dict PTN returns."""
 
     logging.log(logger.TRACE, 'Raw name: [%s]', name)
 
-    meta = PTN.parse(name)
+    meta = names.parse(name)
     logging.log(logger.TRACE, 'Parsed meta-data: [%s]', meta)
 
     logging.debug('Parsed title: [%s]', meta['title'])
     return meta
 
 
-def is_movie(name, api_key):
+def cache_key(meta):
+    """Key used to remember the answer for a parsed name: the lower cased title and the year."""
+
+    return '%s|%s' % (meta['title'].lower(), meta.get('year', ''))
+
+
+def is_movie(name, api_key, cache=None, limiter=None, timeout=TIMEOUT, index=None, fallback=False):
     """Look up the name of the media in question in The Movie DB to determine if this media
-       is a movie or not."""
+       is a movie or not.
+
+       If a TitleIndex is provided, the title is looked up in it first, without any network access. Titles
+       that aren't in the index are only looked up in the movie DB if fallback is set.
+
+       If a LookupCache is provided, it is checked before sending the query and any definitive
+       answer from the movie DB is stored in it. If the movie DB can't be reached in time, or keeps
+       asking us to slow down, None is returned instead of an answer: the media is treated as not being
+       a movie for now, but nothing is cached, so it will be looked up again on the next run."""
+
+    with metrics.stage('tmdb.is_movie') as timer:
+        timer.add(items=1)
+        return lookup(name, api_key, cache, limiter, timeout, index, fallback)
+
 
-    if api_key is None:
+def lookup(name, api_key, cache, limiter, timeout, index=None, fallback=False):
+    if api_key is None and index is None:
         logging.warning("Can't query tmdb because no api key was specified.")
         return False
 
@@ -59,21 +146,108 @@ def is_movie(name, api_key):
                           meta['season'], meta['episode'])
             return False
 
+        if index is not None:
+            if meta['title'] in index:
+                logging.debug('Found [%s] in the title index.', meta['title'])
+                return True
+            if not fallback or api_key is None:
+                logging.debug('[%s] is not in the title index.', meta['title'])
+                return False
+
+        if cache is not None:
+            key = cache_key(meta)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+
         logging.debug('Sending query to [%s] TMDB with URL: [%s]', DNS_NAME, url)
 
         url = url.replace('API_KEY', api_key)
 
-        r = requests.get(url)
+        r = get(url, limiter, timeout)
+        if r is None:
+            return None
 
         logging.debug('TMDB GET status: [%s] with reason: [%s]',
                       r.status_code, r.reason)
-        logging.log(logger.TRACE, 'Results: [%s]', r.text)
 
-        if r.text:
-            result = json.loads(r.text)
-            num_results = result['total_results']
-            logging.debug('Number of results found: [%d]', num_results)
-            if result['total_results'] > 0:
-                return True
+        try:
+            num_results = json.loads(r.text)['total_results']
+        except (ValueError, KeyError, TypeError):
+            logging.warning('TMDB answered [%s] with something unexpected; will retry on a later run.', name)
+            return None
+        logging.debug('Number of results found: [%d]', num_results)
+        found = num_results > 0
+
+        # Only remember actual answers, not failed requests.
+        if cache is not None:
+            cache.put(key, found)
+
+        return found
+
+
+def get(url, limiter=None, timeout=TIMEOUT):
+    """Send a GET through the shared session, backing off and retrying if the movie DB answers 429.
+
+    Returns None if the request timed out, failed, was answered with any other status than 200, or was still
+    being rate limited after all attempts."""
+
+    for attempt in range(ATTEMPTS):
+        if limiter is not None:
+            limiter.wait()
+
+        try:
+            with metrics.stage('tmdb.http') as timer:
+                r = get_session().get(url, timeout=timeout)
+                timer.add(items=1, bytes=len(r.content))
+        except requests.exceptions.Timeout:
+            logging.warning('TMDB query timed out after [%s] seconds; will retry on a later run.', timeout)
+            return None
+        except requests.exceptions.RequestException:
+            logging.exception('TMDB query failed; will retry on a later run.')
+            return None
+
+        if r.status_code == 200:
+            return r
+        if r.status_code != 429:
+            logging.warning('TMDB query failed with status [%s]: [%s]; will retry on a later run.',
+                            r.status_code, r.reason)
+            return None
+
+        try:
+            delay = float(r.headers.get('Retry-After', ''))
+        except ValueError:
+            delay = BACKOFF * 2 ** attempt
+        logging.info('TMDB rate limit hit; backing off for [%s] seconds.', delay)
+        if limiter is not None:
+            limiter.pause(delay)
+        else:
+            time.sleep(delay)
 
-        return False
+    logging.warning('TMDB still rate limiting after [%d] attempts; will retry on a later run.', ATTEMPTS)
+    return None
+
+
+def classify(candidates, api_key, cache=None, workers=WORKERS, rate_limit=RATE_LIMIT, timeout=TIMEOUT, index=None,
+             fallback=False):
+    """Determine which of the candidate names are movies, running the lookups on a bounded pool of workers.
+
+    Returns a dict of each name to whether it is a movie, or None if that couldn't be determined this time.
+    All workers share one keep-alive session and together send no more than rate_limit requests per second."""
+
+    candidates = list(dict.fromkeys(candidates))
+    if not candidates:
+        return {}
+
+    # Parse all the names up front as one batch, so the lookups find them already parsed.
+    names.clean_names(candidates)
+
+    limiter = RateLimiter(rate_limit)
+    get_session(workers)
+    logging.debug('Classifying [%d] names with [%d] workers at up to [%s] requests per second.',
+                  len(candidates), workers, rate_limit)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(candidates)))) as executor:
+        answers = executor.map(lambda name: is_movie(name, api_key, cache, limiter, timeout, index=index,
+                                                     fallback=fallback), candidates)
+        return dict(zip(candidates, answers))
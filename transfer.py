@@ -0,0 +1,517 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import path
+
+# Defaults for moving media: concurrent transfers overall, concurrent transfers onto any one device, and the
+# number of bytes handed to the kernel (or read and written) at a time when copying across devices.
+WORKERS = 4
+PER_DEVICE = 1
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Errors meaning the kernel can't do this particular copy for us, so we should fall back to something simpler.
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM,
+               errno.EBADF}
+
+# Modes of copying across devices: straight to the destination name as quickly as possible, or via a
+# verified, resumable temporary file.
+FAST = 'fast'
+SAFE = 'safe'
+MODES = (FAST, SAFE)
+
+# Ways of placing media in the library: move it there, or leave it where it is (e.g. so it keeps seeding) and
+# place a hard link to it or a reflink clone of it. A clone shares the file's data but is changed independently.
+MOVE = 'move'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+PLACEMENTS = (MOVE, HARDLINK, REFLINK)
+
+# Placed by copying, when the source can be neither linked to nor cloned.
+COPY = 'copy'
+
+# ioctl which clones all of one file's extents into another, from linux/fs.h.
+FICLONE = 0x40049409
+
+PARTIAL_SUFFIX = '.partial'
+JOURNAL_SUFFIX = '.partial.journal'
+
+TransferResult = namedtuple('TransferResult', ['source', 'destination', 'bytes', 'seconds', 'method', 'error'])
+
+
+def existing_ancestor(file_path):
+    """The absolute path if it exists, otherwise the nearest of its ancestors that does."""
+
+    file_path = path.abspath(file_path)
+    while not path.exists(file_path):
+        parent = path.dirname(file_path)
+        if parent == file_path:
+            break
+        file_path = parent
+    return file_path
+
+
+def device_of(file_path):
+    """Device id of the filesystem the path is (or would be) on, found from its nearest existing ancestor."""
+
+    return os.stat(existing_ancestor(file_path)).st_dev
+
+
+def run_in_lanes(tasks, workers=WORKERS, per_device=PER_DEVICE):
+    """Call each of the (device, function) tasks on a pool of workers, returning the results in the same order.
+
+    Each device's tasks are split into per_device lanes which are worked through one task at a time, so no
+    device has more than per_device tasks running at once, while tasks for different devices run side by side."""
+
+    tasks = list(tasks)
+    if not tasks:
+        return []
+
+    lanes = {}
+    for index, (device, function) in enumerate(tasks):
+        device_lanes = lanes.setdefault(device, [[] for _ in range(per_device)])
+        min(device_lanes, key=len).append(index)
+    lanes = [lane for device_lanes in lanes.values() for lane in device_lanes if lane]
+
+    logging.debug('Running [%d] tasks in [%d] lanes with [%d] workers.', len(tasks), len(lanes), workers)
+
+    results = [None] * len(tasks)
+
+    def work(lane):
+        for index in lane:
+            results[index] = tasks[index][1]()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(lanes)))) as executor:
+        list(executor.map(work, lanes))
+
+    return results
+
+
+def run_on_devices(tasks, workers=WORKERS, per_device=PER_DEVICE):
+    """Call each of the (devices, function) tasks on a pool of workers, returning the results in the same order.
+
+    A task uses every one of its devices (e.g. the one it reads from and the one it writes to) while it runs, and
+    no device is used by more than per_device tasks at once. Tasks are started in order, each as soon as there is
+    a free worker and all of its devices are free, so a task waiting on a busy device doesn't hold up the others."""
+
+    tasks = [(set(devices), function) for devices, function in tasks]
+    results = [None] * len(tasks)
+    if not tasks:
+        return results
+
+    logging.debug('Running [%d] tasks with [%d] workers, [%d] per device.', len(tasks), workers, per_device)
+
+    pending = list(range(len(tasks)))
+    busy = {}
+    running = [0]
+    changed = threading.Condition()
+
+    def work(index):
+        try:
+            results[index] = tasks[index][1]()
+        finally:
+            with changed:
+                for device in tasks[index][0]:
+                    busy[device] -= 1
+                running[0] -= 1
+                changed.notify()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(tasks)))) as executor:
+        futures = []
+        with changed:
+            while pending:
+                ready = None
+                if running[0] < workers:
+                    ready = next((index for index in pending
+                                  if all(busy.get(device, 0) < per_device for device in tasks[index][0])), None)
+                if ready is None:
+                    changed.wait()
+                    continue
+
+                pending.remove(ready)
+                for device in tasks[ready][0]:
+                    busy[device] = busy.get(device, 0) + 1
+                running[0] += 1
+                futures.append(executor.submit(work, ready))
+
+        for future in futures:
+            future.result()
+
+    return results
+
+
+def kernel_copy(fsrc, fdst, size, chunk_size=CHUNK_SIZE):
+    """Copy size bytes between the file descriptors without passing them through user space.
+
+    Tries copy_file_range, then sendfile. Returns the number of bytes copied, or None if neither is
+    supported for these files, or neither copied anything (as copy_file_range does on some filesystems)."""
+
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+
+        copied = 0
+        try:
+            while copied < size:
+                if method == 'copy_file_range':
+                    sent = os.copy_file_range(fsrc, fdst, min(chunk_size, size - copied))
+                else:
+                    sent = os.sendfile(fdst, fsrc, copied, min(chunk_size, size - copied))
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as e:
+            if copied or e.errno not in UNSUPPORTED:
+                raise
+            logging.debug('[%s] not supported for this copy: [%s]', method, e)
+            continue
+
+        if copied or not size:
+            return copied
+        logging.debug('[%s] copied nothing of [%d] bytes; trying another way.', method, size)
+
+    return None
+
+
+def copy_file(source, destination, chunk_size=CHUNK_SIZE):
+    """Copy a single file using the kernel where possible, otherwise a large buffer. Returns the bytes copied.
+
+    Raises OSError if the bytes copied don't add up to the size of the source, so it is never removed after a
+    short copy."""
+
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = kernel_copy(fsrc.fileno(), fdst.fileno(), size, chunk_size)
+
+        if copied is None:
+            copied = 0
+            buffer = bytearray(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                read = fsrc.readinto(buffer)
+                if not read:
+                    break
+                fdst.write(view[:read])
+                copied += read
+
+    if copied != size:
+        raise OSError('Copied %d of %d bytes of %s to %s' % (copied, size, source, destination))
+
+    shutil.copystat(source, destination)
+    return copied
+
+
+def safe_copy_file(source, destination, chunk_size=CHUNK_SIZE):
+    """Copy a single file so that a crash can never leave a truncated file under the destination name.
+
+    The data is written to a temporary file next to the destination. Each chunk is hashed as it is copied
+    and, once it has been flushed to disk, its offset and digest are recorded in a journal alongside. When
+    the copy is complete and its size verified, the temporary file is atomically renamed into place. The data
+    is only read once: each chunk is hashed from the buffer it was copied through.
+
+    If an earlier copy of the same source was interrupted, it is resumed from the last chunk recorded in the
+    journal, after checking that chunk still has the recorded digest. Returns the number of bytes copied."""
+
+    partial = destination + PARTIAL_SUFFIX
+    journal_file = destination + JOURNAL_SUFFIX
+
+    stat = os.stat(source)
+    header = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'chunk': chunk_size}
+    offset, digests = resume_point(partial, journal_file, header)
+
+    if digests:
+        logging.info('Resuming copy of [%s] to [%s] from offset [%d]', source, destination, offset)
+    else:
+        with open(journal_file, 'w') as journal:
+            journal.write(json.dumps(header) + '\n')
+
+    copied = 0
+    with open(source, 'rb') as fsrc, open(partial, 'r+b' if digests else 'wb') as fdst, \
+            open(journal_file, 'a') as journal:
+        fsrc.seek(offset)
+        fdst.truncate(offset)
+        fdst.seek(offset)
+
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            read = fsrc.readinto(buffer)
+            if not read:
+                break
+            fdst.write(view[:read])
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+            digest = hashlib.blake2b(view[:read], digest_size=16).hexdigest()
+            digests.append(digest)
+            journal.write('%d %s\n' % (offset + read, digest))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+            offset += read
+            copied += read
+
+        size = os.fstat(fdst.fileno()).st_size
+
+    if size != stat.st_size or os.stat(source).st_mtime_ns != stat.st_mtime_ns:
+        raise IOError('Copy of [%s] is [%d] bytes, expected [%d]; source may have changed.'
+                      % (source, size, stat.st_size))
+
+    shutil.copystat(source, partial)
+    os.replace(partial, destination)
+    sync_dir(path.dirname(destination))
+    os.remove(journal_file)
+
+    checksum = hashlib.blake2b(''.join(digests).encode(), digest_size=16).hexdigest()
+    logging.debug('Verified [%s]: [%d] bytes, checksum [%s]', destination, size, checksum)
+    return copied
+
+
+def resume_point(partial, journal_file, header):
+    """Offset to resume an interrupted copy from and the digests of the chunks before it.
+
+    Returns an offset of 0 and no digests if there is nothing that can be resumed."""
+
+    if not path.exists(partial) or not path.exists(journal_file):
+        return 0, []
+
+    with open(journal_file) as journal:
+        lines = journal.read().splitlines()
+
+    try:
+        if json.loads(lines[0]) != header:
+            logging.info('Source has changed since [%s] was started; starting again.', partial)
+            return 0, []
+        # a crash while writing the journal can leave a partial last line
+        checkpoints = [line.split() for line in lines[1:]]
+        checkpoints = [(int(parts[0]), parts[1]) for parts in checkpoints if len(parts) == 2 and len(parts[1]) == 32]
+    except (ValueError, IndexError):
+        logging.info('Journal [%s] is unreadable; starting again.', journal_file)
+        return 0, []
+
+    if not checkpoints:
+        return 0, []
+
+    # Only whole chunks in order can be resumed from; anything else means the journal can't be trusted.
+    chunk_size = header['chunk']
+    offsets = [min(chunk_size * (i + 1), header['size']) for i in range(len(checkpoints))]
+    if offsets != [offset for offset, digest in checkpoints] or path.getsize(partial) < offsets[-1]:
+        logging.info('Journal [%s] does not match [%s]; starting again.', journal_file, partial)
+        return 0, []
+
+    start = (len(offsets) - 1) * chunk_size
+    with open(partial, 'rb') as f:
+        f.seek(start)
+        if hashlib.blake2b(f.read(offsets[-1] - start), digest_size=16).hexdigest() != checkpoints[-1][1]:
+            logging.info('Last chunk of [%s] does not match the journal; starting again.', partial)
+            return 0, []
+
+    return offsets[-1], [digest for offset, digest in checkpoints]
+
+
+def sync_dir(dir_path):
+    """Flush a directory's entries to disk so that a rename within it survives a crash."""
+
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def move(source, destination, chunk_size=CHUNK_SIZE, mode=FAST):
+    """Move a file or directory, renaming it if it stays on the same filesystem and copying it otherwise.
+
+    In safe mode, files are copied with safe_copy_file and the source is only removed once every file
+    has been verified and renamed into place."""
+
+    start = time.perf_counter()
+
+    if device_of(source) == device_of(path.dirname(destination)):
+        os.rename(source, destination)
+        return TransferResult(source, destination, 0, time.perf_counter() - start, 'rename', None)
+
+    copied = [0]
+    copy_function = safe_copy_file if mode == SAFE else copy_file
+
+    def copy(src, dst):
+        copied[0] += copy_function(src, dst, chunk_size)
+        return dst
+
+    if path.isdir(source):
+        # an interrupted safe copy of a directory leaves it partly populated, so carry on filling it in
+        shutil.copytree(source, destination, copy_function=copy, dirs_exist_ok=mode == SAFE)
+        shutil.rmtree(source)
+    else:
+        copy(source, destination)
+        os.remove(source)
+
+    return TransferResult(source, destination, copied[0], time.perf_counter() - start,
+                          'safe copy' if mode == SAFE else 'copy', None)
+
+
+def reflink(source, destination):
+    """Clone a file by sharing its extents, so no data is copied. Raises OSError if the filesystem can't."""
+
+    try:
+        with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if path.exists(destination):
+            os.remove(destination)
+        raise
+
+    shutil.copystat(source, destination)
+
+
+def can_reflink(source_dir, destination_dir):
+    """Probe whether files in the source directory can be cloned into the destination directory.
+
+    This can be true even across devices, e.g. between btrfs subvolumes."""
+
+    try:
+        with tempfile.NamedTemporaryFile(dir=existing_ancestor(source_dir), prefix='.reflink-probe-') as probe:
+            probe.write(b'probe')
+            probe.flush()
+            clone = path.join(existing_ancestor(destination_dir), path.basename(probe.name))
+            reflink(probe.name, clone)
+            os.remove(clone)
+        return True
+    except OSError as e:
+        logging.debug('Files can\'t be cloned from [%s] to [%s]: %s', source_dir, destination_dir, e)
+        return False
+
+
+def placed(source, destination):
+    """True if the destination already holds the source file, as a link to it or as a finished copy or clone."""
+
+    try:
+        dst = os.stat(destination)
+    except FileNotFoundError:
+        return False
+
+    # Copies and clones only get the source's modification time once they are complete.
+    src = os.stat(source)
+    return path.samestat(src, dst) or (src.st_size == dst.st_size and src.st_mtime_ns == dst.st_mtime_ns)
+
+
+def place(source, destination, method, chunk_size=CHUNK_SIZE, mode=FAST):
+    """Place a file or directory at the destination, leaving the source where it is, by the given method:
+    HARDLINK, REFLINK or COPY.
+
+    Files already placed, e.g. by an earlier run, are left as they are."""
+
+    start = time.perf_counter()
+    copied = [0]
+    copy_function = safe_copy_file if mode == SAFE else copy_file
+
+    def copy(src, dst):
+        if placed(src, dst):
+            logging.debug('[%s] is already placed at [%s]', src, dst)
+        elif method == HARDLINK:
+            os.link(src, dst)
+        elif method == REFLINK:
+            reflink(src, dst)
+        else:
+            copied[0] += copy_function(src, dst, chunk_size)
+        return dst
+
+    if path.isdir(source):
+        shutil.copytree(source, destination, copy_function=copy, dirs_exist_ok=True)
+    else:
+        copy(source, destination)
+
+    return TransferResult(source, destination, copied[0], time.perf_counter() - start, method, None)
+
+
+class TransferEngine:
+    """Runs moves on a pool of workers.
+
+    Moves are grouped by the device they are going to. Each device only gets per_device moves at a time so
+    concurrent copies don't fight over the same disks, while moves to different devices run side by side.
+
+    With a placement other than MOVE, sources are left in place and linked or cloned to their destinations
+    instead. How is worked out once for each pair of source and destination devices."""
+
+    def __init__(self, workers=WORKERS, per_device=PER_DEVICE, chunk_size=CHUNK_SIZE, mode=FAST, placement=MOVE):
+        self.workers = workers
+        self.per_device = per_device
+        self.chunk_size = chunk_size
+        self.mode = mode
+        self.placement = placement
+        self.methods = {}
+        self.lock = threading.Lock()
+
+    def method(self, source, destination, placement=None, probe=True):
+        """How the source is placed at the destination with a placement that leaves the source in place:
+        HARDLINK, REFLINK or, failing those, COPY. A hard link is only tried when asked for, since changing the
+        placed file then changes the source too.
+
+        Finding out whether files can be cloned writes a probe file to each directory. Without probing (e.g. in
+        a dry run), a method not already found out is assumed to be a COPY unless a hard link can be made."""
+
+        placement = placement or self.placement
+        devices = placement, device_of(source), device_of(path.dirname(destination))
+        with self.lock:
+            method = self.methods.get(devices)
+            if method is None:
+                if placement == HARDLINK and devices[1] == devices[2]:
+                    method = HARDLINK
+                elif not probe:
+                    return COPY
+                elif can_reflink(path.dirname(source), path.dirname(destination)):
+                    method = REFLINK
+                else:
+                    method = COPY
+                logging.info('Placing files from [%s] in [%s] by %s.', path.dirname(source), path.dirname(destination),
+                             method)
+                self.methods[devices] = method
+        return method
+
+    def run(self, jobs, placement=None):
+        """Move each (source, destination) pair, returning a TransferResult for each in the same order.
+
+        A failed move doesn't stop the others; its result carries the exception instead. The placement
+        overrides the engine's own."""
+
+        return run_in_lanes(((device_of(path.dirname(destination)),
+                              partial(self.transfer, source, destination, placement))
+                             for source, destination in jobs), self.workers, self.per_device)
+
+    def transfer(self, source, destination, placement=None):
+        """Move (or place) a single file or directory, logging how long it took and the throughput achieved."""
+
+        placement = placement or self.placement
+        verb = 'moved' if placement == MOVE else 'placed'
+        logging.debug('Moving [%s] to [%s] (%s)...', source, destination, placement)
+        try:
+            if placement == MOVE:
+                result = move(source, destination, self.chunk_size, self.mode)
+            else:
+                result = place(source, destination, self.method(source, destination, placement), self.chunk_size,
+                               self.mode)
+        except Exception as e:
+            logging.exception('Failed to move [%s] to [%s]', source, destination)
+            return TransferResult(source, destination, 0, 0, None, e)
+
+        if result.bytes and result.seconds:
+            logging.info('Successfully %s [%s] to [%s] by %s: [%d] bytes in [%.2f] seconds ([%.1f] MB/s)',
+                         verb, source, destination, result.method, result.bytes, result.seconds,
+                         result.bytes / result.seconds / 1000000)
+        else:
+            logging.info('Successfully %s [%s] to [%s] by %s', verb, source, destination, result.method)
+        return result
@@ -0,0 +1,292 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import selectors
+import stat
+import struct
+import threading
+import time
+from os import path
+
+import logger
+
+# Seconds an entry must go unchanged before it is considered completely written, and how often to check.
+SETTLE = 10
+POLL_INTERVAL = 1
+
+# Created next to the configuration file unless configured otherwise.
+FIFO_FILE = 'copy-media.fifo'
+
+# Seconds before entries that couldn't be processed (e.g. the movie DB timed out, or there was no room for them)
+# are tried again.
+RETRY_INTERVAL = 15 * 60
+
+# Directories in the scan directory which are never processed.
+IGNORED = {'tmp'}
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal binding to the Linux inotify API, reporting the names created or changed within a directory."""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed for ' + directory)
+
+        self.directory = directory
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Names from all the events waiting to be read. None in the list means events were lost."""
+
+        names = []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                names.append(None)
+            elif name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Debouncer:
+    """Holds back paths until they have stopped changing for settle seconds.
+
+    A file is considered to be changing while its size or modification time changes. A directory is
+    considered to be changing while any of the files within it are."""
+
+    def __init__(self, settle=SETTLE):
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, entry):
+        if entry not in self.pending:
+            logging.debug('Waiting for [%s] to settle.', entry)
+        self.pending[entry] = (None, time.monotonic())
+
+    def ready(self):
+        """Remove and return the pending paths that have settled. Paths which have disappeared are dropped."""
+
+        now = time.monotonic()
+        settled = []
+        for entry, (last, since) in list(self.pending.items()):
+            current = signature(entry)
+            if current is None:
+                logging.debug('[%s] disappeared before it settled.', entry)
+                del self.pending[entry]
+            elif current != last:
+                self.pending[entry] = (current, now)
+            elif now - since >= self.settle:
+                settled.append(entry)
+                del self.pending[entry]
+        return settled
+
+
+def signature(entry):
+    """Summary of a file or directory tree which changes whenever anything within it is written to."""
+
+    try:
+        st = os.stat(entry)
+    except FileNotFoundError:
+        return None
+
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size, st.st_mtime_ns
+
+    total = count = 0
+    latest = st.st_mtime_ns
+    for parent, dirs, files in os.walk(entry):
+        for name in files:
+            try:
+                st = os.stat(path.join(parent, name))
+            except FileNotFoundError:
+                continue
+            total += st.st_size
+            count += 1
+            latest = max(latest, st.st_mtime_ns)
+    return total, count, latest
+
+
+class Watcher:
+    """Long running alternative to launching the script once per finished download.
+
+    New entries in the scan directory are found with inotify (or by polling the directory where inotify
+    isn't available). Paths can also be handed over by writing them, one per line, to a FIFO; this lets a
+    download client's completion hook pass on a path without starting a new interpreter. Once an entry has
+    stopped changing it is processed by the CopyMedia instance, which keeps its configuration in memory.
+
+    Entries the CopyMedia instance leaves to be tried again are processed again once retry_interval seconds
+    have passed."""
+
+    def __init__(self, copy_media, fifo_file=FIFO_FILE, settle=SETTLE, poll_interval=POLL_INTERVAL,
+                 retry_interval=RETRY_INTERVAL):
+        self.copy_media = copy_media
+        self.scandir = copy_media.scandir
+        self.fifo_file = fifo_file
+        self.debouncer = Debouncer(settle)
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.retrying = set()
+        self.retry_at = None
+        self.stopped = threading.Event()
+
+        self.inotify = None
+        self.fifo = None
+        self.known = set()
+        self.fifo_buffer = b''
+
+    def run(self):
+        """Process entries as they arrive, until stop is called."""
+
+        selector = selectors.DefaultSelector()
+
+        if self.scandir:
+            try:
+                self.inotify = Inotify(self.scandir)
+                selector.register(self.inotify, selectors.EVENT_READ, self.read_inotify)
+                logging.info('Watching [%s] with inotify.', self.scandir)
+            except (OSError, AttributeError, TypeError):
+                logging.info('inotify not available; polling [%s] every [%s] seconds.',
+                             self.scandir, self.poll_interval)
+            self.known = set(self.list_scandir())
+            # left over from the full scan before watching
+            self.schedule_retry([path.join(self.scandir, name) for name in self.copy_media.retry])
+
+        if self.fifo_file:
+            self.fifo = open_fifo(self.fifo_file)
+            selector.register(self.fifo, selectors.EVENT_READ, self.read_fifo)
+            logging.info('Accepting paths on FIFO [%s].', self.fifo_file)
+
+        try:
+            while not self.stopped.is_set():
+                for key, events in selector.select(self.poll_interval):
+                    key.data()
+
+                if self.scandir and self.inotify is None:
+                    self.poll_scandir()
+
+                if self.retrying and time.monotonic() >= self.retry_at:
+                    logging.info('Trying [%s] again.', sorted(self.retrying))
+                    for entry in self.retrying:
+                        self.debouncer.add(entry)
+                    self.retrying = set()
+
+                settled = self.debouncer.ready()
+                if settled:
+                    self.process(settled)
+        finally:
+            selector.close()
+            if self.inotify is not None:
+                self.inotify.close()
+            if self.fifo is not None:
+                os.close(self.fifo)
+
+    def stop(self):
+        self.stopped.set()
+
+    def process(self, paths):
+        logging.info('Processing settled entries: [%s]', paths)
+        try:
+            self.copy_media.process_paths(paths)
+        except Exception:
+            # keep watching; the entries are tried again after the retry interval
+            logging.exception('Error processing [%s].', paths)
+            self.schedule_retry(paths)
+            return
+        self.schedule_retry([entry for entry in paths if path.basename(entry) in self.copy_media.retry])
+
+    def schedule_retry(self, paths):
+        """Process the paths again after the retry interval. The CopyMedia instance's own record of entries to
+        retry is handled with them, so it is cleared."""
+
+        self.copy_media.retry.clear()
+        if not paths:
+            return
+        logging.info('Trying [%s] again in [%s] seconds.', paths, self.retry_interval)
+        if not self.retrying:
+            self.retry_at = time.monotonic() + self.retry_interval
+        self.retrying.update(paths)
+
+    def list_scandir(self):
+        try:
+            return [name for name in os.listdir(self.scandir) if name not in IGNORED]
+        except FileNotFoundError:
+            logging.warning('Scan directory [%s] does not exist.', self.scandir)
+            return []
+
+    def poll_scandir(self):
+        current = set(self.list_scandir())
+        for name in current - self.known:
+            self.debouncer.add(path.join(self.scandir, name))
+        self.known = current
+
+    def read_inotify(self):
+        for name in self.inotify.read():
+            if name is None:
+                logging.warning('inotify events were lost; re-scanning [%s].', self.scandir)
+                self.known = set()
+                self.poll_scandir()
+            elif name not in IGNORED:
+                logging.log(logger.TRACE, 'inotify event for [%s]', name)
+                self.debouncer.add(path.join(self.scandir, name))
+
+    def read_fifo(self):
+        try:
+            data = os.read(self.fifo, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        lines = (self.fifo_buffer + data).split(b'\n')
+        self.fifo_buffer = lines.pop()
+        for line in lines:
+            entry = os.fsdecode(line.strip())
+            if entry:
+                logging.info('Received [%s] on FIFO.', entry)
+                self.debouncer.add(path.abspath(entry))
+
+
+def open_fifo(fifo_file):
+    """Create the FIFO if needed and open it without blocking.
+
+    It is opened for writing as well as reading so that it never reports end of file when a writer goes away."""
+
+    try:
+        os.mkfifo(fifo_file, 0o620)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        if not stat.S_ISFIFO(os.stat(fifo_file).st_mode):
+            raise
+    return os.open(fifo_file, os.O_RDWR | os.O_NONBLOCK)